@@ -3,14 +3,16 @@ import datetime
 import logging
 import urllib.parse
 import secrets
+import typing
 
 import aiohttp
 import aiohttp.web
 
 import smartlist.client
 import smartlist.db
+import smartlist.scheduler
+import smartlist.serialization
 import smartlist.session
-import smartlist.sync
 
 
 logger = logging.getLogger(__name__)
@@ -21,10 +23,10 @@ def get_home(session: smartlist.session.Session, artists_route: str):
         return aiohttp.web.HTTPTemporaryRedirect(artists_route)
 
 
-async def get_artists(db: smartlist.db.SmartListDB,
+async def get_artists(db: smartlist.db.AsyncSmartListDB,
                       session: smartlist.session.Session,
                       spotify_client: smartlist.client.SpotifyClient):
-    db_artists = {artist["id"]: artist for artist in db.get_artists(session.user_id)}
+    db_artists = {artist["id"]: artist for artist in await db.get_artists(session.user_id)}
     artist_details = await spotify_client.get_artists_by_ids(list(db_artists.keys()))
     return dict(
         saved_artists=[dict(details=artist, state=db_artists[artist["uri"]])
@@ -32,16 +34,18 @@ async def get_artists(db: smartlist.db.SmartListDB,
     )
 
 
-async def get_artists_edit(db: smartlist.db.SmartListDB,
+async def get_artists_edit(db: smartlist.db.AsyncSmartListDB,
                            session: smartlist.session.Session,
                            spotify_client: smartlist.client.SpotifyClient):
     return dict(
-        saved_artists={artist["id"] for artist in db.get_artists(session.user_id)},
+        saved_artists={artist["id"] for artist in await db.get_artists(session.user_id)},
         followed_artists=await spotify_client.get_followed_artists(),
     )
 
 
-async def post_artists(db: smartlist.db.SmartListDB, session: smartlist.session.Session, payload):
+async def post_artists(db: smartlist.db.AsyncSmartListDB,
+                       session: smartlist.session.Session,
+                       payload):
     if not isinstance(payload, dict) or \
             "artists" not in payload or \
             not isinstance(payload["artists"], dict):
@@ -55,23 +59,21 @@ async def post_artists(db: smartlist.db.SmartListDB, session: smartlist.session.
         else:
             artists_to_remove.append(artist)
 
-    db.add_artists(session.user_id, artists_to_add)
-    db.remove_artists(session.user_id, artists_to_remove)
+    await db.add_artists(session.user_id, artists_to_add)
+    await db.remove_artists(session.user_id, artists_to_remove)
 
     return aiohttp.web.json_response()
 
 
 async def get_artists_sync(request: aiohttp.web.Request,
-                           config: configparser.ConfigParser,
-                           db: smartlist.db.SmartListDB,
-                           session: smartlist.session.Session,
-                           spotify_client: smartlist.client.SpotifyClient):
+                           scheduler: smartlist.scheduler.SyncScheduler,
+                           session: smartlist.session.Session):
     ws = aiohttp.web.WebSocketResponse()
     await ws.prepare(request)
 
     csrf_check_succeeded = False
     try:
-        msg = await ws.receive_json()
+        msg = await ws.receive_json(loads=smartlist.serialization.loads)
         csrf_check_succeeded = msg["type"] == "csrf" and msg["csrfToken"] == session.csrf_token
     except Exception:
         pass
@@ -79,7 +81,13 @@ async def get_artists_sync(request: aiohttp.web.Request,
     if not csrf_check_succeeded:
         return aiohttp.web.HTTPUnauthorized(text="No CSRF token provided!")
 
-    await smartlist.sync.sync_artists(ws, config, db, session.user_id, spotify_client)
+    await scheduler.subscribe(session.user_id, ws)
+    try:
+        job_id = await scheduler.request_sync(session.user_id)
+        await scheduler.wait_for_job(job_id)
+    finally:
+        scheduler.unsubscribe(session.user_id, ws)
+
     return ws
 
 
@@ -104,8 +112,10 @@ def login(
 
 async def login_callback(
         config: configparser.ConfigParser,
-        db: smartlist.db.SmartListDB,
+        db: smartlist.db.AsyncSmartListDB,
         session: smartlist.session.Session,
+        new_session: typing.Callable[[], typing.Awaitable[smartlist.session.Session]],
+        client_session: aiohttp.ClientSession,
         home_route: str, artists_route: str,
         login_callback_route: str,
         login_failed_route: aiohttp.web.AbstractResource,
@@ -127,55 +137,56 @@ async def login_callback(
         session.add_flash(dict(type="error", msg="Encountered an error logging in."))
         return aiohttp.web.HTTPTemporaryRedirect(home_route)
 
-    async with aiohttp.ClientSession() as client_session:
-        token_parameters = dict(
-            grant_type="authorization_code",
-            client_id=config.get("auth", "client_id"),
-            client_secret=config.get("auth", "client_secret"),
-            code=code,
-            redirect_uri=urllib.parse.urljoin(
-                config.get("auth", "callback_base_url"), login_callback_route),
-        )
-        async with client_session.post(
-                "https://accounts.spotify.com/api/token", data=token_parameters) as resp:
-            if resp.status != 200:
-                logger.error("Error getting token, received status {}".format(resp.status))
-                session.add_flash(dict(type="error", msg="Encountered an error logging in."))
-                return aiohttp.web.HTTPTemporaryRedirect(home_route)
-
-            auth_data = await resp.json()
-            expiration_time = datetime.datetime.now(datetime.timezone.utc)
-            expiration_time += datetime.timedelta(seconds=auth_data["expires_in"])
-
-        headers = dict(
-            Authorization="Bearer " + auth_data["access_token"],
-        )
-        async with client_session.get("https://api.spotify.com/v1/me", headers=headers) as resp:
-            if resp.status != 200:
-                payload = await resp.text()
-                logger.error("Error getting profile, received {}: {}".format(resp.status, payload))
-                session.add_flash(dict(type="error", msg="Encountered an error logging in."))
-                return aiohttp.web.HTTPTemporaryRedirect(home_route)
-
-            profile_data = await resp.json()
-
-        allowed_users = list(filter(lambda s: s != "", config.get(
-            "auth", "allowed_users", fallback="").split(",")))
-        if len(allowed_users) > 0:
-            if profile_data["uri"] not in allowed_users:
-                return aiohttp.web.HTTPTemporaryRedirect(
-                    login_failed_route.url_for().with_query(userId=profile_data["uri"]))
-
-        session.user_info = dict(
-            user_id=profile_data["uri"],
-            access_token=auth_data["access_token"],
-            access_token_expiry=expiration_time.isoformat(),
-        )
-        db.upsert_user(profile_data["uri"], auth_data["refresh_token"])
+    token_parameters = dict(
+        grant_type="authorization_code",
+        client_id=config.get("auth", "client_id"),
+        client_secret=config.get("auth", "client_secret"),
+        code=code,
+        redirect_uri=urllib.parse.urljoin(
+            config.get("auth", "callback_base_url"), login_callback_route),
+    )
+    async with client_session.post(
+            "https://accounts.spotify.com/api/token", data=token_parameters) as resp:
+        if resp.status != 200:
+            logger.error("Error getting token, received status {}".format(resp.status))
+            session.add_flash(dict(type="error", msg="Encountered an error logging in."))
+            return aiohttp.web.HTTPTemporaryRedirect(home_route)
+
+        auth_data = await resp.json(loads=smartlist.serialization.loads)
+        expiration_time = datetime.datetime.now(datetime.timezone.utc)
+        expiration_time += datetime.timedelta(seconds=auth_data["expires_in"])
+
+    headers = dict(
+        Authorization="Bearer " + auth_data["access_token"],
+    )
+    async with client_session.get("https://api.spotify.com/v1/me", headers=headers) as resp:
+        if resp.status != 200:
+            payload = await resp.text()
+            logger.error("Error getting profile, received {}: {}".format(resp.status, payload))
+            session.add_flash(dict(type="error", msg="Encountered an error logging in."))
+            return aiohttp.web.HTTPTemporaryRedirect(home_route)
+
+        profile_data = await resp.json(loads=smartlist.serialization.loads)
+
+    allowed_users = list(filter(lambda s: s != "", config.get(
+        "auth", "allowed_users", fallback="").split(",")))
+    if len(allowed_users) > 0:
+        if profile_data["uri"] not in allowed_users:
+            return aiohttp.web.HTTPTemporaryRedirect(
+                login_failed_route.url_for().with_query(userId=profile_data["uri"]))
+
+    session = await new_session()
+    session.user_info = dict(
+        user_id=profile_data["uri"],
+        access_token=auth_data["access_token"],
+        access_token_expiry=expiration_time.isoformat(),
+    )
+    await db.upsert_user(profile_data["uri"], auth_data["refresh_token"])
 
-        return aiohttp.web.HTTPTemporaryRedirect(artists_route)
+    return aiohttp.web.HTTPTemporaryRedirect(artists_route)
 
 
 def logout(session: smartlist.session.Session, home_route: str):
     del session.user_info
+    del session.csrf_token
     return aiohttp.web.HTTPTemporaryRedirect(home_route)
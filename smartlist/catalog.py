@@ -0,0 +1,97 @@
+import collections
+import configparser
+import datetime
+import logging
+import typing
+
+import smartlist.db
+
+
+logger = logging.getLogger(__name__)
+
+CatalogLoader = typing.Callable[
+    [typing.List[str], str], typing.Awaitable[typing.List[typing.Tuple[dict, str]]]]
+CatalogStorer = typing.Callable[
+    [typing.List[typing.Tuple[str, dict]], str], typing.Awaitable[None]]
+
+
+class Catalog(object):
+
+    def __init__(self,
+                 name: str,
+                 load: CatalogLoader,
+                 store: CatalogStorer,
+                 cache_size: int,
+                 ttl_hours: int):
+        self._name = name
+        self._load = load
+        self._store = store
+        self._cache_size = cache_size
+        self._ttl = datetime.timedelta(hours=ttl_hours)
+        self._cache: "collections.OrderedDict[str, typing.Tuple[dict, datetime.datetime]]" = \
+            collections.OrderedDict()
+
+    def _cache_put(self, item: dict, fetched: datetime.datetime):
+        self._cache[item["uri"]] = (item, fetched)
+        self._cache.move_to_end(item["uri"])
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+    async def get_items(self, uris: typing.List[str]) \
+            -> typing.Tuple[typing.Dict[str, dict], typing.List[str]]:
+        cutoff = datetime.datetime.now(datetime.timezone.utc) - self._ttl
+        found = dict()
+        uncached = []
+        for uri in uris:
+            if uri in self._cache:
+                item, fetched = self._cache[uri]
+                if fetched > cutoff:
+                    self._cache.move_to_end(uri)
+                    found[uri] = item
+                    continue
+
+                del self._cache[uri]
+
+            uncached.append(uri)
+
+        if len(uncached) > 0:
+            rows = await self._load(uncached, cutoff.isoformat())
+            for item, fetched in rows:
+                self._cache_put(item, datetime.datetime.fromisoformat(fetched))
+                found[item["uri"]] = item
+
+        missing = list(dict.fromkeys(uri for uri in uris if uri not in found))
+        logger.info("{} catalog hits: {}, misses: {}".format(self._name, len(found), len(missing)))
+        return found, missing
+
+    async def save_items(self, items: typing.List[dict]):
+        if len(items) == 0:
+            return
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        for item in items:
+            self._cache_put(item, now)
+
+        await self._store([(item["uri"], item) for item in items], now.isoformat())
+
+
+def create_artist_catalog(db: smartlist.db.AsyncSmartListDB,
+                          config: configparser.ConfigParser) -> Catalog:
+    return Catalog(
+        "Artist",
+        db.get_catalog_artists,
+        db.save_catalog_artists,
+        config.getint("artist_cache", "cache_size", fallback=2048),
+        config.getint("artist_cache", "ttl_hours", fallback=24),
+    )
+
+
+def create_album_catalog(db: smartlist.db.AsyncSmartListDB,
+                         config: configparser.ConfigParser) -> Catalog:
+    return Catalog(
+        "Album track",
+        db.get_catalog_albums,
+        db.save_catalog_albums,
+        config.getint("album_cache", "cache_size", fallback=256),
+        config.getint("album_cache", "ttl_hours", fallback=168),
+    )
@@ -1,17 +1,27 @@
+import asyncio
+import collections
 import configparser
 import contextlib
 import datetime
 import logging
+import time
 import typing
 
 import aiohttp
 
+import smartlist.catalog
 import smartlist.db
+import smartlist.serialization
 import smartlist.session
 
 
 ARTIST_IDS_BATCH_SIZE = 50
 PLAYLIST_ITEMS_BATCH_SIZE = 100
+ALBUM_TRACKS_PAGE_SIZE = 50
+MAX_RATE_LIMIT_RETRIES = 5
+
+_token_refreshes: typing.Dict[str, asyncio.Future] = dict()
+
 logger = logging.getLogger(__name__)
 
 
@@ -70,6 +80,15 @@ class Album(object):
 
         self.tracks[track.uri] = track
 
+    def copy_without_tracks(self) -> "Album":
+        return Album(
+            self.name,
+            self._release_date,
+            self._release_date_precision,
+            self.uri,
+            self.artists,
+        )
+
     @classmethod
     def parse(cls, raw_album: typing.Dict[str, typing.Any]):
         album = cls(
@@ -129,16 +148,189 @@ class SpotifyApiException(Exception):
         super().__init__(message)
 
 
+class RateLimiter(object):
+
+    def __init__(self, rate: float, burst: int):
+        self._rate = rate
+        self._burst = burst
+        self._tokens = float(burst)
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock: typing.Optional[asyncio.Lock] = None
+
+    async def acquire(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._blocked_until:
+                    await asyncio.sleep(self._blocked_until - now)
+                    continue
+
+                self._tokens = min(self._burst, self._tokens + (now - self._updated) * self._rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self._tokens) / self._rate)
+
+    def block(self, seconds: float):
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+
+
+class ResponseCache(object):
+
+    def __init__(self, max_entries: int):
+        self._max_entries = max_entries
+        self._entries: "collections.OrderedDict[typing.Tuple[str, str], typing.Tuple[str, dict]]"
+        self._entries = collections.OrderedDict()
+
+    def get(self, user_id: str, url: str) -> typing.Optional[typing.Tuple[str, dict]]:
+        key = (user_id, url)
+        if key not in self._entries:
+            return None
+
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def put(self, user_id: str, url: str, etag: str, payload: dict):
+        key = (user_id, url)
+        self._entries[key] = (etag, payload)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+
+def create_response_cache(config: configparser.ConfigParser) -> typing.Optional[ResponseCache]:
+    max_entries = config.getint("http", "response_cache_size", fallback=0)
+    if max_entries <= 0:
+        return None
+
+    return ResponseCache(max_entries)
+
+
+def create_rate_limiter(config: configparser.ConfigParser) -> RateLimiter:
+    return RateLimiter(
+        config.getfloat("http", "requests_per_second", fallback=10),
+        config.getint("http", "request_burst", fallback=10),
+    )
+
+
+def create_client_session(config: configparser.ConfigParser) -> aiohttp.ClientSession:
+    return aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(
+            limit=config.getint("http", "connection_limit", fallback=100),
+            limit_per_host=config.getint("http", "connection_limit_per_host", fallback=20),
+            keepalive_timeout=config.getint("http", "keepalive_timeout", fallback=60),
+            ttl_dns_cache=config.getint("http", "dns_cache_seconds", fallback=300),
+        ),
+        json_serialize=smartlist.serialization.dumps,
+    )
+
+
+def add_fields(url: str, fields: typing.Optional[str]) -> str:
+    if fields is None:
+        return url
+
+    return "{}{}fields={}".format(url, "&" if "?" in url else "?", fields)
+
+
+def project_artist(raw_artist: dict) -> dict:
+    return dict(name=raw_artist["name"], uri=raw_artist["uri"])
+
+
+def project_track(raw_track: dict) -> dict:
+    return dict(
+        name=raw_track["name"],
+        uri=raw_track["uri"],
+        disc_number=raw_track["disc_number"],
+        track_number=raw_track["track_number"],
+        artists=[project_artist(raw_artist) for raw_artist in raw_track["artists"]],
+    )
+
+
+def project_album(raw_album: dict) -> dict:
+    album = dict(
+        name=raw_album["name"],
+        release_date=raw_album["release_date"],
+        release_date_precision=raw_album["release_date_precision"],
+        uri=raw_album["uri"],
+        artists=[project_artist(raw_artist) for raw_artist in raw_album["artists"]],
+    )
+    if "tracks" in raw_album:
+        album["tracks"] = dict(
+            items=[project_track(raw_track) for raw_track in raw_album["tracks"]["items"]],
+            next=raw_album["tracks"]["next"],
+            total=raw_album["tracks"]["total"],
+        )
+
+    return album
+
+
+def project_saved_album(saved_album: dict) -> dict:
+    return dict(added_at=saved_album["added_at"], album=project_album(saved_album["album"]))
+
+
+def project_saved_track(saved_track: dict) -> dict:
+    return dict(
+        added_at=saved_track["added_at"],
+        track=dict(
+            project_track(saved_track["track"]),
+            album=project_album(saved_track["track"]["album"]),
+        ),
+    )
+
+
+def group_saved_tracks(saved_tracks: typing.List[dict]) -> typing.List[Album]:
+    albums: typing.Dict[str, Album] = dict()
+    for saved_track in saved_tracks:
+        album_uri = saved_track["track"]["album"]["uri"]
+        if album_uri not in albums:
+            albums[album_uri] = Album.parse(saved_track["track"]["album"])
+        albums[album_uri].add_track(Track.parse(albums[album_uri], saved_track["track"]))
+
+    return list(albums.values())
+
+
+class ClientResources(object):
+
+    def __init__(self,
+                 client_session: typing.Optional[aiohttp.ClientSession] = None,
+                 rate_limiter: typing.Optional[RateLimiter] = None,
+                 response_cache: typing.Optional[ResponseCache] = None,
+                 artist_catalog: typing.Optional[smartlist.catalog.Catalog] = None,
+                 album_catalog: typing.Optional[smartlist.catalog.Catalog] = None):
+        self.client_session = client_session
+        self.rate_limiter = rate_limiter
+        self.response_cache = response_cache
+        self.artist_catalog = artist_catalog
+        self.album_catalog = album_catalog
+
+
 class SpotifyClient(object):
 
     def __init__(self,
                  config: configparser.ConfigParser,
-                 db: smartlist.db.SmartListDB,
-                 session: smartlist.session.Session):
+                 db: smartlist.db.AsyncSmartListDB,
+                 session: smartlist.session.Session,
+                 resources: typing.Optional[ClientResources] = None):
+        if resources is None:
+            resources = ClientResources()
+
         self._request_session = session
         self._config = config
         self._db = db
-        self._client_session = None
+        self._client_session = resources.client_session
+        self._owns_client_session = resources.client_session is None
+        self._rate_limiter = resources.rate_limiter
+        self._artist_catalog = resources.artist_catalog
+        self._response_cache = resources.response_cache
+        self._album_catalog = resources.album_catalog
+        self._access_token_expiry: typing.Optional[typing.Tuple[str, datetime.datetime]] = None
+        self._library_changes: typing.Dict[str, typing.List[dict]] = dict()
 
     def _get_client_session(self) -> aiohttp.ClientSession:
         if self._client_session is None:
@@ -146,159 +338,446 @@ class SpotifyClient(object):
 
         return self._client_session
 
+    def _get_access_token_expiry(self) -> datetime.datetime:
+        expiry = self._request_session.access_token_expiry
+        if self._access_token_expiry is None or self._access_token_expiry[0] != expiry:
+            self._access_token_expiry = (expiry, datetime.datetime.fromisoformat(expiry))
+
+        return self._access_token_expiry[1]
+
     def _is_access_token_expired(self):
-        expiry_time = datetime.datetime.fromisoformat(self._request_session.access_token_expiry)
+        expiry_time = self._get_access_token_expiry()
         now = datetime.datetime.now(datetime.timezone.utc)
         return expiry_time - now < datetime.timedelta(minutes=5)
 
     async def _refresh_token(self):
-        logger.info("Attempting to refresh token for {}".format(self._request_session.user_id))
+        user_id = self._request_session.user_id
+        refresh = _token_refreshes.get(user_id)
+        if refresh is None:
+            refresh = asyncio.ensure_future(self._request_new_token(user_id))
+            _token_refreshes[user_id] = refresh
+            refresh.add_done_callback(lambda _: _token_refreshes.pop(user_id, None))
+        else:
+            logger.info("Waiting for in-flight token refresh for {}".format(user_id))
+
+        access_token, expiry_time = await asyncio.shield(refresh)
+        self._request_session.user_info = dict(
+            user_id=user_id,
+            access_token=access_token,
+            access_token_expiry=expiry_time.isoformat(),
+        )
+        self._access_token_expiry = (expiry_time.isoformat(), expiry_time)
+
+    async def _request_new_token(self, user_id: str) -> typing.Tuple[str, datetime.datetime]:
+        logger.info("Attempting to refresh token for {}".format(user_id))
         async with self._get_client_session().post(
                 "https://accounts.spotify.com/api/token",
                 data=dict(
                     grant_type="refresh_token",
-                    refresh_token=self._db.get_refresh_token(self._request_session.user_id),
+                    refresh_token=await self._db.get_refresh_token(user_id),
                     client_id=self._config.get("auth", "client_id"),
                     client_secret=self._config.get("auth", "client_secret"),
                 )
         ) as resp:
             if resp.status != 200:
-                logger.error("Failed to refresh token for {}".format(self._request_session.user_id))
+                logger.error("Failed to refresh token for {}".format(user_id))
                 raise SpotifyAuthorizationException(
                     "Unable to refresh token, status code {}".format(resp.status))
 
-            payload = await resp.json()
+            payload = await resp.json(loads=smartlist.serialization.loads)
             if "refresh_token" in payload:
-                self._db.upsert_user(self._request_session.user_id, payload["refresh_token"])
+                await self._db.upsert_user(user_id, payload["refresh_token"])
 
             now = datetime.datetime.now(datetime.timezone.utc)
-            now += datetime.timedelta(seconds=payload["expires_in"])
-            self._request_session.user_info = dict(
-                user_id=self._request_session.user_id,
-                access_token=payload["access_token"],
-                access_token_expiry=now.isoformat(),
-            )
+            expiry_time = now + datetime.timedelta(seconds=payload["expires_in"])
 
-        logger.info("Successfully refreshed token for {}".format(self._request_session.user_id))
+        logger.info("Successfully refreshed token for {}".format(user_id))
+        return payload["access_token"], expiry_time
+
+    async def _wait_for_rate_limit(self):
+        if self._rate_limiter is not None:
+            await self._rate_limiter.acquire()
+
+    async def _back_off(self, seconds: float):
+        if self._rate_limiter is not None:
+            self._rate_limiter.block(seconds)
+        else:
+            await asyncio.sleep(seconds)
 
     @contextlib.asynccontextmanager
-    async def _make_api_call(self, method: str, url: str, body=None):
+    async def _make_api_call(self,
+                             method: str,
+                             url: str,
+                             body=None,
+                             headers: typing.Optional[typing.Dict[str, str]] = None):
         if self._is_access_token_expired():
             await self._refresh_token()
 
         headers = dict(
+            headers or dict(),
             Authorization="Bearer {}".format(self._request_session.access_token),
         )
 
-        async with self._get_client_session().request(
-                method, url, headers=headers, json=body) as resp:
-            if resp.status != 401:
+        token_refreshed = False
+        rate_limit_retries = 0
+        while True:
+            await self._wait_for_rate_limit()
+            async with self._get_client_session().request(
+                    method, url, headers=headers, json=body) as resp:
+                if resp.status == 401 and not token_refreshed:
+                    await self._refresh_token()
+                    headers["Authorization"] = "Bearer {}".format(
+                        self._request_session.access_token)
+                    token_refreshed = True
+                    continue
+
+                if resp.status == 429 and rate_limit_retries < MAX_RATE_LIMIT_RETRIES:
+                    retry_after = float(resp.headers.get("Retry-After", 1))
+                    logger.warning("Rate limited calling {}, retrying after {}s".format(
+                        url, retry_after))
+                    rate_limit_retries += 1
+                    await self._back_off(retry_after)
+                    continue
+
                 yield resp
-            else:
-                await self._refresh_token()
-                headers["Authorization"] = "Bearer {}".format(self._request_session.access_token)
-                async with self._get_client_session().request(
-                        method, url, headers=headers, json=body) as resp:
-                    yield resp
+                return
 
     async def close(self):
-        if self._client_session is not None:
+        if self._owns_client_session and self._client_session is not None:
             await self._client_session.close()
 
+    async def _get_page(self,
+                        url: str,
+                        error_message: str,
+                        use_cache: bool = False,
+                        fields: typing.Optional[str] = None) -> dict:
+        url = add_fields(url, fields)
+        response_cache = self._response_cache if use_cache else None
+        cached = None
+        if response_cache is not None:
+            cached = response_cache.get(self._request_session.user_id, url)
+
+        if cached is None:
+            api_call = self._make_api_call("get", url)
+        else:
+            api_call = self._make_api_call("get", url, headers={"If-None-Match": cached[0]})
+
+        async with api_call as resp:
+            if resp.status == 304 and cached is not None:
+                return cached[1]
+
+            if resp.status != 200:
+                text = await resp.text()
+                logger.error("{}: {} -> {}".format(error_message, resp.status, text))
+                raise SpotifyApiException(error_message)
+
+            payload = await resp.json(loads=smartlist.serialization.loads)
+            if response_cache is not None and "ETag" in resp.headers:
+                response_cache.put(
+                    self._request_session.user_id, url, resp.headers["ETag"], payload)
+
+            return payload
+
     async def get_followed_artists(self):
-        url = "https://api.spotify.com/v1/me/following?type=artist&limit=50"
+        next_page = asyncio.ensure_future(self._get_page(
+            "https://api.spotify.com/v1/me/following?type=artist&limit=50",
+            "Error getting artists", use_cache=True))
         artists = []
-        while True:
-            async with self._make_api_call("get", url) as resp:
-                if resp.status != 200:
-                    raise SpotifyApiException("Error getting artists")
-
-                payload = await resp.json()
-                artists.extend(payload["artists"]["items"])
-                if not payload["artists"]["next"]:
-                    break
+        while next_page is not None:
+            payload = await next_page
+            next_page = None
+            if payload["artists"]["next"]:
+                next_page = asyncio.ensure_future(self._get_page(
+                    payload["artists"]["next"], "Error getting artists", use_cache=True))
 
-                url = payload["artists"]["next"]
+            artists.extend(payload["artists"]["items"])
 
         artists.sort(key=lambda a: a["name"].lower())
         return artists
 
     async def get_artists_by_ids(self, artist_ids: typing.List[str]):
-        artists = []
-        for batch_start in range(0, len(artist_ids), ARTIST_IDS_BATCH_SIZE):
-            async with self._make_api_call(
-                "get",
-                "https://api.spotify.com/v1/artists?ids={}".format(
-                    ",".join(id[len("spotify:artist:"):] for id in
-                             artist_ids[batch_start:batch_start + ARTIST_IDS_BATCH_SIZE])),
-            ) as resp:
-                if resp.status != 200:
-                    print(await resp.text())
-                    raise SpotifyApiException("Error getting artists by id")
-
-                payload = await resp.json()
-                artists.extend(payload["artists"])
+        if self._artist_catalog is None:
+            artists = await self._fetch_artists_by_ids(artist_ids)
+        else:
+            cached_artists, missing_ids = await self._artist_catalog.get_items(artist_ids)
+            fetched_artists = await self._fetch_artists_by_ids(missing_ids)
+            await self._artist_catalog.save_items(fetched_artists)
+            artists = list(cached_artists.values()) + fetched_artists
 
         artists.sort(key=lambda a: a["name"].lower())
         return artists
 
-    async def get_saved_albums(self) -> typing.List[Album]:
-        url = "https://api.spotify.com/v1/me/albums?limit=50"
-        albums = []
+    async def _fetch_artists_by_ids(self, artist_ids: typing.List[str]):
+        if len(artist_ids) == 0:
+            return []
+
+        semaphore = asyncio.Semaphore(
+            self._config.getint("http", "batch_concurrency", fallback=4))
+
+        async def get_batch_with_limit(batch: typing.List[str]):
+            async with semaphore:
+                return await self._get_page(
+                    "https://api.spotify.com/v1/artists?ids={}".format(
+                        ",".join(id[len("spotify:artist:"):] for id in batch)),
+                    "Error getting artists by id")
+
+        payloads = await asyncio.gather(*(
+            get_batch_with_limit(artist_ids[batch_start:batch_start + ARTIST_IDS_BATCH_SIZE])
+            for batch_start in range(0, len(artist_ids), ARTIST_IDS_BATCH_SIZE)))
+        return [artist for payload in payloads for artist in payload["artists"]]
+
+    async def _iter_saved_item_pages(self, url: str, error_message: str) \
+            -> typing.AsyncIterator[typing.List[dict]]:
+        payload = await self._get_page(url, error_message, use_cache=True)
+        yield payload["items"]
+        if not payload["next"]:
+            return
+
+        semaphore = asyncio.Semaphore(self._config.getint("sync", "page_concurrency", fallback=4))
+
+        async def get_page_with_limit(offset: int):
+            async with semaphore:
+                return await self._get_page("{}&offset={}".format(url, offset), error_message)
+
+        pages = [asyncio.ensure_future(get_page_with_limit(offset)) for offset in
+                 range(payload["limit"], payload["total"], payload["limit"])]
+        try:
+            for page in pages:
+                yield (await page)["items"]
+        finally:
+            for page in pages:
+                page.cancel()
+
+    async def _page_saved_items(self,
+                                url: str,
+                                item_key: str,
+                                error_message: str,
+                                known_items: typing.Set[typing.Tuple[str, str]]):
+        payload = await self._get_page(url, error_message, use_cache=True)
+        items = []
         while True:
-            async with self._make_api_call("get", url) as resp:
-                if resp.status != 200:
-                    text = await resp.text()
-                    logger.error("Error getting saved albums: {} -> {}".format(resp.status, text))
-                    raise SpotifyApiException("Error getting saved albums")
+            for saved_item in payload["items"]:
+                if (saved_item[item_key]["uri"], saved_item["added_at"]) in known_items:
+                    return items, payload["total"]
 
-                payload = await resp.json()
-                for saved_album in payload["items"]:
-                    albums.append(Album.parse(saved_album["album"]))
-                if not payload["next"]:
-                    break
+                items.append(saved_item)
 
-                url = payload["next"]
+            if not payload["next"]:
+                return items, payload["total"]
 
-        return albums
+            payload = await self._get_page(payload["next"], error_message)
 
-    async def get_saved_tracks(self) -> typing.List[Album]:
-        url = "https://api.spotify.com/v1/me/tracks?limit=50"
-        albums: typing.Dict[str, Album] = dict()
+    def _is_library_snapshot_fresh(self,
+                                   last_full_sync: typing.Optional[str],
+                                   now: datetime.datetime) -> bool:
+        return last_full_sync is not None and \
+            now - datetime.datetime.fromisoformat(last_full_sync) < datetime.timedelta(
+                hours=self._config.getint("sync", "library_full_sync_hours", fallback=24))
+
+    async def _is_saved_items_unchanged(self, item_type: str, url: str, error_message: str):
+        user_id = self._request_session.user_id
+        now = datetime.datetime.now(datetime.timezone.utc)
+
+        last_full_sync = await self._db.get_library_last_full_sync(user_id, item_type)
+        if not self._is_library_snapshot_fresh(last_full_sync, now):
+            return False
+
+        payload = await self._get_page(url, error_message)
+        total, newest_added_at = await self._db.get_library_summary(user_id, item_type)
+        newest_item = payload["items"][0]["added_at"] if len(payload["items"]) > 0 else None
+        return payload["total"] == total and newest_item == newest_added_at
+
+    async def is_library_unchanged(self) -> bool:
+        results = await asyncio.gather(
+            self._is_saved_items_unchanged(
+                "albums",
+                "https://api.spotify.com/v1/me/albums?limit=1",
+                "Error probing saved albums",
+            ),
+            self._is_saved_items_unchanged(
+                "tracks",
+                "https://api.spotify.com/v1/me/tracks?limit=1",
+                "Error probing saved tracks",
+            ),
+        )
+        return all(results)
+
+    async def _iter_library_snapshot(self,
+                                     item_type: str,
+                                     skip_uris: typing.AbstractSet[str] = frozenset()) \
+            -> typing.AsyncIterator[typing.List[dict]]:
+        user_id = self._request_session.user_id
+        after_uri = ""
         while True:
-            async with self._make_api_call("get", url) as resp:
-                if resp.status != 200:
-                    text = await resp.text()
-                    logger.error("Error getting saved tracks: {} -> {}".format(resp.status, text))
-                    raise SpotifyApiException("Error getting saved tracks")
+            rows = await self._db.get_library_items(user_id, item_type, after_uri)
+            if len(rows) == 0:
+                return
+
+            after_uri = rows[-1][0]
+            yield [item for uri, item in rows if uri not in skip_uris]
+
+    async def _iter_saved_items(self,
+                                item_type: str,
+                                url: str,
+                                item_key: str,
+                                error_message: str,
+                                use_snapshot: bool,
+                                project: typing.Callable[[dict], dict]) \
+            -> typing.AsyncIterator[typing.List[dict]]:
+        user_id = self._request_session.user_id
+        now = datetime.datetime.now(datetime.timezone.utc)
 
-                payload = await resp.json()
-                for saved_track in payload["items"]:
-                    album_uri = saved_track["track"]["album"]["uri"]
-                    if album_uri not in albums:
-                        albums[album_uri] = Album.parse(saved_track["track"]["album"])
-                    albums[album_uri].add_track(Track.parse(
-                        albums[album_uri], saved_track["track"]))
+        def to_key(item):
+            return item[item_key]["uri"], item["added_at"]
 
-                if not payload["next"]:
-                    break
+        def to_rows(items):
+            return [(*to_key(item), item) for item in items]
 
-                url = payload["next"]
+        if use_snapshot:
+            self._library_changes[item_type] = []
+            async for page in self._iter_library_snapshot(item_type):
+                yield page
+            return
 
-        return list(albums.values())
+        snapshot_keys = set(await self._db.get_library_keys(user_id, item_type))
+        last_full_sync = await self._db.get_library_last_full_sync(user_id, item_type)
+        if self._is_library_snapshot_fresh(last_full_sync, now):
+            new_items, total = await self._page_saved_items(
+                url, item_key, error_message, snapshot_keys)
+            new_items = [project(item) for item in new_items]
+
+            new_uris = {item[item_key]["uri"] for item in new_items}
+            kept_count = sum(1 for uri, _ in snapshot_keys if uri not in new_uris)
+            if len(new_items) + kept_count == total:
+                self._library_changes[item_type] = new_items
+                yield new_items
+                await self._db.save_library_items(user_id, item_type, to_rows(new_items))
+                async for page in self._iter_library_snapshot(item_type, new_uris):
+                    yield page
+                return
+
+            logger.info("Saved {} snapshot for {} is stale, running a full pass".format(
+                item_type, user_id))
+
+        # without a snapshot every item is a change; clean artists are still fingerprint checked
+        track_changes = len(snapshot_keys) > 0
+        if not track_changes:
+            logger.info("No saved {} snapshot for {}, skipping change tracking".format(
+                item_type, user_id))
+
+        await self._db.clear_library_staging(user_id, item_type)
+        seen_keys = set()
+        added_items = []
+        async for page in self._iter_saved_item_pages(url, error_message):
+            page = [project(item) for item in page]
+            if track_changes:
+                seen_keys.update(to_key(item) for item in page)
+                added_items.extend(item for item in page if to_key(item) not in snapshot_keys)
+            yield page
+            await self._db.stage_library_items(user_id, item_type, to_rows(page))
+
+        removed_uris = sorted(uri for uri, added_at in snapshot_keys
+                              if (uri, added_at) not in seen_keys)
+        removed_items = []
+        if len(removed_uris) > 0:
+            removed_items = await self._db.get_library_items_by_uri(
+                user_id, item_type, removed_uris)
+
+        await self._db.commit_library_staging(user_id, item_type, now.isoformat())
+        self._library_changes[item_type] = added_items + removed_items
+
+    async def _fetch_album_tracks(self, raw_album: dict, semaphore: asyncio.Semaphore) -> dict:
+        embedded_tracks = raw_album["tracks"]
+
+        async def get_page_with_limit(offset: int):
+            async with semaphore:
+                return await self._get_page(
+                    "https://api.spotify.com/v1/albums/{}/tracks?limit={}&offset={}".format(
+                        raw_album["uri"][len("spotify:album:"):], ALBUM_TRACKS_PAGE_SIZE, offset),
+                    "Error getting album tracks")
+
+        pages = await asyncio.gather(*(
+            get_page_with_limit(offset) for offset in
+            range(len(embedded_tracks["items"]), embedded_tracks["total"],
+                  ALBUM_TRACKS_PAGE_SIZE)))
+        return dict(
+            uri=raw_album["uri"],
+            tracks=embedded_tracks["items"] + [
+                project_track(item) for page in pages for item in page["items"]],
+        )
 
-    async def get_playlist(self, playlist_id: str) -> dict:
-        async with self._make_api_call(
-            "get",
+    async def _complete_album_tracks(self, raw_albums: typing.List[dict]):
+        truncated = {raw_album["uri"]: raw_album for raw_album in raw_albums
+                     if raw_album["tracks"]["next"]}
+        if len(truncated) == 0:
+            return
+
+        if self._album_catalog is None:
+            listings, missing_uris = dict(), list(truncated)
+        else:
+            listings, missing_uris = await self._album_catalog.get_items(list(truncated))
+
+        semaphore = asyncio.Semaphore(self._config.getint("sync", "page_concurrency", fallback=4))
+        fetched = await asyncio.gather(*(
+            self._fetch_album_tracks(truncated[uri], semaphore) for uri in missing_uris))
+        if self._album_catalog is not None:
+            await self._album_catalog.save_items(fetched)
+
+        for listing in list(listings.values()) + fetched:
+            raw_album = truncated[listing["uri"]]
+            raw_album["tracks"] = dict(raw_album["tracks"], items=listing["tracks"], next=None)
+
+    async def iter_saved_albums(self, use_snapshot: bool = False) \
+            -> typing.AsyncIterator[typing.List[Album]]:
+        async for saved_albums in self._iter_saved_items(
+            "albums",
+            "https://api.spotify.com/v1/me/albums?limit=50",
+            "album",
+            "Error getting saved albums",
+            use_snapshot,
+            project_saved_album,
+        ):
+            await self._complete_album_tracks(
+                [saved_album["album"] for saved_album in saved_albums])
+            yield [Album.parse(saved_album["album"]) for saved_album in saved_albums]
+
+    async def iter_saved_tracks(self, use_snapshot: bool = False) \
+            -> typing.AsyncIterator[typing.List[Album]]:
+        async for saved_tracks in self._iter_saved_items(
+            "tracks",
+            "https://api.spotify.com/v1/me/tracks?limit=50",
+            "track",
+            "Error getting saved tracks",
+            use_snapshot,
+            project_saved_track,
+        ):
+            yield group_saved_tracks(saved_tracks)
+
+    def get_library_changes(self) -> typing.List[Album]:
+        return [Album.parse(saved_album["album"])
+                for saved_album in self._library_changes.get("albums", [])] + \
+            group_saved_tracks(self._library_changes.get("tracks", []))
+
+    async def get_user_playlists(self) -> typing.Dict[str, str]:
+        playlists = dict()
+        url = "https://api.spotify.com/v1/me/playlists?limit=50"
+        while url:
+            payload = await self._get_page(url, "Error getting user playlists", use_cache=True)
+            for playlist in payload["items"]:
+                playlists[playlist["uri"]] = playlist["snapshot_id"]
+            url = payload["next"]
+
+        return playlists
+
+    async def get_playlist(self, playlist_id: str, fields: typing.Optional[str] = None) -> dict:
+        return await self._get_page(
             "https://api.spotify.com/v1/playlists/{}".format(
                 playlist_id[len("spotify:playlist:"):],
             ),
-        ) as resp:
-            if resp.status != 200:
-                logger.error("Error getting playlist: {}".format(resp.status))
-                raise SpotifyApiException("Error getting playlist")
-
-            return await resp.json()
+            "Error getting playlist",
+            use_cache=True,
+            fields=fields,
+        )
 
     async def create_playlist(self, user_id: str, name: str, description: str) -> str:
         request_payload = dict(
@@ -318,33 +797,76 @@ class SpotifyClient(object):
                 logger.error("Error creating playlist: {} -> {}".format(resp.status, text))
                 raise SpotifyApiException("Error creating playlist")
 
-            return await resp.json()
+            return await resp.json(loads=smartlist.serialization.loads)
 
-    async def clear_playlist(self, playlist_id: str):
-        async with self._make_api_call(
-            "put",
-            "https://api.spotify.com/v1/playlists/{}/tracks".format(
+    async def get_playlist_items(self, playlist_id: str) -> typing.Tuple[str, typing.List[str]]:
+        payload = await self._get_page(
+            "https://api.spotify.com/v1/playlists/{}".format(
                 playlist_id[len("spotify:playlist:"):]),
-            body=dict(uris=[]),
-        ) as resp:
-            if resp.status != 201:
-                text = await resp.text()
-                logger.error("Error clearing playlist: {} -> {}".format(resp.status, text))
-                raise SpotifyApiException("Error clearing playlist")
-
-    async def add_items_to_playlist(self, playlist_id: str, items: typing.List[Track]):
+            "Error getting playlist items",
+            fields="snapshot_id,tracks(next,items(track(uri)))",
+        )
+        snapshot_id = payload["snapshot_id"]
+        payload = payload["tracks"]
+        uris = [item["track"]["uri"] for item in payload["items"]]
+        while payload["next"]:
+            payload = await self._get_page(
+                payload["next"], "Error getting playlist items", fields="next,items(track(uri))")
+            uris.extend(item["track"]["uri"] for item in payload["items"])
+
+        return snapshot_id, uris
+
+    async def remove_items_from_playlist(self,
+                                         playlist_id: str,
+                                         items: typing.List[typing.Tuple[int, str]],
+                                         snapshot_id: str) -> str:
+        items = sorted(items, reverse=True)
         for batch_start in range(0, len(items), PLAYLIST_ITEMS_BATCH_SIZE):
             async with self._make_api_call(
-                "post",
+                "delete",
                 "https://api.spotify.com/v1/playlists/{}/tracks".format(
                     playlist_id[len("spotify:playlist:"):]),
                 body=dict(
-                    uris=[i.uri for i in
-                          items[batch_start: batch_start + PLAYLIST_ITEMS_BATCH_SIZE]]
+                    tracks=[dict(uri=uri, positions=[position]) for position, uri in
+                            items[batch_start: batch_start + PLAYLIST_ITEMS_BATCH_SIZE]],
+                    snapshot_id=snapshot_id,
                 ),
+            ) as resp:
+                if resp.status != 200:
+                    text = await resp.text()
+                    logger.error("Error removing items from playlist: {} -> {}".format(
+                        resp.status, text))
+                    raise SpotifyApiException("Error removing items from playlist")
+
+                snapshot_id = (await resp.json(loads=smartlist.serialization.loads))["snapshot_id"]
+
+        return snapshot_id
+
+    async def add_items_to_playlist(self,
+                                    playlist_id: str,
+                                    items: typing.List[Track],
+                                    position: typing.Optional[int] = None) -> str:
+        snapshot_id = None
+        for batch_start in range(0, len(items), PLAYLIST_ITEMS_BATCH_SIZE):
+            body = dict(
+                uris=[i.uri for i in
+                      items[batch_start: batch_start + PLAYLIST_ITEMS_BATCH_SIZE]]
+            )
+            if position is not None:
+                body["position"] = position + batch_start
+
+            async with self._make_api_call(
+                "post",
+                "https://api.spotify.com/v1/playlists/{}/tracks".format(
+                    playlist_id[len("spotify:playlist:"):]),
+                body=body,
             ) as resp:
                 if resp.status != 201:
                     text = await resp.text()
                     logger.error("Error adding items to playlist: {} -> {}".format(
                         resp.status, text))
                     raise SpotifyApiException("Error adding items to playlist")
+
+                snapshot_id = (await resp.json(loads=smartlist.serialization.loads))["snapshot_id"]
+
+        return snapshot_id
@@ -1,14 +1,22 @@
+import asyncio
+import concurrent.futures
 import configparser
+import contextlib
+import functools
 import logging
 import os
+import queue
 import sqlite3
 import typing
+import urllib.parse
+
+import smartlist.serialization
 
 
 logger = logging.getLogger(__name__)
 
 
-EXPECTED_DB_VERSION = 2
+EXPECTED_DB_VERSION = 10
 DB_SCHEMA_SCRIPTS = {
     1: """
         CREATE TABLE users(
@@ -25,8 +33,76 @@ DB_SCHEMA_SCRIPTS = {
             UNIQUE(user_id, artist_id)
         )
     """,
+    3: """
+        CREATE TABLE library_items(
+            user_id NOT NULL,
+            item_type NOT NULL,
+            uri NOT NULL,
+            added_at NOT NULL,
+            item NOT NULL,
+            UNIQUE(user_id, item_type, uri)
+        );
+        CREATE TABLE library_state(
+            user_id NOT NULL,
+            item_type NOT NULL,
+            last_full_sync,
+            UNIQUE(user_id, item_type)
+        );
+    """,
+    4: """
+        ALTER TABLE artists ADD COLUMN fingerprint;
+        ALTER TABLE artists ADD COLUMN snapshot_id;
+    """,
+    5: """
+        CREATE TABLE sync_jobs(
+            job_id INTEGER PRIMARY KEY,
+            user_id NOT NULL,
+            status NOT NULL,
+            created NOT NULL,
+            started,
+            finished
+        );
+    """,
+    6: """
+        CREATE TABLE sessions(
+            session_id UNIQUE,
+            data NOT NULL,
+            expires NOT NULL
+        );
+        CREATE INDEX sessions_expires ON sessions(expires);
+    """,
+    7: """
+        CREATE TABLE artist_catalog(
+            artist_id UNIQUE,
+            data NOT NULL,
+            fetched NOT NULL
+        );
+    """,
+    8: """
+        ALTER TABLE artists ADD COLUMN dirty NOT NULL DEFAULT 1;
+    """,
+    9: """
+        CREATE TABLE album_catalog(
+            album_id UNIQUE,
+            data NOT NULL,
+            fetched NOT NULL
+        );
+    """,
+    10: """
+        CREATE TABLE library_staging(
+            user_id NOT NULL,
+            item_type NOT NULL,
+            uri NOT NULL,
+            added_at NOT NULL,
+            item NOT NULL,
+            UNIQUE(user_id, item_type, uri)
+        );
+    """,
 }
 
+LOOKUP_BATCH_SIZE = 500
+LIBRARY_PAGE_SIZE = 500
+
 
 def apply_db_scripts(conn: sqlite3.Connection):
     cur = conn.cursor()
@@ -48,23 +124,65 @@ def apply_db_scripts(conn: sqlite3.Connection):
     cur.execute("PRAGMA user_version = {}".format(EXPECTED_DB_VERSION))
 
 
+def configure_connection(conn: sqlite3.Connection, config: configparser.ConfigParser):
+    conn.execute("PRAGMA mmap_size = {}".format(
+        config.getint("db", "mmap_size", fallback=268435456)))
+    conn.execute("PRAGMA cache_size = -{}".format(
+        config.getint("db", "cache_size_kb", fallback=16384)))
+
+
 def init_db(root_path: str, config: configparser.ConfigParser):
     db_path = os.path.realpath(os.path.join(root_path, config.get("db", "path")))
     logger.info("Connecting to db {}".format(db_path))
 
-    conn = sqlite3.connect(db_path)
+    conn = sqlite3.connect(db_path, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode = WAL")
+    conn.execute("PRAGMA synchronous = NORMAL")
+    configure_connection(conn, config)
     apply_db_scripts(conn)
 
-    return SmartListDB(conn)
+    read_conns = []
+    for _ in range(config.getint("db", "read_connections", fallback=4)):
+        read_conn = sqlite3.connect(
+            "file:{}?mode=ro".format(urllib.parse.quote(db_path)),
+            uri=True, check_same_thread=False)
+        configure_connection(read_conn, config)
+        read_conns.append(read_conn)
+
+    return SmartListDB(conn, read_conns)
 
 
 class SmartListDB(object):
 
-    def __init__(self, conn: sqlite3.Connection):
+    def __init__(self,
+                 conn: sqlite3.Connection,
+                 read_conns: typing.Optional[typing.List[sqlite3.Connection]] = None):
         self._conn = conn
+        self._all_read_conns = list(read_conns or [])
+        self._read_conns: "queue.Queue[sqlite3.Connection]" = queue.Queue()
+        for read_conn in self._all_read_conns:
+            self._read_conns.put(read_conn)
+
+    @property
+    def read_pool_size(self) -> int:
+        return len(self._all_read_conns)
+
+    @contextlib.contextmanager
+    def _read_conn(self):
+        if self.read_pool_size == 0:
+            with self._conn as conn:
+                yield conn
+            return
+
+        read_conn = self._read_conns.get()
+        try:
+            with read_conn as conn:
+                yield conn
+        finally:
+            self._read_conns.put(read_conn)
 
     def get_refresh_token(self, user_id):
-        with self._conn as conn:
+        with self._read_conn() as conn:
             cur = conn.execute("SELECT refresh_token FROM users WHERE user_id = ?", (user_id,))
             return cur.fetchone()[0]
 
@@ -78,15 +196,19 @@ class SmartListDB(object):
             """, (user_id, refresh_token))
 
     def get_artists(self, user_id: str):
-        with self._conn as conn:
+        with self._read_conn() as conn:
             cur = conn.execute(
-                "SELECT artist_id,playlist_id,last_updated FROM artists WHERE user_id = ?",
+                ("SELECT artist_id,playlist_id,last_updated,fingerprint,snapshot_id,dirty "
+                 "FROM artists WHERE user_id = ?"),
                 (user_id,),
             )
             return [dict(
                 id=val[0],
                 playlist_id=val[1],
                 last_updated=val[2],
+                fingerprint=val[3],
+                snapshot_id=val[4],
+                dirty=bool(val[5]),
             ) for val in cur.fetchall()]
 
     def add_artists(self, user_id: str, artist_ids: typing.List[str]):
@@ -103,14 +225,429 @@ class SmartListDB(object):
                 [(user_id, artist_id) for artist_id in artist_ids],
             )
 
-    def update_artist_playlist(self,
-                               user_id: str,
-                               artist_id: str,
-                               playlist_id: str,
-                               last_updated: str):
+    def update_artist_playlists(self,
+                                user_id: str,
+                                updates: typing.List[typing.Tuple[str, str, str, str, str]]):
         with self._conn as conn:
+            conn.executemany(
+                ("UPDATE artists SET playlist_id = ?, last_updated = ?, fingerprint = ?, "
+                 "snapshot_id = ?, dirty = 0 WHERE user_id = ? AND artist_id = ?"),
+                [(playlist_id, last_updated, fingerprint, snapshot_id, user_id, artist_id)
+                 for artist_id, playlist_id, last_updated, fingerprint, snapshot_id in updates],
+            )
+
+    def mark_artists_dirty(self, user_id: str, artist_ids: typing.List[str]):
+        with self._conn as conn:
+            conn.executemany(
+                "UPDATE artists SET dirty = 1 WHERE user_id = ? AND artist_id = ?",
+                [(user_id, artist_id) for artist_id in artist_ids],
+            )
+
+    def get_library_keys(self, user_id: str, item_type: str) -> typing.List[typing.Tuple[str, str]]:
+        with self._read_conn() as conn:
+            cur = conn.execute(
+                "SELECT uri, added_at FROM library_items WHERE user_id = ? AND item_type = ?",
+                (user_id, item_type),
+            )
+            return [(val[0], val[1]) for val in cur.fetchall()]
+
+    def get_library_items(self,
+                          user_id: str,
+                          item_type: str,
+                          after_uri: str = "",
+                          limit: int = LIBRARY_PAGE_SIZE) -> typing.List[typing.Tuple[str, dict]]:
+        with self._read_conn() as conn:
+            cur = conn.execute(
+                ("SELECT uri, item FROM library_items WHERE user_id = ? AND item_type = ? "
+                 "AND uri > ? ORDER BY uri LIMIT ?"),
+                (user_id, item_type, after_uri, limit),
+            )
+            return [(val[0], smartlist.serialization.loads(val[1])) for val in cur.fetchall()]
+
+    def get_library_items_by_uri(self,
+                                 user_id: str,
+                                 item_type: str,
+                                 uris: typing.List[str]) -> typing.List[dict]:
+        items = []
+        with self._read_conn() as conn:
+            for batch_start in range(0, len(uris), LOOKUP_BATCH_SIZE):
+                batch = uris[batch_start:batch_start + LOOKUP_BATCH_SIZE]
+                cur = conn.execute(
+                    ("SELECT item FROM library_items WHERE user_id = ? AND item_type = ? "
+                     "AND uri IN ({})").format(",".join("?" * len(batch))),
+                    (user_id, item_type, *batch),
+                )
+                items.extend(smartlist.serialization.loads(val[0]) for val in cur.fetchall())
+
+        return items
+
+    def get_library_summary(self,
+                            user_id: str,
+                            item_type: str) -> typing.Tuple[int, typing.Optional[str]]:
+        with self._read_conn() as conn:
+            cur = conn.execute(
+                ("SELECT COUNT(*), MAX(added_at) FROM library_items "
+                 "WHERE user_id = ? AND item_type = ?"),
+                (user_id, item_type),
+            )
+            row = cur.fetchone()
+            return row[0], row[1]
+
+    def get_library_last_full_sync(self, user_id: str, item_type: str):
+        with self._read_conn() as conn:
+            cur = conn.execute(
+                "SELECT last_full_sync FROM library_state WHERE user_id = ? AND item_type = ?",
+                (user_id, item_type),
+            )
+            row = cur.fetchone()
+            return row[0] if row is not None else None
+
+    def _save_library_rows(self,
+                           table: str,
+                           user_id: str,
+                           item_type: str,
+                           items: typing.List[typing.Tuple[str, str, dict]]):
+        with self._conn as conn:
+            conn.executemany("""
+                INSERT INTO {}(user_id, item_type, uri, added_at, item)
+                VALUES(?, ?, ?, ?, ?)
+                ON CONFLICT(user_id, item_type, uri) DO
+                    UPDATE SET added_at = excluded.added_at, item = excluded.item
+            """.format(table),
+                [(user_id, item_type, uri, added_at, smartlist.serialization.dumps(item))
+                 for uri, added_at, item in items])
+
+    def save_library_items(self,
+                           user_id: str,
+                           item_type: str,
+                           items: typing.List[typing.Tuple[str, str, dict]]):
+        self._save_library_rows("library_items", user_id, item_type, items)
+
+    def clear_library_staging(self, user_id: str, item_type: str):
+        with self._conn as conn:
+            conn.execute(
+                "DELETE FROM library_staging WHERE user_id = ? AND item_type = ?",
+                (user_id, item_type),
+            )
+
+    def stage_library_items(self,
+                            user_id: str,
+                            item_type: str,
+                            items: typing.List[typing.Tuple[str, str, dict]]):
+        self._save_library_rows("library_staging", user_id, item_type, items)
+
+    def commit_library_staging(self, user_id: str, item_type: str, full_sync_time: str):
+        with self._conn as conn:
+            conn.execute(
+                "DELETE FROM library_items WHERE user_id = ? AND item_type = ?",
+                (user_id, item_type),
+            )
+            conn.execute("""
+                INSERT INTO library_items(user_id, item_type, uri, added_at, item)
+                SELECT user_id, item_type, uri, added_at, item FROM library_staging
+                WHERE user_id = ? AND item_type = ?
+            """, (user_id, item_type))
             conn.execute(
-                ("UPDATE artists SET playlist_id = ?, last_updated = ? "
-                 "WHERE user_id = ? AND artist_id = ?"),
-                (playlist_id, last_updated, user_id, artist_id),
+                "DELETE FROM library_staging WHERE user_id = ? AND item_type = ?",
+                (user_id, item_type),
+            )
+            conn.execute("""
+                INSERT INTO library_state(user_id, item_type, last_full_sync)
+                VALUES(?, ?, ?)
+                ON CONFLICT(user_id, item_type) DO
+                    UPDATE SET last_full_sync = excluded.last_full_sync
+            """, (user_id, item_type, full_sync_time))
+
+    def enqueue_sync_job(self, user_id: str, created: str) -> int:
+        with self._conn as conn:
+            cur = conn.execute(
+                ("SELECT job_id FROM sync_jobs "
+                 "WHERE user_id = ? AND status IN ('queued', 'running')"),
+                (user_id,),
+            )
+            row = cur.fetchone()
+            if row is not None:
+                return row[0]
+
+            cur = conn.execute(
+                "INSERT INTO sync_jobs(user_id, status, created) VALUES(?, 'queued', ?)",
+                (user_id, created),
             )
+            return cur.lastrowid
+
+    def claim_next_sync_job(self, started: str) -> typing.Optional[typing.Tuple[int, str]]:
+        with self._conn as conn:
+            cur = conn.execute(
+                "SELECT job_id, user_id FROM sync_jobs WHERE status = 'queued' "
+                "ORDER BY job_id LIMIT 1",
+            )
+            row = cur.fetchone()
+            if row is None:
+                return None
+
+            conn.execute(
+                "UPDATE sync_jobs SET status = 'running', started = ? WHERE job_id = ?",
+                (started, row[0]),
+            )
+            return row[0], row[1]
+
+    def finish_sync_job(self, job_id: int, status: str, finished: str):
+        with self._conn as conn:
+            conn.execute(
+                "UPDATE sync_jobs SET status = ?, finished = ? WHERE job_id = ?",
+                (status, finished, job_id),
+            )
+
+    def get_sync_job_status(self, job_id: int) -> typing.Optional[str]:
+        with self._read_conn() as conn:
+            cur = conn.execute("SELECT status FROM sync_jobs WHERE job_id = ?", (job_id,))
+            row = cur.fetchone()
+            return row[0] if row is not None else None
+
+    def requeue_running_sync_jobs(self):
+        with self._conn as conn:
+            conn.execute(
+                "UPDATE sync_jobs SET status = 'queued', started = NULL WHERE status = 'running'")
+
+    def get_users_due_for_sync(self, cutoff: str) -> typing.List[str]:
+        with self._read_conn() as conn:
+            cur = conn.execute("""
+                SELECT user_id FROM users
+                WHERE EXISTS (SELECT 1 FROM artists WHERE artists.user_id = users.user_id)
+                AND NOT EXISTS (
+                    SELECT 1 FROM sync_jobs
+                    WHERE sync_jobs.user_id = users.user_id
+                    AND (status IN ('queued', 'running') OR created > ?)
+                )
+            """, (cutoff,))
+            return [val[0] for val in cur.fetchall()]
+
+    def get_session_data(self,
+                         session_id: str,
+                         now: str) -> typing.Optional[typing.Tuple[str, str]]:
+        with self._read_conn() as conn:
+            cur = conn.execute(
+                "SELECT data, expires FROM sessions WHERE session_id = ? AND expires > ?",
+                (session_id, now),
+            )
+            row = cur.fetchone()
+            return (row[0], row[1]) if row is not None else None
+
+    def save_session_data(self, session_id: str, data: str, expires: str):
+        with self._conn as conn:
+            conn.execute("""
+                INSERT INTO sessions(session_id, data, expires)
+                VALUES(?, ?, ?)
+                ON CONFLICT(session_id) DO
+                    UPDATE SET data = excluded.data, expires = excluded.expires
+            """, (session_id, data, expires))
+
+    def delete_session(self, session_id: str):
+        with self._conn as conn:
+            conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+
+    def delete_expired_sessions(self, now: str):
+        with self._conn as conn:
+            conn.execute("DELETE FROM sessions WHERE expires <= ?", (now,))
+
+    def _get_catalog_items(self,
+                           table: str,
+                           id_column: str,
+                           ids: typing.List[str],
+                           fetched_after: str) -> typing.List[typing.Tuple[dict, str]]:
+        items = []
+        with self._read_conn() as conn:
+            for batch_start in range(0, len(ids), LOOKUP_BATCH_SIZE):
+                batch = ids[batch_start:batch_start + LOOKUP_BATCH_SIZE]
+                cur = conn.execute(
+                    "SELECT data, fetched FROM {} WHERE {} IN ({}) AND fetched > ?".format(
+                        table, id_column, ",".join("?" * len(batch))),
+                    (*batch, fetched_after),
+                )
+                items.extend((smartlist.serialization.loads(val[0]), val[1])
+                             for val in cur.fetchall())
+
+        return items
+
+    def _save_catalog_items(self,
+                            table: str,
+                            id_column: str,
+                            items: typing.List[typing.Tuple[str, dict]],
+                            fetched: str):
+        with self._conn as conn:
+            conn.executemany("""
+                INSERT INTO {table}({id_column}, data, fetched)
+                VALUES(?, ?, ?)
+                ON CONFLICT({id_column}) DO
+                    UPDATE SET data = excluded.data, fetched = excluded.fetched
+            """.format(table=table, id_column=id_column),
+                [(item_id, smartlist.serialization.dumps(item), fetched)
+                 for item_id, item in items])
+
+    def get_catalog_artists(self,
+                            artist_ids: typing.List[str],
+                            fetched_after: str) -> typing.List[typing.Tuple[dict, str]]:
+        return self._get_catalog_items("artist_catalog", "artist_id", artist_ids, fetched_after)
+
+    def save_catalog_artists(self, artists: typing.List[typing.Tuple[str, dict]], fetched: str):
+        self._save_catalog_items("artist_catalog", "artist_id", artists, fetched)
+
+    def get_catalog_albums(self,
+                           album_ids: typing.List[str],
+                           fetched_after: str) -> typing.List[typing.Tuple[dict, str]]:
+        return self._get_catalog_items("album_catalog", "album_id", album_ids, fetched_after)
+
+    def save_catalog_albums(self, albums: typing.List[typing.Tuple[str, dict]], fetched: str):
+        self._save_catalog_items("album_catalog", "album_id", albums, fetched)
+
+    def close(self):
+        for read_conn in self._all_read_conns:
+            read_conn.close()
+        self._conn.close()
+
+
+class AsyncSmartListDB(object):
+
+    def __init__(self, db: SmartListDB):
+        self._db = db
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix="smartlist-db")
+        self._read_executor = self._executor
+        if db.read_pool_size > 0:
+            self._read_executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=db.read_pool_size, thread_name_prefix="smartlist-db-read")
+
+    async def _run(self, func, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    async def _read(self, func, *args, **kwargs):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self._read_executor, functools.partial(func, *args, **kwargs))
+
+    async def close(self):
+        if self._read_executor is not self._executor:
+            self._read_executor.shutdown()
+        await self._run(self._db.close)
+        self._executor.shutdown()
+
+    async def get_refresh_token(self, user_id):
+        return await self._read(self._db.get_refresh_token, user_id)
+
+    async def upsert_user(self, user_id, refresh_token):
+        await self._run(self._db.upsert_user, user_id, refresh_token)
+
+    async def get_artists(self, user_id: str):
+        return await self._read(self._db.get_artists, user_id)
+
+    async def add_artists(self, user_id: str, artist_ids: typing.List[str]):
+        await self._run(self._db.add_artists, user_id, artist_ids)
+
+    async def remove_artists(self, user_id: str, artist_ids: typing.List[str]):
+        await self._run(self._db.remove_artists, user_id, artist_ids)
+
+    async def update_artist_playlists(self,
+                                      user_id: str,
+                                      updates: typing.List[typing.Tuple[str, str, str, str, str]]):
+        await self._run(self._db.update_artist_playlists, user_id, updates)
+
+    async def mark_artists_dirty(self, user_id: str, artist_ids: typing.List[str]):
+        await self._run(self._db.mark_artists_dirty, user_id, artist_ids)
+
+    async def get_library_keys(self,
+                               user_id: str,
+                               item_type: str) -> typing.List[typing.Tuple[str, str]]:
+        return await self._read(self._db.get_library_keys, user_id, item_type)
+
+    async def get_library_items(self,
+                                user_id: str,
+                                item_type: str,
+                                after_uri: str = "",
+                                limit: int = LIBRARY_PAGE_SIZE) \
+            -> typing.List[typing.Tuple[str, dict]]:
+        return await self._read(self._db.get_library_items, user_id, item_type, after_uri, limit)
+
+    async def get_library_items_by_uri(self,
+                                       user_id: str,
+                                       item_type: str,
+                                       uris: typing.List[str]) -> typing.List[dict]:
+        return await self._read(self._db.get_library_items_by_uri, user_id, item_type, uris)
+
+    async def get_library_summary(self,
+                                  user_id: str,
+                                  item_type: str) -> typing.Tuple[int, typing.Optional[str]]:
+        return await self._read(self._db.get_library_summary, user_id, item_type)
+
+    async def get_library_last_full_sync(self, user_id: str, item_type: str):
+        return await self._read(self._db.get_library_last_full_sync, user_id, item_type)
+
+    async def save_library_items(self,
+                                 user_id: str,
+                                 item_type: str,
+                                 items: typing.List[typing.Tuple[str, str, dict]]):
+        await self._run(self._db.save_library_items, user_id, item_type, items)
+
+    async def clear_library_staging(self, user_id: str, item_type: str):
+        await self._run(self._db.clear_library_staging, user_id, item_type)
+
+    async def stage_library_items(self,
+                                  user_id: str,
+                                  item_type: str,
+                                  items: typing.List[typing.Tuple[str, str, dict]]):
+        await self._run(self._db.stage_library_items, user_id, item_type, items)
+
+    async def commit_library_staging(self, user_id: str, item_type: str, full_sync_time: str):
+        await self._run(self._db.commit_library_staging, user_id, item_type, full_sync_time)
+
+    async def enqueue_sync_job(self, user_id: str, created: str) -> int:
+        return await self._run(self._db.enqueue_sync_job, user_id, created)
+
+    async def claim_next_sync_job(self, started: str) -> typing.Optional[typing.Tuple[int, str]]:
+        return await self._run(self._db.claim_next_sync_job, started)
+
+    async def finish_sync_job(self, job_id: int, status: str, finished: str):
+        await self._run(self._db.finish_sync_job, job_id, status, finished)
+
+    async def get_sync_job_status(self, job_id: int) -> typing.Optional[str]:
+        return await self._read(self._db.get_sync_job_status, job_id)
+
+    async def requeue_running_sync_jobs(self):
+        await self._run(self._db.requeue_running_sync_jobs)
+
+    async def get_users_due_for_sync(self, cutoff: str) -> typing.List[str]:
+        return await self._read(self._db.get_users_due_for_sync, cutoff)
+
+    async def get_session_data(self,
+                               session_id: str,
+                               now: str) -> typing.Optional[typing.Tuple[str, str]]:
+        return await self._read(self._db.get_session_data, session_id, now)
+
+    async def save_session_data(self, session_id: str, data: str, expires: str):
+        await self._run(self._db.save_session_data, session_id, data, expires)
+
+    async def delete_session(self, session_id: str):
+        await self._run(self._db.delete_session, session_id)
+
+    async def delete_expired_sessions(self, now: str):
+        await self._run(self._db.delete_expired_sessions, now)
+
+    async def get_catalog_artists(self,
+                                  artist_ids: typing.List[str],
+                                  fetched_after: str) -> typing.List[typing.Tuple[dict, str]]:
+        return await self._read(self._db.get_catalog_artists, artist_ids, fetched_after)
+
+    async def save_catalog_artists(self,
+                                   artists: typing.List[typing.Tuple[str, dict]],
+                                   fetched: str):
+        await self._run(self._db.save_catalog_artists, artists, fetched)
+
+    async def get_catalog_albums(self,
+                                 album_ids: typing.List[str],
+                                 fetched_after: str) -> typing.List[typing.Tuple[dict, str]]:
+        return await self._read(self._db.get_catalog_albums, album_ids, fetched_after)
+
+    async def save_catalog_albums(self,
+                                  albums: typing.List[typing.Tuple[str, dict]],
+                                  fetched: str):
+        await self._run(self._db.save_catalog_albums, albums, fetched)
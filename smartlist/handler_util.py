@@ -1,5 +1,7 @@
 import aiohttp.web
 
+import smartlist.serialization
+
 
 def require_auth(*, redirect_on_fail=True):
     def decorator(func):
@@ -27,6 +29,6 @@ def require_csrf(func):
 
 async def get_json_payload(request: aiohttp.web.Request):
     try:
-        return await request.json()
+        return await request.json(loads=smartlist.serialization.loads)
     except Exception:
         raise aiohttp.web.HTTPBadRequest(text="Could not parse request")
@@ -1,9 +1,12 @@
+import functools
+
 import aiohttp.web
 import aiohttp_jinja2
 
 import smartlist.actions
 import smartlist.client
 import smartlist.handler_util
+import smartlist.session
 
 routes = aiohttp.web.RouteTableDef()
 
@@ -55,10 +58,8 @@ async def post_artists(request: aiohttp.web.Request):
 async def get_artists_sync(request: aiohttp.web.Request):
     return await smartlist.actions.get_artists_sync(
         request,
-        request.app["config"],
-        request.app["db"],
+        request.app["scheduler"],
         request["session"],
-        request["client"],
     )
 
 
@@ -77,6 +78,8 @@ async def login_callback(request: aiohttp.web.Request):
         request.app["config"],
         request.app["db"],
         request["session"],
+        functools.partial(smartlist.session.new_session, request),
+        request.app["client_resources"].client_session,
         str(request.app.router["home"].url_for()),
         str(request.app.router["artists"].url_for()),
         str(request.app.router["login_callback"].url_for()),
@@ -1,4 +1,4 @@
-import base64
+import asyncio
 import configparser
 import logging
 import os
@@ -8,13 +8,21 @@ import aiohttp
 import aiohttp.web
 import aiohttp_jinja2
 import aiohttp_session
-import aiohttp_session.cookie_storage
 import jinja2
 
+import smartlist.catalog
+import smartlist.client
 import smartlist.db
 import smartlist.handlers
 import smartlist.middleware
+import smartlist.scheduler
 import smartlist.session
+import smartlist.static
+
+try:
+    import uvloop
+except ImportError:  # pragma: no cover
+    uvloop = None
 
 
 logger = logging.getLogger(__name__)
@@ -35,6 +43,47 @@ def init_logging():
     root_logger.addHandler(ch)
 
 
+def install_event_loop_policy(config: configparser.ConfigParser):
+    if not config.getboolean("web", "use_uvloop", fallback=True):
+        return
+
+    if uvloop is None:
+        logger.info("uvloop is not installed, using the default event loop")
+        return
+
+    logger.info("Using uvloop event loop")
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+
+async def db_context(app: aiohttp.web.Application):
+    yield
+    await app["db"].close()
+
+
+async def session_cleanup_context(app: aiohttp.web.Application):
+    interval_minutes = app["config"].getint("session", "cleanup_interval_minutes", fallback=60)
+    task = asyncio.ensure_future(
+        smartlist.session.purge_expired_sessions(app["db"], interval_minutes * 60))
+    yield
+    task.cancel()
+    await asyncio.gather(task, return_exceptions=True)
+
+
+async def client_session_context(app: aiohttp.web.Application):
+    resources = app["client_resources"]
+    resources.client_session = smartlist.client.create_client_session(app["config"])
+    yield
+    await resources.client_session.close()
+
+
+async def scheduler_context(app: aiohttp.web.Application):
+    app["scheduler"] = smartlist.scheduler.SyncScheduler(
+        app["config"], app["db"], app["client_resources"])
+    await app["scheduler"].start()
+    yield
+    await app["scheduler"].stop()
+
+
 async def load_session_context_processor(request):
     return {
         "session": request["session"],
@@ -56,29 +105,48 @@ def main():
     else:
         logger.info("Loaded config from {}".format(",".join(files_read)))
 
+    install_event_loop_policy(config)
+
     template_path = os.path.realpath(os.path.join(root_path, "templates"))
     static_path = os.path.realpath(os.path.join(root_path, "static"))
 
     app = aiohttp.web.Application()
     app["config"] = config
-    app["db"] = smartlist.db.init_db(root_path, config)
-    app["static_root_url"] = "/assets"
-    app.router.add_static(app["static_root_url"], static_path)
+    app["db"] = smartlist.db.AsyncSmartListDB(smartlist.db.init_db(root_path, config))
+    app["client_resources"] = smartlist.client.ClientResources(
+        rate_limiter=smartlist.client.create_rate_limiter(config),
+        response_cache=smartlist.client.create_response_cache(config),
+        artist_catalog=smartlist.catalog.create_artist_catalog(app["db"], config),
+        album_catalog=smartlist.catalog.create_album_catalog(app["db"], config),
+    )
+    app.cleanup_ctx.extend([
+        db_context,
+        session_cleanup_context,
+        client_session_context,
+        scheduler_context,
+    ])
+    app["static_assets"] = smartlist.static.StaticAssets("/assets", static_path)
     app.router.add_routes(smartlist.handlers.routes)
 
-    secret_key = base64.urlsafe_b64decode(config.get("session", "secret_key"))
-    aiohttp_session.setup(app, aiohttp_session.cookie_storage.EncryptedCookieStorage(secret_key))
+    session_storage = smartlist.session.SessionStorage(
+        app["db"],
+        cache_size=config.getint("session", "cache_size", fallback=1024),
+        max_age=config.getint("session", "max_age_days", fallback=30) * 24 * 60 * 60,
+    )
 
     app.middlewares.extend([
+        smartlist.middleware.serve_static,
+        aiohttp_session.session_middleware(session_storage),
         smartlist.middleware.load_session,
         smartlist.middleware.inject_client,
         smartlist.middleware.generate_csrf_token,
     ])
 
-    aiohttp_jinja2.setup(
+    env = aiohttp_jinja2.setup(
         app,
         loader=jinja2.FileSystemLoader(template_path),
         context_processors=[load_session_context_processor])
+    env.globals["static"] = app["static_assets"].url_for
 
     host = config.get("web", "host", fallback="127.0.0.1")
     port = config.getint("web", "port", fallback=7578)
@@ -7,6 +7,15 @@ import smartlist.client
 import smartlist.session
 
 
+@aiohttp.web.middleware
+async def serve_static(request: aiohttp.web.Request, handler: typing.Callable):
+    static_assets = request.app["static_assets"]
+    if static_assets.matches(request.path):
+        return static_assets.handle(request)
+
+    return await handler(request)
+
+
 @aiohttp.web.middleware
 async def load_session(request: aiohttp.web.Request, handler: typing.Callable):
     request["session"] = await smartlist.session.get_session(request)
@@ -15,8 +24,9 @@ async def load_session(request: aiohttp.web.Request, handler: typing.Callable):
 
 @aiohttp.web.middleware
 async def inject_client(request: aiohttp.web.Request, handler: typing.Callable):
-    session = await smartlist.session.get_session(request)
-    client = smartlist.client.SpotifyClient(request.app["config"], request.app["db"], session)
+    client = smartlist.client.SpotifyClient(
+        request.app["config"], request.app["db"], request["session"],
+        request.app["client_resources"])
     request["client"] = client
 
     try:
@@ -27,8 +37,8 @@ async def inject_client(request: aiohttp.web.Request, handler: typing.Callable):
 
 @aiohttp.web.middleware
 async def generate_csrf_token(request: aiohttp.web.Request, handler: typing.Callable):
-    session = await smartlist.session.get_session(request)
-    if session.csrf_token is None:
+    session = request["session"]
+    if session.user_info is not None and session.csrf_token is None:
         session.csrf_token = secrets.token_urlsafe()
 
     return await handler(request)
@@ -0,0 +1,174 @@
+import asyncio
+import configparser
+import datetime
+import logging
+import typing
+
+import aiohttp.web
+
+import smartlist.client
+import smartlist.db
+import smartlist.serialization
+import smartlist.session
+import smartlist.sync
+
+
+logger = logging.getLogger(__name__)
+
+
+class SyncProgress(object):
+
+    def __init__(self, scheduler: "SyncScheduler", user_id: str):
+        self._scheduler = scheduler
+        self._user_id = user_id
+        self.messages: typing.List[dict] = []
+
+    async def send_json(self, data: dict):
+        self.messages.append(data)
+        text = smartlist.serialization.dumps(data)
+        for ws in list(self._scheduler.get_subscribers(self._user_id)):
+            try:
+                await ws.send_str(text)
+            except Exception:
+                logger.info("Dropping closed subscriber for {}".format(self._user_id))
+                self._scheduler.unsubscribe(self._user_id, ws)
+
+
+class SyncScheduler(object):
+
+    def __init__(self,
+                 config: configparser.ConfigParser,
+                 db: smartlist.db.AsyncSmartListDB,
+                 resources: smartlist.client.ClientResources):
+        self._config = config
+        self._db = db
+        self._resources = resources
+        self._subscribers: typing.Dict[str, typing.Set[aiohttp.web.WebSocketResponse]] = dict()
+        self._progress: typing.Dict[str, SyncProgress] = dict()
+        self._job_events: typing.Dict[int, asyncio.Event] = dict()
+        self._running_jobs: typing.Set[asyncio.Task] = set()
+        self._wakeup: typing.Optional[asyncio.Event] = None
+        self._task: typing.Optional[asyncio.Task] = None
+
+    async def start(self):
+        logger.info("Starting sync scheduler")
+        await self._db.requeue_running_sync_jobs()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        logger.info("Stopping sync scheduler")
+        tasks = list(self._running_jobs)
+        if self._task is not None:
+            tasks.append(self._task)
+
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def get_subscribers(self, user_id: str) -> typing.Set[aiohttp.web.WebSocketResponse]:
+        return self._subscribers.get(user_id, set())
+
+    async def subscribe(self, user_id: str, ws: aiohttp.web.WebSocketResponse):
+        self._subscribers.setdefault(user_id, set()).add(ws)
+        if user_id in self._progress:
+            for message in list(self._progress[user_id].messages):
+                await ws.send_json(message, dumps=smartlist.serialization.dumps)
+
+    def unsubscribe(self, user_id: str, ws: aiohttp.web.WebSocketResponse):
+        subscribers = self._subscribers.get(user_id, set())
+        subscribers.discard(ws)
+        if len(subscribers) == 0:
+            self._subscribers.pop(user_id, None)
+
+    async def request_sync(self, user_id: str) -> int:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        job_id = await self._db.enqueue_sync_job(user_id, now.isoformat())
+        if self._wakeup is not None:
+            self._wakeup.set()
+        return job_id
+
+    async def wait_for_job(self, job_id: int):
+        event = self._job_events.setdefault(job_id, asyncio.Event())
+        if await self._db.get_sync_job_status(job_id) not in ("queued", "running"):
+            self._job_events.pop(job_id, None)
+            return
+
+        await event.wait()
+
+    async def _enqueue_periodic_jobs(self):
+        interval_hours = self._config.getint("scheduler", "sync_interval_hours", fallback=24)
+        if interval_hours <= 0:
+            return
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        cutoff = now - datetime.timedelta(hours=interval_hours)
+        for user_id in await self._db.get_users_due_for_sync(cutoff.isoformat()):
+            logger.info("Scheduling periodic sync for {}".format(user_id))
+            await self._db.enqueue_sync_job(user_id, now.isoformat())
+
+    async def _start_queued_jobs(self):
+        max_jobs = self._config.getint("scheduler", "max_concurrent_jobs", fallback=1)
+        while len(self._running_jobs) < max_jobs:
+            now = datetime.datetime.now(datetime.timezone.utc)
+            job = await self._db.claim_next_sync_job(now.isoformat())
+            if job is None:
+                return
+
+            task = asyncio.ensure_future(self._run_job(*job))
+            self._running_jobs.add(task)
+            task.add_done_callback(self._running_jobs.discard)
+
+    async def _run(self):
+        poll_seconds = self._config.getint("scheduler", "poll_seconds", fallback=60)
+        while True:
+            self._wakeup.clear()
+            try:
+                await self._enqueue_periodic_jobs()
+                await self._start_queued_jobs()
+            except Exception:
+                logger.exception("Failed scheduling sync jobs")
+
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=poll_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _run_job(self, job_id: int, user_id: str):
+        logger.info("Running sync job {} for {}".format(job_id, user_id))
+        self._progress[user_id] = SyncProgress(self, user_id)
+
+        session = smartlist.session.Session({})
+        session.user_info = dict(
+            user_id=user_id,
+            access_token=None,
+            access_token_expiry=datetime.datetime.min.replace(
+                tzinfo=datetime.timezone.utc).isoformat(),
+        )
+        spotify_client = smartlist.client.SpotifyClient(
+            self._config, self._db, session, self._resources)
+
+        status = None
+        try:
+            await smartlist.sync.sync_artists(
+                self._progress[user_id], self._config, self._db, user_id, spotify_client)
+            status = "complete"
+        except asyncio.CancelledError:
+            logger.info("Sync job {} for {} interrupted, it will be resumed".format(
+                job_id, user_id))
+            raise
+        except Exception:
+            logger.exception("Sync job {} for {} failed".format(job_id, user_id))
+            status = "failed"
+        finally:
+            await spotify_client.close()
+            if status is not None:
+                now = datetime.datetime.now(datetime.timezone.utc)
+                await self._db.finish_sync_job(job_id, status, now.isoformat())
+            del self._progress[user_id]
+            if job_id in self._job_events:
+                self._job_events.pop(job_id).set()
+            if self._wakeup is not None:
+                self._wakeup.set()
+
+        logger.info("Finished sync job {} for {} with status {}".format(job_id, user_id, status))
@@ -0,0 +1,21 @@
+import json
+import typing
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def dumps(obj: typing.Any) -> str:
+    if orjson is not None:
+        return orjson.dumps(obj).decode()
+
+    return json.dumps(obj)
+
+
+def loads(data: typing.Union[str, bytes]) -> typing.Any:
+    if orjson is not None:
+        return orjson.loads(data)
+
+    return json.loads(data)
@@ -1,6 +1,18 @@
+import asyncio
+import collections
+import datetime
+import logging
+import secrets
+import typing
+
 import aiohttp.web
 import aiohttp_session
 
+import smartlist.db
+
+
+logger = logging.getLogger(__name__)
+
 
 class Session(object):
 
@@ -102,3 +114,98 @@ class Session(object):
 
 async def get_session(request: aiohttp.web.Request):
     return Session(await aiohttp_session.get_session(request))
+
+
+async def new_session(request: aiohttp.web.Request):
+    old_session = await aiohttp_session.get_session(request)
+    if old_session.identity is not None:
+        await request[aiohttp_session.STORAGE_KEY].delete_session(old_session.identity)
+
+    session = Session(await aiohttp_session.new_session(request))
+    request["session"] = session
+    return session
+
+
+async def purge_expired_sessions(db: smartlist.db.AsyncSmartListDB, interval_seconds: int):
+    while True:
+        try:
+            now = datetime.datetime.now(datetime.timezone.utc)
+            await db.delete_expired_sessions(now.isoformat())
+        except Exception:
+            logger.exception("Failed purging expired sessions")
+
+        await asyncio.sleep(interval_seconds)
+
+
+class SessionStorage(aiohttp_session.AbstractStorage):
+
+    def __init__(self, db: smartlist.db.AsyncSmartListDB, *, cache_size: int, max_age: int,
+                 **kwargs):
+        super().__init__(max_age=max_age, **kwargs)
+        self._db = db
+        self._cache_size = cache_size
+        self._cache: "collections.OrderedDict[str, typing.Tuple[str, datetime.datetime]]" = \
+            collections.OrderedDict()
+
+    def _cache_put(self, session_id: str, data: str, expires: datetime.datetime):
+        self._cache[session_id] = (data, expires)
+        self._cache.move_to_end(session_id)
+        while len(self._cache) > self._cache_size:
+            self._cache.popitem(last=False)
+
+    async def _load_data(self, session_id: str) -> typing.Optional[str]:
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if session_id in self._cache:
+            data, expires = self._cache[session_id]
+            if expires <= now:
+                del self._cache[session_id]
+                return None
+
+            self._cache.move_to_end(session_id)
+            return data
+
+        row = await self._db.get_session_data(session_id, now.isoformat())
+        if row is None:
+            return None
+
+        data, expires = row
+        self._cache_put(session_id, data, datetime.datetime.fromisoformat(expires))
+        return data
+
+    async def delete_session(self, session_id: str):
+        self._cache.pop(session_id, None)
+        await self._db.delete_session(session_id)
+
+    async def load_session(self, request: aiohttp.web.Request):
+        session_id = self.load_cookie(request)
+        data = None
+        if session_id is not None:
+            data = await self._load_data(session_id)
+
+        if data is None:
+            return aiohttp_session.Session(None, data=None, new=True, max_age=self.max_age)
+
+        return aiohttp_session.Session(
+            session_id, data=self._decoder(data), new=False, max_age=self.max_age)
+
+    async def save_session(self,
+                           request: aiohttp.web.Request,
+                           response: aiohttp.web.StreamResponse,
+                           session: aiohttp_session.Session):
+        session_id = session.identity
+        if session.empty:
+            if session_id is not None:
+                await self.delete_session(session_id)
+            self.save_cookie(response, "", max_age=session.max_age)
+            return
+
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if session_id is None:
+            session_id = secrets.token_urlsafe(32)
+            session.set_new_identity(session_id)
+
+        data = self._encoder(self._get_session_data(session))
+        expires = now + datetime.timedelta(seconds=self.max_age)
+        self._cache_put(session_id, data, expires)
+        await self._db.save_session_data(session_id, data, expires.isoformat())
+        self.save_cookie(response, session_id, max_age=session.max_age)
@@ -0,0 +1,132 @@
+import gzip
+import hashlib
+import logging
+import mimetypes
+import os
+import typing
+
+import aiohttp.web
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+
+HASH_LENGTH = 12
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+logger = logging.getLogger(__name__)
+
+
+class StaticFile(object):
+
+    __slots__ = ("content_type", "digest", "bodies")
+    content_type: str
+    digest: str
+    bodies: typing.Dict[typing.Optional[str], bytes]
+
+    def __init__(self, content_type, digest, bodies):
+        self.content_type = content_type
+        self.digest = digest
+        self.bodies = bodies
+
+    def select_encoding(self, accept_encoding: str) -> typing.Optional[str]:
+        accepted = set()
+        for part in accept_encoding.split(","):
+            coding, *params = [val.strip() for val in part.split(";")]
+            if "q=0" not in params:
+                accepted.add(coding.lower())
+
+        for encoding in ("br", "gzip"):
+            if encoding in accepted and encoding in self.bodies:
+                return encoding
+
+        return None
+
+    def get_etag(self, encoding: typing.Optional[str]) -> str:
+        if encoding is None:
+            return "\"{}\"".format(self.digest)
+
+        return "\"{}-{}\"".format(self.digest, encoding)
+
+
+def compress_body(body: bytes) -> typing.Dict[typing.Optional[str], bytes]:
+    bodies = {None: body}
+    compressors = [("gzip", lambda data: gzip.compress(data, compresslevel=9))]
+    if brotli is not None:
+        compressors.insert(0, ("br", brotli.compress))
+
+    for encoding, compress in compressors:
+        compressed = compress(body)
+        if len(compressed) < len(body):
+            bodies[encoding] = compressed
+
+    return bodies
+
+
+class StaticAssets(object):
+
+    def __init__(self, root_url: str, static_path: str):
+        self._root_url = root_url.rstrip("/")
+        self._hashed_names: typing.Dict[str, str] = dict()
+        self._files: typing.Dict[str, typing.Tuple[StaticFile, bool]] = dict()
+
+        for dir_path, _, file_names in os.walk(static_path):
+            for file_name in file_names:
+                file_path = os.path.join(dir_path, file_name)
+                name = os.path.relpath(file_path, static_path).replace(os.sep, "/")
+                self._add_file(name, file_path)
+
+        logger.info("Loaded {} static assets from {}".format(len(self._hashed_names), static_path))
+
+    def _add_file(self, name: str, file_path: str):
+        with open(file_path, "rb") as f:
+            body = f.read()
+
+        digest = hashlib.sha256(body).hexdigest()[:HASH_LENGTH]
+        base, ext = os.path.splitext(name)
+        hashed_name = "{}.{}{}".format(base, digest, ext)
+        content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+
+        static_file = StaticFile(content_type, digest, compress_body(body))
+        self._hashed_names[name] = hashed_name
+        self._files[name] = (static_file, False)
+        self._files[hashed_name] = (static_file, True)
+
+    def url_for(self, name: str) -> str:
+        name = name.lstrip("/")
+        return "{}/{}".format(self._root_url, self._hashed_names.get(name, name))
+
+    def matches(self, path: str) -> bool:
+        return path.startswith(self._root_url + "/")
+
+    def handle(self, request: aiohttp.web.Request) -> aiohttp.web.Response:
+        name = request.path[len(self._root_url) + 1:]
+        if name not in self._files:
+            raise aiohttp.web.HTTPNotFound()
+
+        if request.method not in ("GET", "HEAD"):
+            raise aiohttp.web.HTTPMethodNotAllowed(request.method, ["GET", "HEAD"])
+
+        static_file, immutable = self._files[name]
+        encoding = static_file.select_encoding(request.headers.get("Accept-Encoding", ""))
+        etag = static_file.get_etag(encoding)
+        headers = {
+            "Cache-Control": IMMUTABLE_CACHE_CONTROL if immutable else "no-cache",
+            "ETag": etag,
+            "Vary": "Accept-Encoding",
+        }
+
+        if_none_match = request.headers.get("If-None-Match", "")
+        if etag in [val.strip() for val in if_none_match.split(",")]:
+            return aiohttp.web.Response(status=304, headers=headers)
+
+        if encoding is not None:
+            headers["Content-Encoding"] = encoding
+
+        return aiohttp.web.Response(
+            body=static_file.bodies[encoding],
+            content_type=static_file.content_type,
+            headers=headers,
+        )
@@ -1,5 +1,8 @@
+import asyncio
+import bisect
 import configparser
 import datetime
+import hashlib
 import logging
 import operator
 import typing
@@ -14,24 +17,131 @@ import smartlist.session
 logger = logging.getLogger(__name__)
 
 
+class ArtistUpdateBuffer(object):
+
+    def __init__(self, db: smartlist.db.AsyncSmartListDB, user_id: str, flush_size: int):
+        self._db = db
+        self._user_id = user_id
+        self._flush_size = flush_size
+        self._updates: typing.List[typing.Tuple[str, str, str, str, str]] = []
+
+    async def add(self,
+                  artist_id: str,
+                  playlist_id: str,
+                  last_updated: str,
+                  fingerprint: str,
+                  snapshot_id: str):
+        self._updates.append((artist_id, playlist_id, last_updated, fingerprint, snapshot_id))
+        if len(self._updates) >= self._flush_size:
+            await self.flush()
+
+    async def flush(self):
+        if len(self._updates) == 0:
+            return
+
+        updates, self._updates = self._updates, []
+        logger.info("Saving {} artist updates for {}".format(len(updates), self._user_id))
+        await self._db.update_artist_playlists(self._user_id, updates)
+
+
 async def sync_artists(ws: aiohttp.web.WebSocketResponse,
                        config: configparser.ConfigParser,
-                       db: smartlist.db.SmartListDB,
+                       db: smartlist.db.AsyncSmartListDB,
                        user_id: str,
                        spotify_client: smartlist.client.SpotifyClient):
     logger.info("Syncing artists for {}".format(user_id))
     await ws.send_json(dict(type="start",))
-    artists = db.get_artists(user_id)
+    artists = await db.get_artists(user_id)
+    artist_ids = {artist["id"] for artist in artists}
+
+    try:
+        library_unchanged = await spotify_client.is_library_unchanged()
+        saved_albums_index, saved_tracks_index = await asyncio.gather(
+            index_album_pages_by_artist(
+                spotify_client.iter_saved_albums(use_snapshot=library_unchanged), artist_ids),
+            index_album_pages_by_artist(
+                spotify_client.iter_saved_tracks(use_snapshot=library_unchanged), artist_ids),
+        )
+        changed_artist_ids = set(index_albums_by_artist(
+            spotify_client.get_library_changes(), artist_ids))
+    except Exception:
+        logger.exception("Failed loading library for {}".format(user_id))
+        for artist in artists:
+            await ws.send_json(dict(
+                type="artistError",
+                artistId=artist["id"],
+                error="Unable to sync"
+            ))
+        return
+
+    playlists = None
+    if any(artist["playlist_id"] is not None for artist in artists):
+        try:
+            playlists = await spotify_client.get_user_playlists()
+        except Exception:
+            logger.exception("Could not list playlists for {}, checking them one by one".format(
+                user_id))
+
+    dirty_artists = []
+    clean_artists = []
     for artist in artists:
-        await sync_artist(ws, config, db, user_id, spotify_client, artist)
+        if artist["dirty"] or artist["id"] in changed_artist_ids:
+            dirty_artists.append(artist)
+            continue
+
+        track_list = build_artist_track_list(
+            saved_albums_index.get(artist["id"], []), saved_tracks_index.get(artist["id"], []))
+        if is_playlist_current(artist, fingerprint_track_list(track_list), playlists):
+            clean_artists.append(artist)
+        else:
+            logger.info("Playlist for artist {} no longer matches, rebuilding".format(
+                artist["id"]))
+            dirty_artists.append(artist)
+
+    newly_dirty_ids = [artist["id"] for artist in dirty_artists if not artist["dirty"]]
+    if len(newly_dirty_ids) > 0:
+        await db.mark_artists_dirty(user_id, newly_dirty_ids)
+
+    for artist in clean_artists:
+        await ws.send_json(dict(
+            type="artistStart",
+            artistId=artist["id"],
+        ))
+        await ws.send_json(dict(
+            type="artistComplete",
+            artistId=artist["id"],
+            lastUpdated=artist["last_updated"],
+        ))
+
+    logger.info("Rebuilding {} of {} artists for {}".format(
+        len(dirty_artists), len(artists), user_id))
+
+    semaphore = asyncio.Semaphore(config.getint("sync", "max_concurrency", fallback=1))
+    updates = ArtistUpdateBuffer(
+        db, user_id, config.getint("sync", "write_batch_size", fallback=20))
+
+    async def sync_artist_with_limit(artist: dict):
+        async with semaphore:
+            await sync_artist(ws, config, updates, user_id, spotify_client, artist,
+                              saved_albums_index.get(artist["id"], []),
+                              saved_tracks_index.get(artist["id"], []),
+                              playlists)
+
+    try:
+        await asyncio.gather(*(sync_artist_with_limit(artist) for artist in dirty_artists))
+    finally:
+        await updates.flush()
 
 
 async def sync_artist(ws: aiohttp.web.WebSocketResponse,
                       config: configparser.ConfigParser,
-                      db: smartlist.db.SmartListDB,
+                      updates: ArtistUpdateBuffer,
                       user_id: str,
                       spotify_client: smartlist.client.SpotifyClient,
-                      artist: dict):
+                      artist: dict,
+                      saved_albums: typing.List[smartlist.client.Album],
+                      saved_tracks: typing.List[smartlist.client.Album],
+                      playlists: typing.Optional[typing.Dict[str, str]] = None):
     logger.info("Syncing artist {}".format(artist["id"]))
     await ws.send_json(dict(
         type="artistStart",
@@ -39,18 +149,27 @@ async def sync_artist(ws: aiohttp.web.WebSocketResponse,
     ))
 
     try:
-        saved_albums = await spotify_client.get_saved_albums()
-        saved_albums = filter_albums(artist["id"], saved_albums)
-
-        saved_tracks = await spotify_client.get_saved_tracks()
-        saved_tracks = filter_albums(artist["id"], saved_tracks)
-
-        all_saved_albums = merge_album_lists(saved_albums, saved_tracks)
-        final_track_list = convert_album_list_to_track_list(all_saved_albums)
-
-        playlist_id = await get_or_create_playlist(config, user_id, spotify_client, artist)
-        await replace_playlist_tracks(spotify_client, playlist_id, final_track_list)
-        last_updated = update_artist_playlist_info(db, user_id, artist, playlist_id)
+        final_track_list = build_artist_track_list(saved_albums, saved_tracks)
+        fingerprint = fingerprint_track_list(final_track_list)
+
+        playlist_id, snapshot_id = await get_or_create_playlist(
+            config, user_id, spotify_client, artist, playlists)
+        if playlist_id == artist["playlist_id"] and \
+                snapshot_id == artist["snapshot_id"] and \
+                fingerprint == artist["fingerprint"]:
+            logger.info("Playlist for artist {} is unchanged".format(artist["id"]))
+            await updates.add(
+                artist["id"], playlist_id, artist["last_updated"], fingerprint, snapshot_id)
+            await ws.send_json(dict(
+                type="artistComplete",
+                artistId=artist["id"],
+                lastUpdated=artist["last_updated"],
+            ))
+            return
+
+        snapshot_id = await replace_playlist_tracks(spotify_client, playlist_id, final_track_list)
+        last_updated = await update_artist_playlist_info(
+            updates, artist, playlist_id, fingerprint, snapshot_id)
     except Exception:
         logger.exception("Failed syncing artist {}".format(artist["id"]))
         await ws.send_json(dict(
@@ -68,21 +187,35 @@ async def sync_artist(ws: aiohttp.web.WebSocketResponse,
     ))
 
 
-def filter_albums(artist_id: str, albums: typing.List[smartlist.client.Album]) \
-        -> typing.List[smartlist.client.Album]:
-    filtered_albums = []
+def index_albums_by_artist(albums: typing.List[smartlist.client.Album],
+                           artist_ids: typing.Optional[typing.Set[str]] = None) \
+        -> typing.Dict[str, typing.List[smartlist.client.Album]]:
+    index: typing.Dict[str, typing.List[smartlist.client.Album]] = dict()
     for album in albums:
-        for track in list(album.tracks.values()):
-            if not any(map(
-                lambda track_artist: track_artist.uri == artist_id,
-                track.artists,
-            )):
-                del album.tracks[track.uri]
+        artist_albums: typing.Dict[str, smartlist.client.Album] = dict()
+        for track in album.tracks.values():
+            for track_artist in track.artists:
+                if artist_ids is not None and track_artist.uri not in artist_ids:
+                    continue
+                if track_artist.uri not in artist_albums:
+                    artist_albums[track_artist.uri] = album.copy_without_tracks()
+                artist_albums[track_artist.uri].add_track(track)
 
-        if len(album.tracks) > 0:
-            filtered_albums.append(album)
+        for artist_uri, artist_album in artist_albums.items():
+            index.setdefault(artist_uri, []).append(artist_album)
 
-    return filtered_albums
+    return index
+
+
+async def index_album_pages_by_artist(
+        pages: typing.AsyncIterator[typing.List[smartlist.client.Album]],
+        artist_ids: typing.Set[str]) -> typing.Dict[str, typing.List[smartlist.client.Album]]:
+    index: typing.Dict[str, typing.List[smartlist.client.Album]] = dict()
+    async for page in pages:
+        for artist_uri, artist_albums in index_albums_by_artist(page, artist_ids).items():
+            index.setdefault(artist_uri, []).extend(artist_albums)
+
+    return index
 
 
 def merge_album_lists(*album_lists: typing.List[smartlist.client.Album]) \
@@ -102,24 +235,49 @@ def merge_album_lists(*album_lists: typing.List[smartlist.client.Album]) \
 def convert_album_list_to_track_list(album_list: typing.List[smartlist.client.Album]) \
         -> typing.List[smartlist.client.Track]:
     track_list = []
-    for album in sorted(album_list, key=operator.attrgetter("release_date")):
+    for album in sorted(album_list, key=operator.attrgetter("release_date", "uri")):
         for track in sorted(
-                sorted(album.tracks.values(),
-                       key=operator.attrgetter("track_number")),
-                key=operator.attrgetter("disc_number")):
+                album.tracks.values(),
+                key=operator.attrgetter("disc_number", "track_number", "uri")):
             track_list.append(track)
 
     return track_list
 
 
+def build_artist_track_list(saved_albums: typing.List[smartlist.client.Album],
+                            saved_tracks: typing.List[smartlist.client.Album]) \
+        -> typing.List[smartlist.client.Track]:
+    return convert_album_list_to_track_list(merge_album_lists(saved_albums, saved_tracks))
+
+
+def is_playlist_current(artist: dict,
+                        fingerprint: str,
+                        playlists: typing.Optional[typing.Dict[str, str]]) -> bool:
+    if artist["playlist_id"] is None or playlists is None:
+        return False
+
+    return fingerprint == artist["fingerprint"] and \
+        playlists.get(artist["playlist_id"]) == artist["snapshot_id"]
+
+
+def fingerprint_track_list(tracks: typing.List[smartlist.client.Track]) -> str:
+    return hashlib.sha256("\n".join(track.uri for track in tracks).encode()).hexdigest()
+
+
 async def get_or_create_playlist(config: configparser.ConfigParser,
                                  user_id: str,
                                  spotify_client: smartlist.client.SpotifyClient,
-                                 artist: dict):
+                                 artist: dict,
+                                 playlists: typing.Optional[typing.Dict[str, str]] = None) \
+        -> typing.Tuple[str, str]:
     if artist["playlist_id"] is not None:
+        if playlists is not None and artist["playlist_id"] in playlists:
+            return artist["playlist_id"], playlists[artist["playlist_id"]]
+
         try:
-            await spotify_client.get_playlist(artist["playlist_id"])
-            return artist["playlist_id"]
+            playlist = await spotify_client.get_playlist(
+                artist["playlist_id"], fields="snapshot_id")
+            return artist["playlist_id"], playlist["snapshot_id"]
         except smartlist.client.SpotifyApiException:
             logger.error("Could not retrieve playlist, constructing new one")
 
@@ -135,20 +293,85 @@ async def get_or_create_playlist(config: configparser.ConfigParser,
     playlist_description = description_template.format(**artist)
 
     playlist = await spotify_client.create_playlist(user_id, playlist_name, playlist_description)
-    return playlist["uri"]
+    return playlist["uri"], playlist["snapshot_id"]
+
+
+def diff_playlist_tracks(current_uris: typing.List[str],
+                         tracks: typing.List[smartlist.client.Track]) \
+        -> typing.Tuple[typing.List[typing.Tuple[int, str]],
+                        typing.List[typing.Tuple[int, typing.List[smartlist.client.Track]]]]:
+    desired_positions = {track.uri: idx for idx, track in enumerate(tracks)}
+
+    # candidates are the first occurrence of each wanted track, in playlist order
+    candidates: typing.List[typing.Tuple[int, int]] = []
+    seen_uris = set()
+    for position, uri in enumerate(current_uris):
+        if uri in desired_positions and uri not in seen_uris:
+            seen_uris.add(uri)
+            candidates.append((position, desired_positions[uri]))
+
+    # the longest run already in the desired order can stay where it is
+    tails: typing.List[int] = []
+    tail_indexes: typing.List[int] = []
+    predecessors: typing.List[int] = []
+    for idx, (_, desired_position) in enumerate(candidates):
+        tail_idx = bisect.bisect_left(tails, desired_position)
+        predecessors.append(tail_indexes[tail_idx - 1] if tail_idx > 0 else -1)
+        if tail_idx == len(tails):
+            tails.append(desired_position)
+            tail_indexes.append(idx)
+        else:
+            tails[tail_idx] = desired_position
+            tail_indexes[tail_idx] = idx
+
+    kept_positions = set()
+    idx = tail_indexes[-1] if len(tail_indexes) > 0 else -1
+    while idx >= 0:
+        kept_positions.add(candidates[idx][0])
+        idx = predecessors[idx]
+
+    removals = [(position, uri) for position, uri in enumerate(current_uris)
+                if position not in kept_positions]
+
+    kept_uris = {current_uris[position] for position in kept_positions}
+    insertions: typing.List[typing.Tuple[int, typing.List[smartlist.client.Track]]] = []
+    for idx, track in enumerate(tracks):
+        if track.uri in kept_uris:
+            continue
+
+        if len(insertions) > 0 and \
+                insertions[-1][0] + len(insertions[-1][1]) == idx:
+            insertions[-1][1].append(track)
+        else:
+            insertions.append((idx, [track]))
+
+    return removals, insertions
 
 
 async def replace_playlist_tracks(spotify_client: smartlist.client.SpotifyClient,
                                   playlist_id: str,
                                   tracks: typing.List[smartlist.client.Track]):
-    await spotify_client.clear_playlist(playlist_id)
-    await spotify_client.add_items_to_playlist(playlist_id, tracks)
+    snapshot_id, current_uris = await spotify_client.get_playlist_items(playlist_id)
+    removals, insertions = diff_playlist_tracks(current_uris, tracks)
+    logger.info("Updating playlist {}: {} removals, {} insertions".format(
+        playlist_id, len(removals), sum(len(run) for _, run in insertions)))
+
+    if len(removals) > 0:
+        snapshot_id = await spotify_client.remove_items_from_playlist(
+            playlist_id, removals, snapshot_id)
+
+    for position, run in insertions:
+        snapshot_id = await spotify_client.add_items_to_playlist(
+            playlist_id, run, position=position)
+
+    return snapshot_id
 
 
-def update_artist_playlist_info(db: smartlist.db.SmartListDB,
-                                user_id: str,
-                                artist: dict,
-                                playlist_id: str):
+async def update_artist_playlist_info(updates: ArtistUpdateBuffer,
+                                      artist: dict,
+                                      playlist_id: str,
+                                      fingerprint: str,
+                                      snapshot_id: str):
     now = datetime.datetime.now(datetime.timezone.utc)
-    db.update_artist_playlist(user_id, artist["id"], playlist_id, now.isoformat())
+    await updates.add(artist["id"], playlist_id, now.isoformat(), fingerprint, snapshot_id)
     return now
@@ -1,9 +1,11 @@
+import asyncio
 import datetime
 
 import pytest
 import unittest.mock
 
 import smartlist.actions
+import smartlist.serialization
 import smartlist.session
 
 
@@ -20,7 +22,7 @@ def test_get_home():
 
 @pytest.mark.asyncio
 async def test_get_artists():
-    db = unittest.mock.Mock()
+    db = unittest.mock.AsyncMock()
     db.get_artists.return_value = [
         dict(id="id1", playlist_id=None), dict(id="id2", playlist_id="pid2")]
     session = smartlist.session.Session({})
@@ -42,7 +44,7 @@ async def test_get_artists():
 
 @pytest.mark.asyncio
 async def test_get_artists_edit():
-    db = unittest.mock.Mock()
+    db = unittest.mock.AsyncMock()
     db.get_artists.return_value = [dict(id="id1"), dict(id="id2")]
     session = smartlist.session.Session({})
     session.user_info = dict(user_id="user_id")
@@ -63,7 +65,7 @@ async def test_get_artists_edit():
 class TestPostArtists(object):
 
     async def test_success(self):
-        mock_db = unittest.mock.Mock()
+        mock_db = unittest.mock.AsyncMock()
         session = smartlist.session.Session({})
         session.user_info = dict(user_id="user_id")
         payload = dict(
@@ -105,15 +107,16 @@ class TestGetArtistsSync(object):
         return mock
 
     @pytest.fixture
-    def mock_sync(self, monkeypatch: pytest.MonkeyPatch):
+    def mock_scheduler(self):
         mock = unittest.mock.AsyncMock()
-        monkeypatch.setattr("smartlist.actions.smartlist.sync.sync_artists",
-                            mock)
+        mock.request_sync = unittest.mock.AsyncMock()
+        mock.request_sync.return_value = "job_id"
+        mock.unsubscribe = unittest.mock.Mock()
         return mock
 
     async def test_success(self,
                            mock_websocket: unittest.mock.AsyncMock,
-                           mock_sync: unittest.mock.AsyncMock):
+                           mock_scheduler: unittest.mock.AsyncMock):
         mock_websocket.receive_json.return_value = dict(
             type="csrf",
             csrfToken="token",
@@ -123,30 +126,50 @@ class TestGetArtistsSync(object):
         mock_session.user_info = dict(user_id="user_id")
         mock_session.csrf_token = "token"
 
-        resp = await smartlist.actions.get_artists_sync(
-            "request", "config", "db", mock_session, "client")
+        resp = await smartlist.actions.get_artists_sync("request", mock_scheduler, mock_session)
 
         assert resp == mock_websocket
         mock_websocket.prepare.assert_called_once_with("request")
-        mock_websocket.receive_json.assert_called_once_with()
-        mock_sync.assert_called_once_with(mock_websocket, "config", "db", "user_id", "client")
+        mock_websocket.receive_json.assert_called_once_with(loads=smartlist.serialization.loads)
+        mock_scheduler.subscribe.assert_called_once_with("user_id", mock_websocket)
+        mock_scheduler.request_sync.assert_called_once_with("user_id")
+        mock_scheduler.wait_for_job.assert_called_once_with("job_id")
+        mock_scheduler.unsubscribe.assert_called_once_with("user_id", mock_websocket)
+
+    async def test_wait_cancelled(self,
+                                  mock_websocket: unittest.mock.AsyncMock,
+                                  mock_scheduler: unittest.mock.AsyncMock):
+        mock_websocket.receive_json.return_value = dict(
+            type="csrf",
+            csrfToken="token",
+        )
+        mock_scheduler.wait_for_job.side_effect = asyncio.CancelledError()
+
+        mock_session = smartlist.session.Session({})
+        mock_session.user_info = dict(user_id="user_id")
+        mock_session.csrf_token = "token"
+
+        with pytest.raises(asyncio.CancelledError):
+            await smartlist.actions.get_artists_sync("request", mock_scheduler, mock_session)
+
+        mock_scheduler.unsubscribe.assert_called_once_with("user_id", mock_websocket)
 
     async def test_recieve_json_exception(self,
                                           mock_websocket: unittest.mock.AsyncMock,
-                                          mock_sync: unittest.mock.AsyncMock):
+                                          mock_scheduler: unittest.mock.AsyncMock):
         mock_websocket.receive_json.side_effect = Exception()
 
-        resp = await smartlist.actions.get_artists_sync(
-            "request", "config", "db", "session", "client")
+        resp = await smartlist.actions.get_artists_sync("request", mock_scheduler, "session")
 
         assert resp.status == 401
         mock_websocket.prepare.assert_called_once_with("request")
-        mock_websocket.receive_json.assert_called_once_with()
-        mock_sync.assert_not_called()
+        mock_websocket.receive_json.assert_called_once_with(loads=smartlist.serialization.loads)
+        mock_scheduler.subscribe.assert_not_called()
+        mock_scheduler.request_sync.assert_not_called()
 
     async def test_token_mismatch(self,
                                   mock_websocket: unittest.mock.AsyncMock,
-                                  mock_sync: unittest.mock.AsyncMock):
+                                  mock_scheduler: unittest.mock.AsyncMock):
         mock_websocket.receive_json.return_value = dict(
             type="csrf",
             csrfToken="wsToken",
@@ -155,13 +178,13 @@ class TestGetArtistsSync(object):
         mock_session = smartlist.session.Session({})
         mock_session.csrf_token = "sessionToken"
 
-        resp = await smartlist.actions.get_artists_sync(
-            "request", "config", "db", mock_session, "client")
+        resp = await smartlist.actions.get_artists_sync("request", mock_scheduler, mock_session)
 
         assert resp.status == 401
         mock_websocket.prepare.assert_called_once_with("request")
-        mock_websocket.receive_json.assert_called_once_with()
-        mock_sync.assert_not_called()
+        mock_websocket.receive_json.assert_called_once_with(loads=smartlist.serialization.loads)
+        mock_scheduler.subscribe.assert_not_called()
+        mock_scheduler.request_sync.assert_not_called()
 
 
 def test_login():
@@ -196,16 +219,20 @@ class TestLoginCallback(object):
         return session
 
     @pytest.fixture
-    def mock_client_session_constructor(self, monkeypatch):
+    def mock_new_session(self):
+        return unittest.mock.AsyncMock(return_value=smartlist.session.Session({}))
+
+    @pytest.fixture
+    def mock_client_session(self):
         mock = unittest.mock.MagicMock()
-        mock.return_value.__aenter__.return_value.post = unittest.mock.MagicMock()
-        mock.return_value.__aenter__.return_value.get = unittest.mock.MagicMock()
-        monkeypatch.setattr("aiohttp.ClientSession", mock)
+        mock.post = unittest.mock.MagicMock()
+        mock.get = unittest.mock.MagicMock()
         return mock
 
     async def test_bad_state(self, mock_session):
         resp = await smartlist.actions.login_callback(
-            None, None, mock_session, "home_route", "artists_route", None, None, None, None, None)
+            None, None, mock_session, None, None,
+            "home_route", "artists_route", None, None, None, None, None)
         assert resp.status == 307
         assert resp.location == "home_route"
         assert mock_session.pop_flashes() == [dict(
@@ -213,7 +240,7 @@ class TestLoginCallback(object):
 
     async def test_error(self, mock_session):
         resp = await smartlist.actions.login_callback(
-            None, None, mock_session, "home_route", "artists_route",
+            None, None, mock_session, None, None, "home_route", "artists_route",
             None, None, "state", "error", None)
         assert resp.status == 307
         assert resp.location == "home_route"
@@ -222,26 +249,25 @@ class TestLoginCallback(object):
 
     async def test_missing_code(self, mock_session):
         resp = await smartlist.actions.login_callback(
-            None, None, mock_session, "home_route", "artists_route",
+            None, None, mock_session, None, None, "home_route", "artists_route",
             None, None, "state", None, None)
         assert resp.status == 307
         assert resp.location == "home_route"
         assert mock_session.pop_flashes() == [dict(
             type="error", msg="Encountered an error logging in.")]
 
-    async def test_success(self, monkeypatch, mock_session, mock_client_session_constructor):
+    async def test_success(self, monkeypatch, mock_session, mock_new_session,
+                           mock_client_session):
         mock_config = unittest.mock.Mock()
         mock_config.get.side_effect = ["client_id", "client_secret", "http://callback_base_url", ""]
 
-        mock_db = unittest.mock.Mock()
+        mock_db = unittest.mock.AsyncMock()
 
         utcnow = datetime.datetime.now(datetime.timezone.utc)
         mock_datetime_datetime = unittest.mock.Mock()
         mock_datetime_datetime.now.return_value = utcnow
         monkeypatch.setattr("smartlist.actions.datetime.datetime", mock_datetime_datetime)
 
-        mock_client_session = mock_client_session_constructor.return_value.__aenter__.return_value
-
         post_token_response = mock_client_session.post.return_value.__aenter__.return_value
         post_token_response.status = 200
         post_token_response.json.side_effect = (dict(
@@ -257,7 +283,7 @@ class TestLoginCallback(object):
         ),)
 
         resp = await smartlist.actions.login_callback(
-            mock_config, mock_db, mock_session,
+            mock_config, mock_db, mock_session, mock_new_session, mock_client_session,
             "home_route", "artists_route", "login_callback_route",
             None, "state", None, "code")
 
@@ -269,7 +295,6 @@ class TestLoginCallback(object):
             unittest.mock.call("auth", "callback_base_url"),
             unittest.mock.call("auth", "allowed_users", fallback=""),
         ))
-        mock_client_session_constructor.assert_called_once_with()
         mock_client_session.post.assert_called_once_with(
             "https://accounts.spotify.com/api/token", data=dict(
                 grant_type="authorization_code",
@@ -281,11 +306,13 @@ class TestLoginCallback(object):
         mock_client_session.get.assert_called_once_with(
             "https://api.spotify.com/v1/me", headers=dict(Authorization="Bearer access_token")
         )
-        post_token_response.json.assert_called_once_with()
-        get_profile_response.json.assert_called_once_with()
+        post_token_response.json.assert_called_once_with(loads=smartlist.serialization.loads)
+        get_profile_response.json.assert_called_once_with(loads=smartlist.serialization.loads)
 
         expiry = utcnow + datetime.timedelta(seconds=60)
-        assert mock_session._session == dict(
+        mock_new_session.assert_called_once_with()
+        assert mock_session._session == dict()
+        assert mock_new_session.return_value._session == dict(
             user_info=dict(
                 user_id="spotify:user:user_id",
                 access_token="access_token",
@@ -295,18 +322,16 @@ class TestLoginCallback(object):
         mock_db.upsert_user.assert_called_once_with("spotify:user:user_id", "refresh_token")
         mock_datetime_datetime.now.assert_called_once_with(datetime.timezone.utc)
 
-    async def test_user_not_allowed(self, mock_session, mock_client_session_constructor):
+    async def test_user_not_allowed(self, mock_session, mock_new_session, mock_client_session):
         mock_config = unittest.mock.Mock()
         mock_config.get.side_effect = ["client_id", "client_secret",
                                        "http://callback_base_url", "spotify:user:test_user"]
 
-        mock_db = unittest.mock.Mock()
+        mock_db = unittest.mock.AsyncMock()
 
         mock_login_failed_route = unittest.mock.Mock()
         mock_login_failed_route.url_for.return_value.with_query.return_value = "login_failed_route"
 
-        mock_client_session = mock_client_session_constructor.return_value.__aenter__.return_value
-
         post_token_response = mock_client_session.post.return_value.__aenter__.return_value
         post_token_response.status = 200
         post_token_response.json.side_effect = (dict(
@@ -322,7 +347,7 @@ class TestLoginCallback(object):
         ),)
 
         resp = await smartlist.actions.login_callback(
-            mock_config, mock_db, mock_session,
+            mock_config, mock_db, mock_session, mock_new_session, mock_client_session,
             "home_route", "artists_route", "login_callback_route",
             mock_login_failed_route, "state", None, "code")
 
@@ -334,7 +359,6 @@ class TestLoginCallback(object):
             unittest.mock.call("auth", "callback_base_url"),
             unittest.mock.call("auth", "allowed_users", fallback=""),
         ))
-        mock_client_session_constructor.assert_called_once_with()
         mock_client_session.post.assert_called_once_with(
             "https://accounts.spotify.com/api/token", data=dict(
                 grant_type="authorization_code",
@@ -346,27 +370,26 @@ class TestLoginCallback(object):
         mock_client_session.get.assert_called_once_with(
             "https://api.spotify.com/v1/me", headers=dict(Authorization="Bearer access_token")
         )
-        post_token_response.json.assert_called_once_with()
-        get_profile_response.json.assert_called_once_with()
+        post_token_response.json.assert_called_once_with(loads=smartlist.serialization.loads)
+        get_profile_response.json.assert_called_once_with(loads=smartlist.serialization.loads)
 
         assert mock_session._session == dict()
+        mock_new_session.assert_not_called()
         mock_db.upsert_user.assert_not_called()
         mock_login_failed_route.assert_has_calls((
             unittest.mock.call.url_for(),
             unittest.mock.call.url_for().with_query(userId="spotify:user:user_id"),
         ))
 
-    async def test_post_fail(self, mock_session, mock_client_session_constructor):
+    async def test_post_fail(self, mock_session, mock_client_session):
         mock_config = unittest.mock.Mock()
         mock_config.get.side_effect = ["client_id", "client_secret", "http://callback_base_url"]
 
-        mock_client_session = mock_client_session_constructor.return_value.__aenter__.return_value
-
         post_token_response = mock_client_session.post.return_value.__aenter__.return_value
         post_token_response.status = 500
 
         resp = await smartlist.actions.login_callback(
-            mock_config, None, mock_session,
+            mock_config, None, mock_session, None, mock_client_session,
             "home_route", "artists_route", "login_callback_route",
             None, "state", None, "code")
 
@@ -377,7 +400,6 @@ class TestLoginCallback(object):
             unittest.mock.call("auth", "client_secret"),
             unittest.mock.call("auth", "callback_base_url"),
         ))
-        mock_client_session_constructor.assert_called_once_with()
         mock_client_session.post.assert_called_once_with(
             "https://accounts.spotify.com/api/token", data=dict(
                 grant_type="authorization_code",
@@ -391,12 +413,10 @@ class TestLoginCallback(object):
         assert mock_session.pop_flashes() == [dict(
             type="error", msg="Encountered an error logging in.")]
 
-    async def test_get_fails(self, mock_session, mock_client_session_constructor):
+    async def test_get_fails(self, mock_session, mock_client_session):
         mock_config = unittest.mock.Mock()
         mock_config.get.side_effect = ["client_id", "client_secret", "http://callback_base_url"]
 
-        mock_client_session = mock_client_session_constructor.return_value.__aenter__.return_value
-
         post_token_response = mock_client_session.post.return_value.__aenter__.return_value
         post_token_response.status = 200
         post_token_response.json.side_effect = (dict(
@@ -408,7 +428,7 @@ class TestLoginCallback(object):
         get_profile_response.status = 500
 
         resp = await smartlist.actions.login_callback(
-            mock_config, None, mock_session,
+            mock_config, None, mock_session, None, mock_client_session,
             "home_route", "artists_route", "login_callback_route",
             None, "state", None, "code")
 
@@ -419,7 +439,6 @@ class TestLoginCallback(object):
             unittest.mock.call("auth", "client_secret"),
             unittest.mock.call("auth", "callback_base_url"),
         ))
-        mock_client_session_constructor.assert_called_once_with()
         mock_client_session.post.assert_called_once_with(
             "https://accounts.spotify.com/api/token", data=dict(
                 grant_type="authorization_code",
@@ -431,7 +450,7 @@ class TestLoginCallback(object):
         mock_client_session.get.assert_called_once_with(
             "https://api.spotify.com/v1/me", headers=dict(Authorization="Bearer access_token")
         )
-        post_token_response.json.assert_called_once_with()
+        post_token_response.json.assert_called_once_with(loads=smartlist.serialization.loads)
         get_profile_response.text.assert_called_once_with()
         get_profile_response.json.assert_not_called()
         assert mock_session.pop_flashes() == [dict(
@@ -441,9 +460,11 @@ class TestLoginCallback(object):
 def test_logout():
     session = smartlist.session.Session({})
     session.user_info = "user_info"
+    session.csrf_token = "csrf_token"
 
     resp = smartlist.actions.logout(session, "home_route")
 
     assert resp.status == 307
     assert resp.location == "home_route"
     assert session.user_info is None
+    assert session.csrf_token is None
@@ -0,0 +1,102 @@
+import configparser
+import datetime
+import unittest.mock
+
+import pytest
+
+import smartlist.catalog
+
+
+@pytest.fixture
+def catalog():
+    return smartlist.catalog.Catalog(
+        "Test", unittest.mock.AsyncMock(), unittest.mock.AsyncMock(), 2, 24)
+
+
+def _timestamp(hours_ago):
+    return datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=hours_ago)
+
+
+@pytest.mark.asyncio
+class TestGetItems(object):
+
+    async def test_memory_hit(self, catalog: smartlist.catalog.Catalog):
+        catalog._cache_put(dict(uri="a1"), _timestamp(1))
+
+        found, missing = await catalog.get_items(["a1"])
+
+        assert found == dict(a1=dict(uri="a1"))
+        assert missing == []
+        catalog._load.assert_not_called()
+
+    async def test_db_hit_and_miss(self, catalog: smartlist.catalog.Catalog):
+        catalog._load.return_value = [
+            (dict(uri="a2"), _timestamp(2).isoformat()),
+        ]
+
+        found, missing = await catalog.get_items(["a2", "a3", "a3"])
+
+        assert found == dict(a2=dict(uri="a2"))
+        assert missing == ["a3"]
+        catalog._load.assert_called_once_with(["a2", "a3", "a3"], unittest.mock.ANY)
+        assert list(catalog._cache.keys()) == ["a2"]
+
+    async def test_expired_memory_entry(self, catalog: smartlist.catalog.Catalog):
+        catalog._cache_put(dict(uri="a1"), _timestamp(25))
+        catalog._load.return_value = []
+
+        found, missing = await catalog.get_items(["a1"])
+
+        assert found == dict()
+        assert missing == ["a1"]
+        assert "a1" not in catalog._cache
+        cutoff = datetime.datetime.fromisoformat(catalog._load.call_args[0][1])
+        assert abs(cutoff - _timestamp(24)) < datetime.timedelta(minutes=1)
+
+
+@pytest.mark.asyncio
+async def test_save_items(catalog: smartlist.catalog.Catalog):
+    await catalog.save_items([dict(uri="a1"), dict(uri="a2"), dict(uri="a3")])
+
+    catalog._store.assert_called_once_with([
+        ("a1", dict(uri="a1")),
+        ("a2", dict(uri="a2")),
+        ("a3", dict(uri="a3")),
+    ], unittest.mock.ANY)
+    assert list(catalog._cache.keys()) == ["a2", "a3"]
+
+
+@pytest.mark.asyncio
+async def test_save_no_items(catalog: smartlist.catalog.Catalog):
+    await catalog.save_items([])
+
+    catalog._store.assert_not_called()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("create,section,load,store,cache_size,ttl", (
+    (smartlist.catalog.create_artist_catalog, "artist_cache",
+     "get_catalog_artists", "save_catalog_artists", 2048, 24),
+    (smartlist.catalog.create_album_catalog, "album_cache",
+     "get_catalog_albums", "save_catalog_albums", 256, 168),
+), ids=("Artist", "Album"))
+async def test_create_catalog(create, section, load, store, cache_size, ttl):
+    mock_db = unittest.mock.AsyncMock()
+    getattr(mock_db, load).return_value = [(dict(uri="u1"), _timestamp(1).isoformat())]
+
+    catalog = create(mock_db, configparser.ConfigParser())
+    found, missing = await catalog.get_items(["u1", "u2"])
+    await catalog.save_items([dict(uri="u2")])
+
+    assert catalog._cache_size == cache_size
+    assert catalog._ttl == datetime.timedelta(hours=ttl)
+    assert found == dict(u1=dict(uri="u1"))
+    assert missing == ["u2"]
+    getattr(mock_db, load).assert_called_once_with(["u1", "u2"], unittest.mock.ANY)
+    getattr(mock_db, store).assert_called_once_with([("u2", dict(uri="u2"))], unittest.mock.ANY)
+
+    config = configparser.ConfigParser()
+    config.read_dict({section: dict(cache_size="5", ttl_hours="6")})
+    catalog = create(mock_db, config)
+    assert catalog._cache_size == 5
+    assert catalog._ttl == datetime.timedelta(hours=6)
@@ -1,3 +1,5 @@
+import asyncio
+import configparser
 import copy
 import datetime
 import unittest.mock
@@ -5,13 +7,23 @@ import unittest.mock
 import pytest
 
 import smartlist.client
+import smartlist.serialization
 import smartlist.session
 
 
+async def collect(pages):
+    return [page async for page in pages]
+
+
+async def iter_pages(*pages):
+    for page in pages:
+        yield page
+
+
 @pytest.fixture
 def client():
     config = unittest.mock.Mock()
-    db = unittest.mock.Mock()
+    db = unittest.mock.AsyncMock()
     session = smartlist.session.Session({})
     return smartlist.client.SpotifyClient(config, db, session)
 
@@ -104,6 +116,20 @@ class TestAlbum(object):
             t2=t2,
         )
 
+    def test_copy_without_tracks(self):
+        album = smartlist.client.Album("name", "date", "day", "uri", ["a1"])
+        album.add_track(smartlist.client.Track(None, "t1", None, None, None, None))
+
+        copied_album = album.copy_without_tracks()
+
+        assert copied_album is not album
+        assert copied_album.name == "name"
+        assert copied_album._release_date == "date"
+        assert copied_album._release_date_precision == "day"
+        assert copied_album.uri == "uri"
+        assert copied_album.artists == ["a1"]
+        assert copied_album.tracks == dict()
+
     @pytest.mark.parametrize("release_date,release_date_precision,expected_datetime", (
         ("2021-02-02", "day", datetime.datetime(2021, 2, 2)),
         ("2021-02", "month", datetime.datetime(2021, 2, 1)),
@@ -144,12 +170,55 @@ def test_track_parse(monkeypatch: pytest.MonkeyPatch):
     ))
 
 
+def test_create_client_session(monkeypatch: pytest.MonkeyPatch):
+    mock_session_constructor = unittest.mock.Mock()
+    monkeypatch.setattr("smartlist.client.aiohttp.ClientSession", mock_session_constructor)
+    mock_connector_constructor = unittest.mock.Mock()
+    monkeypatch.setattr("smartlist.client.aiohttp.TCPConnector", mock_connector_constructor)
+
+    mock_config = unittest.mock.Mock()
+    mock_config.getint.side_effect = (1, 2, 3, 4)
+
+    client_session = smartlist.client.create_client_session(mock_config)
+
+    assert client_session == mock_session_constructor.return_value
+    mock_connector_constructor.assert_called_once_with(
+        limit=1, limit_per_host=2, keepalive_timeout=3, ttl_dns_cache=4)
+    mock_session_constructor.assert_called_once_with(
+        connector=mock_connector_constructor.return_value,
+        json_serialize=smartlist.serialization.dumps)
+    mock_config.getint.assert_has_calls((
+        unittest.mock.call("http", "connection_limit", fallback=100),
+        unittest.mock.call("http", "connection_limit_per_host", fallback=20),
+        unittest.mock.call("http", "keepalive_timeout", fallback=60),
+        unittest.mock.call("http", "dns_cache_seconds", fallback=300),
+    ))
+
+
 def test_constructor():
     client = smartlist.client.SpotifyClient("config", "db", "session")
     assert client._request_session == "session"
     assert client._config == "config"
     assert client._db == "db"
     assert client._client_session is None
+    assert client._owns_client_session
+
+
+def test_constructor_with_resources():
+    client = smartlist.client.SpotifyClient(
+        "config", "db", "session", smartlist.client.ClientResources(
+            client_session="client_session",
+            rate_limiter="rate_limiter",
+            response_cache="response_cache",
+            artist_catalog="artist_catalog",
+            album_catalog="album_catalog",
+        ))
+    assert client._client_session == "client_session"
+    assert not client._owns_client_session
+    assert client._rate_limiter == "rate_limiter"
+    assert client._response_cache == "response_cache"
+    assert client._artist_catalog == "artist_catalog"
+    assert client._album_catalog == "album_catalog"
 
 
 def test_get_client_session(monkeypatch: pytest.MonkeyPatch):
@@ -175,10 +244,6 @@ def test_is_access_token_expired(monkeypatch: pytest.MonkeyPatch,
     mock_datetime.now.return_value = now
     monkeypatch.setattr("smartlist.client.datetime.datetime", mock_datetime)
 
-    client._request_session.user_info = dict(
-        access_token_expiry="mock_expiry",
-    )
-
     for expiry_delta, expected_result in (
         (-10, True),
         (-5, True),
@@ -187,12 +252,18 @@ def test_is_access_token_expired(monkeypatch: pytest.MonkeyPatch,
         (5, False),
         (10, False),
     ):
+        client._request_session.user_info = dict(
+            access_token_expiry="mock_expiry_{}".format(expiry_delta),
+        )
         mock_datetime.fromisoformat.return_value = now + datetime.timedelta(minutes=expiry_delta)
         assert client._is_access_token_expired() == expected_result, "({}, {}) failed".format(
             expiry_delta, expected_result)
 
     assert mock_datetime.fromisoformat.call_count == 6
 
+    assert client._is_access_token_expired() is False
+    assert mock_datetime.fromisoformat.call_count == 6
+
 
 @pytest.mark.asyncio
 class TestRefreshToken(object):
@@ -236,7 +307,7 @@ class TestRefreshToken(object):
                 client_secret="secret",
             )
         )
-        mock_response.json.assert_called_once_with()
+        mock_response.json.assert_called_once_with(loads=smartlist.serialization.loads)
         client._db.get_refresh_token.assert_called_once_with("user_id")
         if include_refresh_token:
             client._db.upsert_user.assert_called_once_with("user_id", "refresh_token")
@@ -251,6 +322,9 @@ class TestRefreshToken(object):
             access_token="access_token",
             access_token_expiry=expected_expiry_time,
         )
+        assert client._access_token_expiry == (
+            expected_expiry_time, utcnow + datetime.timedelta(seconds=10))
+        assert smartlist.client._token_refreshes == dict()
 
     async def test_success_with_new_refresh_token(self,
                                                   monkeypatch: pytest.MonkeyPatch,
@@ -289,6 +363,32 @@ class TestRefreshToken(object):
         mock_response.json.assert_not_called()
         client._db.get_refresh_token.assert_called_once_with("user_id")
 
+    async def test_concurrent_refreshes_coalesced(self, client: smartlist.client.SpotifyClient):
+        mock_response = unittest.mock.AsyncMock()
+        mock_response.status = 200
+        mock_response.json.return_value = dict(
+            access_token="access_token",
+            expires_in=3600,
+            refresh_token="refresh_token",
+        )
+        client._client_session = unittest.mock.MagicMock()
+        client._client_session.post.return_value.__aenter__.return_value = mock_response
+        client._request_session.user_info = dict(user_id="user_id")
+
+        other_session = smartlist.session.Session(dict(user_info=dict(user_id="user_id")))
+        other_client = smartlist.client.SpotifyClient(
+            client._config, client._db, other_session,
+            smartlist.client.ClientResources(client_session=client._client_session))
+
+        await asyncio.gather(client._refresh_token(), other_client._refresh_token())
+
+        client._client_session.post.assert_called_once()
+        client._db.upsert_user.assert_called_once_with("user_id", "refresh_token")
+        assert client._request_session.access_token == "access_token"
+        assert other_session.access_token == "access_token"
+        assert other_session.access_token_expiry == client._request_session.access_token_expiry
+        assert smartlist.client._token_refreshes == dict()
+
 
 @pytest.mark.asyncio
 class TestMakeApiCall(object):
@@ -345,11 +445,13 @@ class TestMakeApiCall(object):
             return unittest.mock.DEFAULT
 
         mocked_client._client_session.request.side_effect = request_side_effect
+        mock_response2 = unittest.mock.Mock()
+        mock_response2.status = 200
         mocked_client._client_session.request.return_value.__aenter__.side_effect = (
-            mock_response, "response2")
+            mock_response, mock_response2)
 
         async with mocked_client._make_api_call("method", "url") as resp:
-            assert resp == "response2"
+            assert resp == mock_response2
 
         assert request_calls == [
             unittest.mock.call("method", "url",
@@ -360,6 +462,145 @@ class TestMakeApiCall(object):
                                json=None),
         ]
 
+    async def test_extra_headers(self, mocked_client: smartlist.client.SpotifyClient):
+        mocked_client._client_session.request.return_value.__aenter__.return_value.status = 200
+
+        async with mocked_client._make_api_call("get", "url", headers={"If-None-Match": "etag"}):
+            pass
+
+        mocked_client._client_session.request.assert_called_once_with(
+            "get", "url", json=None,
+            headers={"If-None-Match": "etag", "Authorization": "Bearer token"})
+
+    async def test_retries_on_429(self,
+                                  monkeypatch: pytest.MonkeyPatch,
+                                  mocked_client: smartlist.client.SpotifyClient):
+        mock_sleep = unittest.mock.AsyncMock()
+        monkeypatch.setattr("smartlist.client.asyncio.sleep", mock_sleep)
+
+        mock_response = unittest.mock.Mock()
+        mock_response.status = 429
+        mock_response.headers = {"Retry-After": "3"}
+        mock_response2 = unittest.mock.Mock()
+        mock_response2.status = 200
+        mocked_client._client_session.request.return_value.__aenter__.side_effect = (
+            mock_response, mock_response2)
+
+        async with mocked_client._make_api_call("method", "url") as resp:
+            assert resp == mock_response2
+
+        assert mocked_client._client_session.request.call_count == 2
+        mock_sleep.assert_called_once_with(3.0)
+
+    async def test_429_blocks_rate_limiter(self, mocked_client: smartlist.client.SpotifyClient):
+        mocked_client._rate_limiter = unittest.mock.Mock()
+        mocked_client._rate_limiter.acquire = unittest.mock.AsyncMock()
+
+        mock_response = unittest.mock.Mock()
+        mock_response.status = 429
+        mock_response.headers = {"Retry-After": "3"}
+        mock_response2 = unittest.mock.Mock()
+        mock_response2.status = 200
+        mocked_client._client_session.request.return_value.__aenter__.side_effect = (
+            mock_response, mock_response2)
+
+        async with mocked_client._make_api_call("method", "url") as resp:
+            assert resp == mock_response2
+
+        assert mocked_client._rate_limiter.acquire.call_count == 2
+        mocked_client._rate_limiter.block.assert_called_once_with(3.0)
+
+    async def test_gives_up_after_max_429_retries(self,
+                                                  monkeypatch: pytest.MonkeyPatch,
+                                                  mocked_client: smartlist.client.SpotifyClient):
+        monkeypatch.setattr("smartlist.client.asyncio.sleep", unittest.mock.AsyncMock())
+
+        mock_response = unittest.mock.Mock()
+        mock_response.status = 429
+        mock_response.headers = dict()
+        mocked_client._client_session.request.return_value.__aenter__.return_value = mock_response
+
+        async with mocked_client._make_api_call("method", "url") as resp:
+            assert resp == mock_response
+
+        assert mocked_client._client_session.request.call_count == \
+            smartlist.client.MAX_RATE_LIMIT_RETRIES + 1
+
+
+@pytest.mark.asyncio
+class TestRateLimiter(object):
+
+    @pytest.fixture
+    def mock_time(self, monkeypatch: pytest.MonkeyPatch):
+        clock = dict(now=100.0)
+
+        async def sleep(seconds):
+            clock["now"] += seconds
+
+        mock_sleep = unittest.mock.AsyncMock(side_effect=sleep)
+        monkeypatch.setattr("smartlist.client.time.monotonic", lambda: clock["now"])
+        monkeypatch.setattr("smartlist.client.asyncio.sleep", mock_sleep)
+        return mock_sleep
+
+    async def test_allows_burst(self, mock_time: unittest.mock.AsyncMock):
+        limiter = smartlist.client.RateLimiter(2, 3)
+
+        for _ in range(3):
+            await limiter.acquire()
+
+        mock_time.assert_not_called()
+
+    async def test_waits_for_token(self, mock_time: unittest.mock.AsyncMock):
+        limiter = smartlist.client.RateLimiter(2, 1)
+
+        await limiter.acquire()
+        await limiter.acquire()
+
+        mock_time.assert_called_once_with(0.5)
+
+    async def test_block(self, mock_time: unittest.mock.AsyncMock):
+        limiter = smartlist.client.RateLimiter(2, 1)
+
+        limiter.block(5)
+        await limiter.acquire()
+
+        mock_time.assert_called_once_with(5)
+
+
+def test_response_cache():
+    cache = smartlist.client.ResponseCache(2)
+    cache.put("u1", "url1", "etag1", "payload1")
+    cache.put("u2", "url1", "etag2", "payload2")
+
+    assert cache.get("u1", "url1") == ("etag1", "payload1")
+    cache.put("u1", "url2", "etag3", "payload3")
+
+    assert cache.get("u1", "url1") == ("etag1", "payload1")
+    assert cache.get("u2", "url1") is None
+    assert cache.get("u1", "url2") == ("etag3", "payload3")
+
+
+@pytest.mark.parametrize("size, expected_type", (
+    (None, type(None)),
+    ("0", type(None)),
+    ("10", smartlist.client.ResponseCache),
+))
+def test_create_response_cache(size, expected_type):
+    config = configparser.ConfigParser()
+    config.read_dict(dict(http=dict() if size is None else dict(response_cache_size=size)))
+
+    assert isinstance(smartlist.client.create_response_cache(config), expected_type)
+
+
+def test_create_rate_limiter():
+    config = configparser.ConfigParser()
+    config.read_dict(dict(http=dict(requests_per_second="4", request_burst="8")))
+
+    limiter = smartlist.client.create_rate_limiter(config)
+
+    assert limiter._rate == 4
+    assert limiter._burst == 8
+
 
 @pytest.mark.asyncio
 async def test_close(client: smartlist.client.SpotifyClient):
@@ -371,6 +612,18 @@ async def test_close(client: smartlist.client.SpotifyClient):
     client._client_session.close.assert_called_once_with()
 
 
+@pytest.mark.asyncio
+async def test_close_borrowed_client_session():
+    client_session = unittest.mock.AsyncMock()
+    client = smartlist.client.SpotifyClient(
+        None, None, None, smartlist.client.ClientResources(client_session=client_session))
+
+    assert client._get_client_session() == client_session
+    await client.close()
+
+    client_session.close.assert_not_called()
+
+
 @pytest.mark.asyncio
 class TestGetFollowedArtists(object):
 
@@ -392,7 +645,7 @@ class TestGetFollowedArtists(object):
         assert artists == [dict(name="artist1"), dict(name="artist2")]
         client._make_api_call.assert_called_once_with(
             "get", "https://api.spotify.com/v1/me/following?type=artist&limit=50")
-        mock_response.json.assert_called_once_with()
+        mock_response.json.assert_called_once_with(loads=smartlist.serialization.loads)
 
     async def test_multiple_pages(self, client: smartlist.client.SpotifyClient):
         mock_response = unittest.mock.AsyncMock()
@@ -420,16 +673,16 @@ class TestGetFollowedArtists(object):
             unittest.mock.call(
                 "get", "https://api.spotify.com/v1/me/following?type=artist&limit=50"),
             unittest.mock.call().__aenter__(),
-            unittest.mock.call().__aenter__().json(),
+            unittest.mock.call().__aenter__().json(loads=smartlist.serialization.loads),
             unittest.mock.call().__aexit__(None, None, None),
             unittest.mock.call("get", "page 2 url"),
             unittest.mock.call().__aenter__(),
-            unittest.mock.call().__aenter__().json(),
+            unittest.mock.call().__aenter__().json(loads=smartlist.serialization.loads),
             unittest.mock.call().__aexit__(None, None, None),
         ))
 
     async def test_non_200_response(self, client: smartlist.client.SpotifyClient):
-        mock_response = unittest.mock.Mock()
+        mock_response = unittest.mock.AsyncMock()
         mock_response.status = 500
 
         client._make_api_call = unittest.mock.MagicMock()
@@ -451,6 +704,7 @@ class TestGetArtistsById(object):
         mock_response.json.return_value = dict(
             artists=[dict(name="artist2"), dict(name="artist3"), dict(name="artist1")])
 
+        client._config.getint.return_value = 4
         client._make_api_call = unittest.mock.MagicMock()
         client._make_api_call.return_value.__aenter__.return_value = mock_response
 
@@ -458,7 +712,7 @@ class TestGetArtistsById(object):
         artists = await client.get_artists_by_ids(artist_ids)
 
         assert artists == [dict(name="artist1"), dict(name="artist2"), dict(name="artist3")]
-        mock_response.json.assert_called_once_with()
+        mock_response.json.assert_called_once_with(loads=smartlist.serialization.loads)
         client._make_api_call.assert_called_once_with(
             "get",  "https://api.spotify.com/v1/artists?ids=id1,id2,id3")
         client._make_api_call.return_value.__aenter__.assert_called_once_with()
@@ -475,6 +729,7 @@ class TestGetArtistsById(object):
             dict(artists=[dict(name="artist3")]),
         )
 
+        client._config.getint.return_value = 4
         client._make_api_call = unittest.mock.MagicMock()
         client._make_api_call.return_value.__aenter__.return_value = mock_response
 
@@ -482,21 +737,42 @@ class TestGetArtistsById(object):
         artists = await client.get_artists_by_ids(artist_ids)
 
         assert artists == [dict(name="artist1"), dict(name="artist2"), dict(name="artist3")]
+        client._config.getint.assert_called_once_with("http", "batch_concurrency", fallback=4)
         client._make_api_call.assert_has_calls((
             unittest.mock.call("get", "https://api.spotify.com/v1/artists?ids=id1,id2"),
-            unittest.mock.call().__aenter__(),
-            unittest.mock.call().__aenter__().json(),
-            unittest.mock.call().__aexit__(None, None, None),
             unittest.mock.call("get", "https://api.spotify.com/v1/artists?ids=id3"),
-            unittest.mock.call().__aenter__(),
-            unittest.mock.call().__aenter__().json(),
-            unittest.mock.call().__aexit__(None, None, None),
-        ))
+        ), any_order=True)
+
+    async def test_batches_run_concurrently(self,
+                                            monkeypatch: pytest.MonkeyPatch,
+                                            client: smartlist.client.SpotifyClient):
+        monkeypatch.setattr("smartlist.client.ARTIST_IDS_BATCH_SIZE", 1)
+        running = 0
+        max_running = 0
+
+        async def get_page_side_effect(url, error_message):
+            nonlocal running, max_running
+            running += 1
+            max_running = max(max_running, running)
+            await asyncio.sleep(0)
+            running -= 1
+            return dict(artists=[dict(name=url[-3:])])
+
+        client._config.getint.return_value = 2
+        client._get_page = unittest.mock.AsyncMock()
+        client._get_page.side_effect = get_page_side_effect
+
+        artists = await client.get_artists_by_ids(
+            ["spotify:artist:id{}".format(idx) for idx in range(3, 0, -1)])
+
+        assert artists == [dict(name="id1"), dict(name="id2"), dict(name="id3")]
+        assert max_running == 2
 
     async def test_non_200_response(self, client: smartlist.client.SpotifyClient):
         mock_response = unittest.mock.AsyncMock()
         mock_response.status = 500
 
+        client._config.getint.return_value = 4
         client._make_api_call = unittest.mock.MagicMock()
         client._make_api_call.return_value.__aenter__.return_value = mock_response
 
@@ -510,79 +786,116 @@ class TestGetArtistsById(object):
             "get",  "https://api.spotify.com/v1/artists?ids=id1,id2,id3")
         client._make_api_call.return_value.__aenter__.assert_called_once_with()
 
+    async def test_catalog_misses_only(self, client: smartlist.client.SpotifyClient):
+        mock_response = unittest.mock.AsyncMock()
+        mock_response.status = 200
+        mock_response.json.return_value = dict(artists=[dict(name="artist2", uri="id2")])
+
+        client._config.getint.return_value = 4
+        client._make_api_call = unittest.mock.MagicMock()
+        client._make_api_call.return_value.__aenter__.return_value = mock_response
+        client._artist_catalog = unittest.mock.AsyncMock()
+        client._artist_catalog.get_items.return_value = (
+            {
+                "spotify:artist:id3": dict(name="Artist3"),
+                "spotify:artist:id1": dict(name="artist1"),
+            },
+            ["spotify:artist:id2"],
+        )
 
-@pytest.mark.asyncio
-class TestGetSavedAlbums(object):
+        artist_ids = ["spotify:artist:id1", "spotify:artist:id2", "spotify:artist:id3"]
+        artists = await client.get_artists_by_ids(artist_ids)
 
-    @pytest.fixture
-    def mock_album_parse(self, monkeypatch: pytest.MonkeyPatch):
-        mock = unittest.mock.Mock()
-        monkeypatch.setattr("smartlist.client.Album.parse", mock)
-        return mock
+        assert artists == [
+            dict(name="artist1"), dict(name="artist2", uri="id2"), dict(name="Artist3")]
+        client._artist_catalog.get_items.assert_called_once_with(artist_ids)
+        client._make_api_call.assert_called_once_with(
+            "get",  "https://api.spotify.com/v1/artists?ids=id2")
+        client._artist_catalog.save_items.assert_called_once_with(
+            [dict(name="artist2", uri="id2")])
 
-    async def test_single_page(self,
-                               client: smartlist.client.SpotifyClient,
-                               mock_album_parse: unittest.mock.Mock):
-        mock_album_parse.side_effect = ["parsed1", "parsed2"]
+    async def test_catalog_warm(self, client: smartlist.client.SpotifyClient):
+        client._make_api_call = unittest.mock.MagicMock()
+        client._artist_catalog = unittest.mock.AsyncMock()
+        client._artist_catalog.get_items.return_value = (
+            {"spotify:artist:id1": dict(name="artist1")}, [])
+
+        artists = await client.get_artists_by_ids(["spotify:artist:id1"])
+
+        assert artists == [dict(name="artist1")]
+        client._make_api_call.assert_not_called()
+        client._artist_catalog.save_items.assert_called_once_with([])
 
+
+@pytest.mark.asyncio
+class TestGetPage(object):
+
+    async def test_success(self, client: smartlist.client.SpotifyClient):
         mock_response = unittest.mock.AsyncMock()
         mock_response.status = 200
-        mock_response.json.return_value = dict(
-            items=[dict(album="a1"), dict(album="a2")],
-            next=None
-        )
+        mock_response.json.return_value = "payload"
 
         client._make_api_call = unittest.mock.MagicMock()
         client._make_api_call.return_value.__aenter__.return_value = mock_response
 
-        albums = await client.get_saved_albums()
+        assert await client._get_page("url", "Error message") == "payload"
+        client._make_api_call.assert_called_once_with("get", "url")
 
-        assert albums == ["parsed1", "parsed2"]
-        mock_album_parse.assert_has_calls((
-            unittest.mock.call("a1"),
-            unittest.mock.call("a2"),
-        ))
-        client._make_api_call.assert_called_once_with(
-            "get", "https://api.spotify.com/v1/me/albums?limit=50")
-        mock_response.json.assert_called_once_with()
+    async def test_fields(self, client: smartlist.client.SpotifyClient):
+        mock_response = unittest.mock.AsyncMock()
+        mock_response.status = 200
+
+        client._make_api_call = unittest.mock.MagicMock()
+        client._make_api_call.return_value.__aenter__.return_value = mock_response
 
-    async def test_multiple_pages(self,
-                                  client: smartlist.client.SpotifyClient,
-                                  mock_album_parse: unittest.mock.Mock):
-        mock_album_parse.side_effect = ["parsed1", "parsed2", "parsed3"]
+        await client._get_page("url?limit=1", "Error message", fields="snapshot_id")
+        client._make_api_call.assert_called_once_with("get", "url?limit=1&fields=snapshot_id")
 
+    async def test_stores_response_with_etag(self, client: smartlist.client.SpotifyClient):
         mock_response = unittest.mock.AsyncMock()
         mock_response.status = 200
-        mock_response.json.side_effect = (dict(
-            items=[dict(album="a1"), dict(album="a2")],
-            next="page 2 url"
-        ), dict(
-            items=[dict(album="a3")],
-            next=None
-        ))
+        mock_response.headers = {"ETag": "etag"}
+        mock_response.json.return_value = "payload"
 
         client._make_api_call = unittest.mock.MagicMock()
         client._make_api_call.return_value.__aenter__.return_value = mock_response
+        client._request_session.user_info = dict(user_id="user_id")
+        client._response_cache = smartlist.client.ResponseCache(10)
 
-        albums = await client.get_saved_albums()
+        assert await client._get_page("url", "Error message", use_cache=True) == "payload"
+        client._make_api_call.assert_called_once_with("get", "url")
+        assert client._response_cache.get("user_id", "url") == ("etag", "payload")
 
-        assert albums == ["parsed1", "parsed2", "parsed3"]
-        mock_album_parse.assert_has_calls((
-            unittest.mock.call("a1"),
-            unittest.mock.call("a2"),
-            unittest.mock.call("a3"),
-        ))
-        client._make_api_call.assert_has_calls((
-            unittest.mock.call(
-                "get", "https://api.spotify.com/v1/me/albums?limit=50"),
-            unittest.mock.call().__aenter__(),
-            unittest.mock.call().__aenter__().json(),
-            unittest.mock.call().__aexit__(None, None, None),
-            unittest.mock.call("get", "page 2 url"),
-            unittest.mock.call().__aenter__(),
-            unittest.mock.call().__aenter__().json(),
-            unittest.mock.call().__aexit__(None, None, None),
-        ))
+    async def test_not_modified(self, client: smartlist.client.SpotifyClient):
+        mock_response = unittest.mock.AsyncMock()
+        mock_response.status = 304
+
+        client._make_api_call = unittest.mock.MagicMock()
+        client._make_api_call.return_value.__aenter__.return_value = mock_response
+        client._request_session.user_info = dict(user_id="user_id")
+        client._response_cache = smartlist.client.ResponseCache(10)
+        client._response_cache.put("user_id", "url", "etag", "cached_payload")
+
+        assert await client._get_page("url", "Error message", use_cache=True) == "cached_payload"
+        client._make_api_call.assert_called_once_with(
+            "get", "url", headers={"If-None-Match": "etag"})
+        mock_response.json.assert_not_called()
+
+    async def test_cache_not_used(self, client: smartlist.client.SpotifyClient):
+        mock_response = unittest.mock.AsyncMock()
+        mock_response.status = 200
+        mock_response.headers = {"ETag": "etag"}
+        mock_response.json.return_value = "payload"
+
+        client._make_api_call = unittest.mock.MagicMock()
+        client._make_api_call.return_value.__aenter__.return_value = mock_response
+        client._request_session.user_info = dict(user_id="user_id")
+        client._response_cache = smartlist.client.ResponseCache(10)
+        client._response_cache.put("user_id", "url", "old_etag", "cached_payload")
+
+        assert await client._get_page("url", "Error message") == "payload"
+        client._make_api_call.assert_called_once_with("get", "url")
+        assert client._response_cache.get("user_id", "url") == ("old_etag", "cached_payload")
 
     async def test_non_200_response(self, client: smartlist.client.SpotifyClient):
         mock_response = unittest.mock.AsyncMock()
@@ -591,30 +904,542 @@ class TestGetSavedAlbums(object):
         client._make_api_call = unittest.mock.MagicMock()
         client._make_api_call.return_value.__aenter__.return_value = mock_response
 
-        with pytest.raises(smartlist.client.SpotifyApiException,
-                           match="Error getting saved albums"):
-            await client.get_saved_albums()
+        with pytest.raises(smartlist.client.SpotifyApiException, match="Error message"):
+            await client._get_page("url", "Error message")
 
-        client._make_api_call.assert_called_once_with(
-            "get", "https://api.spotify.com/v1/me/albums?limit=50")
+        mock_response.json.assert_not_called()
 
 
 @pytest.mark.asyncio
-class TestGetSavedTracks(object):
+class TestIterSavedItemPages(object):
+
+    async def test_single_page(self, client: smartlist.client.SpotifyClient):
+        client._get_page = unittest.mock.AsyncMock()
+        client._get_page.return_value = dict(items=["i1", "i2"], next=None, limit=2, total=2)
+
+        pages = await collect(client._iter_saved_item_pages("url", "Error message"))
+
+        assert pages == [["i1", "i2"]]
+        client._get_page.assert_called_once_with("url", "Error message", use_cache=True)
+
+    async def test_multiple_pages(self, client: smartlist.client.SpotifyClient):
+        client._config.getint.return_value = 2
+        pages = {
+            "url": dict(items=["i1", "i2"], next="next url", limit=2, total=5),
+            "url&offset=2": dict(items=["i3", "i4"]),
+            "url&offset=4": dict(items=["i5"]),
+        }
+
+        async def get_page_side_effect(url, error_message, use_cache=False):
+            # finish later pages first to check the order is preserved
+            await asyncio.sleep(0.01 if url == "url&offset=2" else 0)
+            return pages[url]
+
+        client._get_page = unittest.mock.AsyncMock()
+        client._get_page.side_effect = get_page_side_effect
+
+        result = await collect(client._iter_saved_item_pages("url", "Error message"))
+
+        assert result == [["i1", "i2"], ["i3", "i4"], ["i5"]]
+        client._config.getint.assert_called_once_with("sync", "page_concurrency", fallback=4)
+        client._get_page.assert_has_calls((
+            unittest.mock.call("url", "Error message", use_cache=True),
+            unittest.mock.call("url&offset=2", "Error message"),
+            unittest.mock.call("url&offset=4", "Error message"),
+        ))
+
+    async def test_closing_cancels_pending_pages(self, client: smartlist.client.SpotifyClient):
+        client._config.getint.return_value = 1
+        page_started = asyncio.Event()
+
+        async def get_page_side_effect(url, error_message, use_cache=False):
+            if url == "url":
+                return dict(items=["i1"], next="next url", limit=1, total=3)
+            page_started.set()
+            await asyncio.sleep(10)
+
+        client._get_page = unittest.mock.AsyncMock()
+        client._get_page.side_effect = get_page_side_effect
+
+        pages = client._iter_saved_item_pages("url", "Error message")
+        assert await pages.__anext__() == ["i1"]
+        next_page = asyncio.ensure_future(pages.__anext__())
+        await page_started.wait()
+        next_page.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await next_page
+        await pages.aclose()
+        await asyncio.sleep(0)
+
+        assert asyncio.all_tasks() == {asyncio.current_task()}
+
+
+@pytest.mark.asyncio
+class TestPageSavedItems(object):
+
+    def build_item(self, uri, added_at="added_at"):
+        return dict(added_at=added_at, album=dict(uri=uri))
+
+    async def test_stops_at_known_item(self, client: smartlist.client.SpotifyClient):
+        client._get_page = unittest.mock.AsyncMock()
+        client._get_page.side_effect = (dict(
+            items=[self.build_item("a1")],
+            next="page 2 url",
+            total=10,
+        ), dict(
+            items=[self.build_item("a2"), self.build_item("a3", "old"), self.build_item("a4")],
+            next="page 3 url",
+            total=10,
+        ))
+
+        items, total = await client._page_saved_items(
+            "url", "album", "Error message", {("a3", "old")})
+
+        assert items == [self.build_item("a1"), self.build_item("a2")]
+        assert total == 10
+        client._get_page.assert_has_calls((
+            unittest.mock.call("url", "Error message", use_cache=True),
+            unittest.mock.call("page 2 url", "Error message"),
+        ))
+
+    async def test_known_items_not_reached(self, client: smartlist.client.SpotifyClient):
+        client._get_page = unittest.mock.AsyncMock()
+        client._get_page.return_value = dict(
+            items=[self.build_item("a1")],
+            next=None,
+            total=1,
+        )
+
+        items, total = await client._page_saved_items(
+            "url", "album", "Error message", {("a3", "old")})
+
+        assert items == [self.build_item("a1")]
+        assert total == 1
+        client._get_page.assert_called_once_with("url", "Error message", use_cache=True)
+
+
+@pytest.mark.asyncio
+class TestIterSavedItems(object):
 
     @pytest.fixture
-    def mock_album_parse(self, monkeypatch: pytest.MonkeyPatch):
-        mock = unittest.mock.Mock()
-        monkeypatch.setattr("smartlist.client.Album.parse", mock)
-        return mock
+    def mock_datetime_now(self, monkeypatch: pytest.MonkeyPatch):
+        now = datetime.datetime(2021, 6, 2, tzinfo=datetime.timezone.utc)
+        mock_datetime_datetime = unittest.mock.Mock(wraps=datetime.datetime)
+        mock_datetime_datetime.now.return_value = now
+        monkeypatch.setattr("smartlist.client.datetime.datetime", mock_datetime_datetime)
+        return now
+
+    def build_item(self, uri, added_at="added_at"):
+        return dict(added_at=added_at, album=dict(uri=uri))
+
+    async def test_full_pass_without_snapshot(self,
+                                              client: smartlist.client.SpotifyClient,
+                                              mock_datetime_now: datetime.datetime):
+        items = [self.build_item("a1"), self.build_item("a2")]
+        client._request_session.user_info = dict(user_id="user_id")
+        client._db.get_library_last_full_sync.return_value = None
+        client._db.get_library_keys.return_value = []
+        client._iter_saved_item_pages = unittest.mock.Mock()
+        client._iter_saved_item_pages.return_value = iter_pages([items[0]], [items[1]])
+
+        result = await collect(client._iter_saved_items(
+            "albums", "url", "album", "Error message", False, dict))
+
+        assert result == [[items[0]], [items[1]]]
+        assert client._library_changes == dict(albums=[])
+        client._db.get_library_last_full_sync.assert_called_once_with("user_id", "albums")
+        client._db.get_library_keys.assert_called_once_with("user_id", "albums")
+        client._db.get_library_items.assert_not_called()
+        client._db.get_library_items_by_uri.assert_not_called()
+        client._iter_saved_item_pages.assert_called_once_with("url", "Error message")
+        client._db.clear_library_staging.assert_called_once_with("user_id", "albums")
+        client._db.stage_library_items.assert_has_calls((
+            unittest.mock.call("user_id", "albums", [("a1", "added_at", items[0])]),
+            unittest.mock.call("user_id", "albums", [("a2", "added_at", items[1])]),
+        ))
+        client._db.commit_library_staging.assert_called_once_with(
+            "user_id", "albums", mock_datetime_now.isoformat())
+        client._db.save_library_items.assert_not_called()
+
+    async def test_full_pass_stages_after_yield(self,
+                                                client: smartlist.client.SpotifyClient,
+                                                mock_datetime_now: datetime.datetime):
+        client._request_session.user_info = dict(user_id="user_id")
+        client._db.get_library_last_full_sync.return_value = None
+        client._db.get_library_keys.return_value = []
+        client._iter_saved_item_pages = unittest.mock.Mock()
+        client._iter_saved_item_pages.return_value = iter_pages([self.build_item("a1")])
+
+        async for page in client._iter_saved_items(
+                "albums", "url", "album", "Error message", False, dict):
+            client._db.stage_library_items.assert_not_called()
+            page[0]["album"]["tracks"] = "completed"
+
+        client._db.stage_library_items.assert_called_once_with("user_id", "albums", [
+            ("a1", "added_at", dict(added_at="added_at", album=dict(uri="a1", tracks="completed"))),
+        ])
+
+    async def test_full_pass_when_snapshot_expired(self,
+                                                   client: smartlist.client.SpotifyClient,
+                                                   mock_datetime_now: datetime.datetime):
+        client._request_session.user_info = dict(user_id="user_id")
+        client._config.getint.return_value = 24
+        client._db.get_library_last_full_sync.return_value = (
+            mock_datetime_now - datetime.timedelta(hours=25)).isoformat()
+        client._db.get_library_keys.return_value = [("a1", "old"), ("a2", "old")]
+        client._db.get_library_items_by_uri.return_value = [self.build_item("a1", "old")]
+        client._page_saved_items = unittest.mock.AsyncMock()
+        client._iter_saved_item_pages = unittest.mock.Mock()
+        client._iter_saved_item_pages.return_value = iter_pages(
+            [self.build_item("a2", "old"), self.build_item("a3", "new")])
+
+        await collect(client._iter_saved_items(
+            "albums", "url", "album", "Error message", False, dict))
+
+        client._config.getint.assert_called_once_with(
+            "sync", "library_full_sync_hours", fallback=24)
+        client._page_saved_items.assert_not_called()
+        client._iter_saved_item_pages.assert_called_once_with("url", "Error message")
+        client._db.stage_library_items.assert_called_once_with(
+            "user_id", "albums", [
+                ("a2", "old", self.build_item("a2", "old")),
+                ("a3", "new", self.build_item("a3", "new")),
+            ])
+        client._db.get_library_items_by_uri.assert_called_once_with("user_id", "albums", ["a1"])
+        client._db.commit_library_staging.assert_called_once_with(
+            "user_id", "albums", mock_datetime_now.isoformat())
+        assert client._library_changes == dict(
+            albums=[self.build_item("a3", "new"), self.build_item("a1", "old")])
+
+    async def test_incremental(self,
+                               client: smartlist.client.SpotifyClient,
+                               mock_datetime_now: datetime.datetime):
+        client._request_session.user_info = dict(user_id="user_id")
+        client._config.getint.return_value = 24
+        client._db.get_library_last_full_sync.return_value = (
+            mock_datetime_now - datetime.timedelta(hours=1)).isoformat()
+        client._db.get_library_keys.return_value = [("a2", "old"), ("a3", "old")]
+        client._db.get_library_items.side_effect = (
+            [("a1", self.build_item("a1", "new")), ("a2", self.build_item("a2", "old"))],
+            [("a3", self.build_item("a3", "new"))],
+            [],
+        )
+        client._page_saved_items = unittest.mock.AsyncMock()
+        client._page_saved_items.return_value = (
+            [self.build_item("a1", "new"), self.build_item("a3", "new")], 3)
+
+        result = await collect(client._iter_saved_items(
+            "albums", "url", "album", "Error message", False, dict))
+
+        assert result == [
+            [self.build_item("a1", "new"), self.build_item("a3", "new")],
+            [self.build_item("a2", "old")],
+            [],
+        ]
+        assert client._library_changes == dict(
+            albums=[self.build_item("a1", "new"), self.build_item("a3", "new")])
+        client._db.get_library_keys.assert_called_once_with("user_id", "albums")
+        client._db.get_library_items.assert_has_calls((
+            unittest.mock.call("user_id", "albums", ""),
+            unittest.mock.call("user_id", "albums", "a2"),
+            unittest.mock.call("user_id", "albums", "a3"),
+        ))
+        client._page_saved_items.assert_called_once_with(
+            "url", "album", "Error message", {("a2", "old"), ("a3", "old")})
+        client._db.save_library_items.assert_called_once_with(
+            "user_id", "albums", [
+                ("a1", "new", self.build_item("a1", "new")),
+                ("a3", "new", self.build_item("a3", "new")),
+            ])
+        client._db.clear_library_staging.assert_not_called()
+
+    async def test_incremental_saves_after_yield(self,
+                                                 client: smartlist.client.SpotifyClient,
+                                                 mock_datetime_now: datetime.datetime):
+        client._request_session.user_info = dict(user_id="user_id")
+        client._config.getint.return_value = 24
+        client._db.get_library_last_full_sync.return_value = (
+            mock_datetime_now - datetime.timedelta(hours=1)).isoformat()
+        client._db.get_library_keys.return_value = []
+        client._db.get_library_items.return_value = []
+        client._page_saved_items = unittest.mock.AsyncMock()
+        client._page_saved_items.return_value = ([self.build_item("a1", "new")], 1)
+
+        async for page in client._iter_saved_items(
+                "albums", "url", "album", "Error message", False, dict):
+            if len(page) > 0:
+                client._db.save_library_items.assert_not_called()
+                page[0]["album"]["tracks"] = "completed"
+
+        client._db.save_library_items.assert_called_once_with("user_id", "albums", [
+            ("a1", "new", dict(added_at="new", album=dict(uri="a1", tracks="completed"))),
+        ])
+
+    async def test_incremental_total_mismatch(self,
+                                              client: smartlist.client.SpotifyClient,
+                                              mock_datetime_now: datetime.datetime):
+        client._request_session.user_info = dict(user_id="user_id")
+        client._config.getint.return_value = 24
+        client._db.get_library_last_full_sync.return_value = (
+            mock_datetime_now - datetime.timedelta(hours=1)).isoformat()
+        client._db.get_library_keys.return_value = [("a2", "old"), ("a3", "old")]
+        client._db.get_library_items_by_uri.return_value = [self.build_item("a3", "old")]
+        client._page_saved_items = unittest.mock.AsyncMock()
+        client._page_saved_items.return_value = ([self.build_item("a1", "new")], 2)
+        client._iter_saved_item_pages = unittest.mock.Mock()
+        client._iter_saved_item_pages.return_value = iter_pages(
+            [self.build_item("a1", "new"), self.build_item("a2", "old")])
+
+        result = await collect(client._iter_saved_items(
+            "albums", "url", "album", "Error message", False, dict))
+
+        assert result == [[self.build_item("a1", "new"), self.build_item("a2", "old")]]
+        assert client._library_changes == dict(
+            albums=[self.build_item("a1", "new"), self.build_item("a3", "old")])
+        client._page_saved_items.assert_called_once_with(
+            "url", "album", "Error message", {("a2", "old"), ("a3", "old")})
+        client._iter_saved_item_pages.assert_called_once_with("url", "Error message")
+        client._db.save_library_items.assert_not_called()
+        client._db.stage_library_items.assert_called_once_with(
+            "user_id", "albums", [
+                ("a1", "new", self.build_item("a1", "new")),
+                ("a2", "old", self.build_item("a2", "old")),
+            ])
+        client._db.get_library_items_by_uri.assert_called_once_with("user_id", "albums", ["a3"])
+        client._db.commit_library_staging.assert_called_once_with(
+            "user_id", "albums", mock_datetime_now.isoformat())
+
+
+@pytest.mark.asyncio
+async def test_iter_saved_items_from_snapshot(client: smartlist.client.SpotifyClient):
+    client._request_session.user_info = dict(user_id="user_id")
+    client._page_saved_items = unittest.mock.AsyncMock()
+    client._db.get_library_items.side_effect = ([("u1", "item1"), ("u2", "item2")], [])
+
+    assert await collect(client._iter_saved_items(
+        "albums", "url", "album", "Error message", True, dict)) == [["item1", "item2"]]
+
+    assert client._library_changes == dict(albums=[])
+    client._db.get_library_items.assert_has_calls((
+        unittest.mock.call("user_id", "albums", ""),
+        unittest.mock.call("user_id", "albums", "u2"),
+    ))
+    client._db.get_library_keys.assert_not_called()
+    client._db.get_library_last_full_sync.assert_not_called()
+    client._page_saved_items.assert_not_called()
+    client._db.save_library_items.assert_not_called()
+
+
+@pytest.mark.asyncio
+class TestIsSavedItemsUnchanged(object):
 
     @pytest.fixture
-    def mock_track_parse(self, monkeypatch: pytest.MonkeyPatch):
-        mock = unittest.mock.Mock()
-        monkeypatch.setattr("smartlist.client.Track.parse", mock)
-        return mock
+    def probe_client(self, client: smartlist.client.SpotifyClient):
+        client._request_session.user_info = dict(user_id="user_id")
+        client._config.getint.return_value = 24
+        client._db.get_library_last_full_sync.return_value = (
+            datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=1)).isoformat()
+        client._db.get_library_summary.return_value = (2, "newest")
+        client._get_page = unittest.mock.AsyncMock()
+        return client
+
+    async def test_unchanged(self, probe_client: smartlist.client.SpotifyClient):
+        probe_client._get_page.return_value = dict(total=2, items=[dict(added_at="newest")])
+
+        assert await probe_client._is_saved_items_unchanged("albums", "url", "Error message")
+
+        probe_client._get_page.assert_called_once_with("url", "Error message")
+        probe_client._db.get_library_summary.assert_called_once_with("user_id", "albums")
+
+    @pytest.mark.parametrize("payload", (
+        dict(total=3, items=[dict(added_at="newest")]),
+        dict(total=2, items=[dict(added_at="newer")]),
+        dict(total=0, items=[]),
+    ))
+    async def test_changed(self, payload: dict, probe_client: smartlist.client.SpotifyClient):
+        probe_client._get_page.return_value = payload
+
+        assert not await probe_client._is_saved_items_unchanged("albums", "url", "Error message")
 
-    def build_track(self, name, album):
+    async def test_empty_library(self, probe_client: smartlist.client.SpotifyClient):
+        probe_client._get_page.return_value = dict(total=0, items=[])
+        probe_client._db.get_library_summary.return_value = (0, None)
+
+        assert await probe_client._is_saved_items_unchanged("albums", "url", "Error message")
+
+    async def test_snapshot_expired(self, probe_client: smartlist.client.SpotifyClient):
+        probe_client._db.get_library_last_full_sync.return_value = (
+            datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(hours=25)).isoformat()
+
+        assert not await probe_client._is_saved_items_unchanged("albums", "url", "Error message")
+
+        probe_client._get_page.assert_not_called()
+
+    async def test_no_snapshot(self, probe_client: smartlist.client.SpotifyClient):
+        probe_client._db.get_library_last_full_sync.return_value = None
+
+        assert not await probe_client._is_saved_items_unchanged("albums", "url", "Error message")
+
+        probe_client._get_page.assert_not_called()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("results, expected", (
+    ((True, True), True),
+    ((True, False), False),
+    ((False, True), False),
+))
+async def test_is_library_unchanged(results, expected, client: smartlist.client.SpotifyClient):
+    client._is_saved_items_unchanged = unittest.mock.AsyncMock()
+    client._is_saved_items_unchanged.side_effect = results
+
+    assert await client.is_library_unchanged() == expected
+
+    client._is_saved_items_unchanged.assert_has_calls((
+        unittest.mock.call(
+            "albums", "https://api.spotify.com/v1/me/albums?limit=1", "Error probing saved albums"),
+        unittest.mock.call(
+            "tracks", "https://api.spotify.com/v1/me/tracks?limit=1", "Error probing saved tracks"),
+    ))
+
+
+@pytest.mark.asyncio
+class TestCompleteAlbumTracks(object):
+
+    def build_album(self, uri, items, total, next_url="next"):
+        return dict(uri=uri, tracks=dict(items=items, next=next_url, total=total))
+
+    async def test_complete_albums_skipped(self, client: smartlist.client.SpotifyClient):
+        client._album_catalog = unittest.mock.AsyncMock()
+        client._fetch_album_tracks = unittest.mock.AsyncMock()
+
+        await client._complete_album_tracks([self.build_album("al1", ["t1"], 1, None)])
+
+        client._album_catalog.get_items.assert_not_called()
+        client._fetch_album_tracks.assert_not_called()
+
+    async def test_uses_catalog(self, client: smartlist.client.SpotifyClient):
+        album1 = self.build_album("al1", ["t1"], 2)
+        album2 = self.build_album("al2", ["t1"], 2)
+        album3 = self.build_album("al3", ["t1"], 1, None)
+        client._config.getint.return_value = 4
+        client._album_catalog = unittest.mock.AsyncMock()
+        client._album_catalog.get_items.return_value = (
+            dict(al1=dict(uri="al1", tracks=["t1", "cached"])), ["al2"])
+        client._fetch_album_tracks = unittest.mock.AsyncMock()
+        client._fetch_album_tracks.return_value = dict(uri="al2", tracks=["t1", "fetched"])
+
+        await client._complete_album_tracks([album1, album2, album3])
+
+        client._album_catalog.get_items.assert_called_once_with(["al1", "al2"])
+        client._fetch_album_tracks.assert_called_once_with(album2, unittest.mock.ANY)
+        client._album_catalog.save_items.assert_called_once_with(
+            [dict(uri="al2", tracks=["t1", "fetched"])])
+        assert album1["tracks"] == dict(items=["t1", "cached"], next=None, total=2)
+        assert album2["tracks"] == dict(items=["t1", "fetched"], next=None, total=2)
+        assert album3["tracks"] == dict(items=["t1"], next=None, total=1)
+
+    async def test_without_catalog(self, client: smartlist.client.SpotifyClient):
+        album = self.build_album("al1", ["t1"], 2)
+        client._config.getint.return_value = 4
+        client._fetch_album_tracks = unittest.mock.AsyncMock()
+        client._fetch_album_tracks.return_value = dict(uri="al1", tracks=["t1", "t2"])
+
+        await client._complete_album_tracks([album])
+
+        client._fetch_album_tracks.assert_called_once_with(album, unittest.mock.ANY)
+        assert album["tracks"]["items"] == ["t1", "t2"]
+
+    async def test_page_concurrency_shared(self,
+                                           monkeypatch: pytest.MonkeyPatch,
+                                           client: smartlist.client.SpotifyClient):
+        monkeypatch.setattr("smartlist.client.project_track", str.upper)
+        running = 0
+        max_running = 0
+
+        async def get_page(*args):
+            nonlocal running, max_running
+            running += 1
+            max_running = max(max_running, running)
+            await asyncio.sleep(0)
+            running -= 1
+            return dict(items=["t"])
+
+        client._config.getint.return_value = 2
+        client._get_page = unittest.mock.AsyncMock()
+        client._get_page.side_effect = get_page
+        albums = [self.build_album("spotify:album:al{}".format(idx), ["t"], 101)
+                  for idx in range(4)]
+
+        await client._complete_album_tracks(albums)
+
+        assert client._get_page.call_count == 8
+        assert max_running == 2
+        client._config.getint.assert_called_once_with("sync", "page_concurrency", fallback=4)
+
+
+@pytest.mark.asyncio
+async def test_fetch_album_tracks(monkeypatch: pytest.MonkeyPatch,
+                                  client: smartlist.client.SpotifyClient):
+    monkeypatch.setattr("smartlist.client.project_track", str.upper)
+    client._get_page = unittest.mock.AsyncMock()
+    client._get_page.side_effect = (dict(items=["t51"]), dict(items=["t101"]))
+
+    listing = await client._fetch_album_tracks(dict(
+        uri="spotify:album:al1",
+        tracks=dict(items=["t1"] * 50, next="next", total=101),
+    ), asyncio.Semaphore(2))
+
+    assert listing == dict(uri="spotify:album:al1", tracks=["t1"] * 50 + ["T51", "T101"])
+    client._get_page.assert_has_calls((
+        unittest.mock.call("https://api.spotify.com/v1/albums/al1/tracks?limit=50&offset=50",
+                           "Error getting album tracks"),
+        unittest.mock.call("https://api.spotify.com/v1/albums/al1/tracks?limit=50&offset=100",
+                           "Error getting album tracks"),
+    ))
+
+
+@pytest.mark.asyncio
+async def test_iter_saved_albums(monkeypatch: pytest.MonkeyPatch,
+                                 client: smartlist.client.SpotifyClient):
+    mock_album_parse = unittest.mock.Mock()
+    mock_album_parse.side_effect = ["parsed1", "parsed2"]
+    monkeypatch.setattr("smartlist.client.Album.parse", mock_album_parse)
+
+    client._complete_album_tracks = unittest.mock.AsyncMock()
+    client._iter_saved_items = unittest.mock.Mock()
+    client._iter_saved_items.return_value = iter_pages([dict(album="a1")], [dict(album="a2")])
+
+    albums = await collect(client.iter_saved_albums())
+
+    assert albums == [["parsed1"], ["parsed2"]]
+    client._complete_album_tracks.assert_has_calls((
+        unittest.mock.call(["a1"]),
+        unittest.mock.call(["a2"]),
+    ))
+    mock_album_parse.assert_has_calls((
+        unittest.mock.call("a1"),
+        unittest.mock.call("a2"),
+    ))
+    client._iter_saved_items.assert_called_once_with(
+        "albums",
+        "https://api.spotify.com/v1/me/albums?limit=50",
+        "album",
+        "Error getting saved albums",
+        False,
+        smartlist.client.project_saved_album,
+    )
+
+
+@pytest.mark.asyncio
+async def test_iter_saved_tracks(monkeypatch: pytest.MonkeyPatch,
+                                 client: smartlist.client.SpotifyClient):
+    mock_album_parse = unittest.mock.Mock()
+    monkeypatch.setattr("smartlist.client.Album.parse", mock_album_parse)
+    mock_track_parse = unittest.mock.Mock()
+    monkeypatch.setattr("smartlist.client.Track.parse", mock_track_parse)
+
+    def build_track(name, album):
         return dict(
             track=dict(
                 name=name,
@@ -625,106 +1450,152 @@ class TestGetSavedTracks(object):
             ),
         )
 
-    async def test_single_page(self,
-                               client: smartlist.client.SpotifyClient,
-                               mock_album_parse: unittest.mock.Mock,
-                               mock_track_parse: unittest.mock.Mock):
-        mock_album1 = unittest.mock.Mock()
-        mock_album2 = unittest.mock.Mock()
-        mock_album_parse.side_effect = [mock_album1, mock_album2]
-        mock_track_parse.side_effect = ["a1t1", "a1t2", "a2t1"]
-
-        a1t1 = self.build_track("a1t1", "album1")
-        a1t2 = self.build_track("a1t2", "album1")
-        a2t1 = self.build_track("a2t1", "album2")
-        mock_response = unittest.mock.AsyncMock()
-        mock_response.status = 200
-        mock_response.json.return_value = dict(
-            items=[a1t1, a1t2, a2t1],
-            next=None
-        )
+    mock_album1 = unittest.mock.Mock()
+    mock_album2 = unittest.mock.Mock()
+    mock_album_parse.side_effect = [mock_album1, mock_album2]
+    mock_track_parse.side_effect = ["a1t1", "a2t1", "a1t2"]
 
-        client._make_api_call = unittest.mock.MagicMock()
-        client._make_api_call.return_value.__aenter__.return_value = mock_response
+    a1t1 = build_track("a1t1", "album1")
+    a1t2 = build_track("a1t2", "album1")
+    a2t1 = build_track("a2t1", "album2")
+    client._iter_saved_items = unittest.mock.Mock()
+    client._iter_saved_items.return_value = iter_pages([a1t1, a2t1, a1t2])
 
-        albums = await client.get_saved_tracks()
+    albums = await collect(client.iter_saved_tracks())
 
-        assert albums == [mock_album1, mock_album2]
-        mock_album_parse.assert_has_calls((
-            unittest.mock.call(a1t1["track"]["album"]),
-            unittest.mock.call(a2t1["track"]["album"]),
-        ))
-        mock_track_parse.assert_has_calls((
-            unittest.mock.call(mock_album1, a1t1["track"]),
-            unittest.mock.call(mock_album1, a1t2["track"]),
-            unittest.mock.call(mock_album2, a2t1["track"]),
-        ))
-        client._make_api_call.assert_called_once_with(
-            "get", "https://api.spotify.com/v1/me/tracks?limit=50")
-        mock_response.json.assert_called_once_with()
-
-    async def test_multiple_pages(self,
-                                  client: smartlist.client.SpotifyClient,
-                                  mock_album_parse: unittest.mock.Mock,
-                                  mock_track_parse: unittest.mock.Mock):
-        mock_album1 = unittest.mock.Mock()
-        mock_album2 = unittest.mock.Mock()
-        mock_album_parse.side_effect = [mock_album1, mock_album2]
-        mock_track_parse.side_effect = ["a1t1", "a1t2", "a2t1"]
-
-        a1t1 = self.build_track("a1t1", "album1")
-        a1t2 = self.build_track("a1t2", "album1")
-        a2t1 = self.build_track("a2t1", "album2")
-        mock_response = unittest.mock.AsyncMock()
-        mock_response.status = 200
-        mock_response.json.side_effect = (dict(
-            items=[a1t1, a2t1],
-            next="page 2 url"
-        ), dict(
-            items=[a1t2],
-            next=None
-        ))
+    assert albums == [[mock_album1, mock_album2]]
+    mock_album_parse.assert_has_calls((
+        unittest.mock.call(a1t1["track"]["album"]),
+        unittest.mock.call(a2t1["track"]["album"]),
+    ))
+    mock_track_parse.assert_has_calls((
+        unittest.mock.call(mock_album1, a1t1["track"]),
+        unittest.mock.call(mock_album2, a2t1["track"]),
+        unittest.mock.call(mock_album1, a1t2["track"]),
+    ))
+    mock_album1.add_track.assert_has_calls((
+        unittest.mock.call("a1t1"),
+        unittest.mock.call("a1t2"),
+    ))
+    mock_album2.add_track.assert_called_once_with("a2t1")
+    client._iter_saved_items.assert_called_once_with(
+        "tracks",
+        "https://api.spotify.com/v1/me/tracks?limit=50",
+        "track",
+        "Error getting saved tracks",
+        False,
+        smartlist.client.project_saved_track,
+    )
 
-        client._make_api_call = unittest.mock.MagicMock()
-        client._make_api_call.return_value.__aenter__.return_value = mock_response
 
-        albums = await client.get_saved_tracks()
+@pytest.mark.asyncio
+async def test_iter_saved_items_projects_items(client: smartlist.client.SpotifyClient):
+    client._request_session.user_info = dict(user_id="user_id")
+    client._db.get_library_last_full_sync.return_value = None
+    client._db.get_library_keys.return_value = []
+    client._iter_saved_item_pages = unittest.mock.Mock()
+    client._iter_saved_item_pages.return_value = iter_pages(
+        [dict(added_at="added_at", album=dict(uri="a1"), popularity=10)])
 
-        assert albums == [mock_album1, mock_album2]
-        mock_album_parse.assert_has_calls((
-            unittest.mock.call(a1t1["track"]["album"]),
-            unittest.mock.call(a2t1["track"]["album"]),
-        ))
-        mock_track_parse.assert_has_calls((
-            unittest.mock.call(mock_album1, a1t1["track"]),
-            unittest.mock.call(mock_album2, a2t1["track"]),
-            unittest.mock.call(mock_album1, a1t2["track"]),
-        ))
-        client._make_api_call.assert_has_calls((
-            unittest.mock.call(
-                "get", "https://api.spotify.com/v1/me/tracks?limit=50"),
-            unittest.mock.call().__aenter__(),
-            unittest.mock.call().__aenter__().json(),
-            unittest.mock.call().__aexit__(None, None, None),
-            unittest.mock.call("get", "page 2 url"),
-            unittest.mock.call().__aenter__(),
-            unittest.mock.call().__aenter__().json(),
-            unittest.mock.call().__aexit__(None, None, None),
-        ))
+    result = await collect(client._iter_saved_items(
+        "albums", "url", "album", "Error message", False,
+        lambda item: dict(added_at=item["added_at"], album=item["album"])))
 
-    async def test_non_200_response(self, client: smartlist.client.SpotifyClient):
-        mock_response = unittest.mock.AsyncMock()
-        mock_response.status = 500
+    assert result == [[dict(added_at="added_at", album=dict(uri="a1"))]]
+    client._db.stage_library_items.assert_called_once_with(
+        "user_id", "albums",
+        [("a1", "added_at", dict(added_at="added_at", album=dict(uri="a1")))])
 
-        client._make_api_call = unittest.mock.MagicMock()
-        client._make_api_call.return_value.__aenter__.return_value = mock_response
 
-        with pytest.raises(smartlist.client.SpotifyApiException,
-                           match="Error getting saved tracks"):
-            await client.get_saved_tracks()
+def _raw_artist(uri):
+    return dict(name=uri, uri=uri, href="href", external_urls=dict())
+
+
+def _raw_track(uri):
+    return dict(name=uri, uri=uri, disc_number=1, track_number=2, artists=[_raw_artist("ar1")],
+                available_markets=["US"], preview_url="preview")
+
+
+def _raw_album(uri, **kwargs):
+    return dict(name=uri, uri=uri, release_date="2021", release_date_precision="year",
+                artists=[_raw_artist("ar1")], images=[dict(url="image")], popularity=50,
+                **kwargs)
 
-        client._make_api_call.assert_called_once_with(
-            "get", "https://api.spotify.com/v1/me/tracks?limit=50")
+
+def test_project_saved_album():
+    saved_album = dict(added_at="added_at", album=_raw_album(
+        "al1", tracks=dict(items=[_raw_track("t1")], next="next", total=2, href="href")))
+
+    projected = smartlist.client.project_saved_album(saved_album)
+
+    assert projected == dict(added_at="added_at", album=dict(
+        name="al1", uri="al1", release_date="2021", release_date_precision="year",
+        artists=[dict(name="ar1", uri="ar1")],
+        tracks=dict(
+            items=[dict(name="t1", uri="t1", disc_number=1, track_number=2,
+                        artists=[dict(name="ar1", uri="ar1")])],
+            next="next",
+            total=2,
+        ),
+    ))
+    album = smartlist.client.Album.parse(projected["album"])
+    assert list(album.tracks) == ["t1"]
+
+
+def test_project_saved_track():
+    saved_track = dict(added_at="added_at", track=dict(_raw_track("t1"), album=_raw_album("al1")))
+
+    projected = smartlist.client.project_saved_track(saved_track)
+
+    assert projected == dict(added_at="added_at", track=dict(
+        name="t1", uri="t1", disc_number=1, track_number=2,
+        artists=[dict(name="ar1", uri="ar1")],
+        album=dict(name="al1", uri="al1", release_date="2021", release_date_precision="year",
+                   artists=[dict(name="ar1", uri="ar1")]),
+    ))
+
+
+@pytest.mark.parametrize("url, fields, expected", (
+    ("url", None, "url"),
+    ("url", "a,b(c)", "url?fields=a,b(c)"),
+    ("url?limit=1", "a", "url?limit=1&fields=a"),
+))
+def test_add_fields(url, fields, expected):
+    assert smartlist.client.add_fields(url, fields) == expected
+
+
+def test_get_library_changes(monkeypatch: pytest.MonkeyPatch,
+                             client: smartlist.client.SpotifyClient):
+    mock_album_parse = unittest.mock.Mock()
+    mock_album_parse.return_value = "album"
+    monkeypatch.setattr("smartlist.client.Album.parse", mock_album_parse)
+    mock_group_saved_tracks = unittest.mock.Mock()
+    mock_group_saved_tracks.return_value = ["track_album"]
+    monkeypatch.setattr("smartlist.client.group_saved_tracks", mock_group_saved_tracks)
+
+    assert client.get_library_changes() == ["track_album"]
+    mock_group_saved_tracks.assert_called_once_with([])
+
+    client._library_changes = dict(albums=[dict(album="raw_album")], tracks=["saved_track"])
+    assert client.get_library_changes() == ["album", "track_album"]
+    mock_album_parse.assert_called_once_with("raw_album")
+    mock_group_saved_tracks.assert_called_with(["saved_track"])
+
+
+@pytest.mark.asyncio
+async def test_get_user_playlists(client: smartlist.client.SpotifyClient):
+    client._get_page = unittest.mock.AsyncMock()
+    client._get_page.side_effect = (
+        dict(items=[dict(uri="p1", snapshot_id="s1")], next="next url"),
+        dict(items=[dict(uri="p2", snapshot_id="s2")], next=None),
+    )
+
+    assert await client.get_user_playlists() == dict(p1="s1", p2="s2")
+    client._get_page.assert_has_calls((
+        unittest.mock.call("https://api.spotify.com/v1/me/playlists?limit=50",
+                           "Error getting user playlists", use_cache=True),
+        unittest.mock.call("next url", "Error getting user playlists", use_cache=True),
+    ))
 
 
 @pytest.mark.asyncio
@@ -746,10 +1617,20 @@ class TestGetPlaylist(object):
                 "get",
                 "https://api.spotify.com/v1/playlists/playlist_id"),
             unittest.mock.call().__aenter__(),
-            unittest.mock.call().__aenter__().json(),
+            unittest.mock.call().__aenter__().json(loads=smartlist.serialization.loads),
             unittest.mock.call().__aexit__(None, None, None),
         ))
 
+    async def test_fields(self, client: smartlist.client.SpotifyClient):
+        client._get_page = unittest.mock.AsyncMock()
+
+        resp = await client.get_playlist("spotify:playlist:playlist_id", fields="snapshot_id")
+
+        assert resp == client._get_page.return_value
+        client._get_page.assert_called_once_with(
+            "https://api.spotify.com/v1/playlists/playlist_id", "Error getting playlist",
+            use_cache=True, fields="snapshot_id")
+
     async def test_non_201_response(self, client: smartlist.client.SpotifyClient):
         mock_response = unittest.mock.AsyncMock()
         mock_response.status = 500
@@ -792,7 +1673,7 @@ class TestCreatePlaylist(object):
                     description="description",
                 )),
             unittest.mock.call().__aenter__(),
-            unittest.mock.call().__aenter__().json(),
+            unittest.mock.call().__aenter__().json(loads=smartlist.serialization.loads),
             unittest.mock.call().__aexit__(None, None, None),
         ))
 
@@ -820,41 +1701,146 @@ class TestCreatePlaylist(object):
 
 
 @pytest.mark.asyncio
-class TestClearPlaylist(object):
+class TestGetPlaylistItems(object):
 
-    async def test_success(self, client: smartlist.client.SpotifyClient):
+    async def test_single_page(self, client: smartlist.client.SpotifyClient):
         mock_response = unittest.mock.AsyncMock()
-        mock_response.status = 201
+        mock_response.status = 200
+        mock_response.json.return_value = dict(
+            snapshot_id="snapshot_id",
+            tracks=dict(
+                items=[dict(track=dict(uri="t1")), dict(track=dict(uri="t2"))],
+                next=None,
+            ),
+        )
 
         client._make_api_call = unittest.mock.MagicMock()
         client._make_api_call.return_value.__aenter__.return_value = mock_response
 
-        await client.clear_playlist("spotify:playlist:playlist_id")
+        snapshot_id, uris = await client.get_playlist_items("spotify:playlist:playlist_id")
+
+        assert snapshot_id == "snapshot_id"
+        assert uris == ["t1", "t2"]
+        client._make_api_call.assert_called_once_with(
+            "get",
+            ("https://api.spotify.com/v1/playlists/playlist_id"
+             "?fields=snapshot_id,tracks(next,items(track(uri)))"))
 
+    async def test_multiple_pages(self, client: smartlist.client.SpotifyClient):
+        mock_response = unittest.mock.AsyncMock()
+        mock_response.status = 200
+        mock_response.json.side_effect = (dict(
+            snapshot_id="snapshot_id",
+            tracks=dict(
+                items=[dict(track=dict(uri="t1"))],
+                next="page 2 url",
+            ),
+        ), dict(
+            items=[dict(track=dict(uri="t2"))],
+            next=None,
+        ))
+
+        client._make_api_call = unittest.mock.MagicMock()
+        client._make_api_call.return_value.__aenter__.return_value = mock_response
+
+        snapshot_id, uris = await client.get_playlist_items("spotify:playlist:playlist_id")
+
+        assert snapshot_id == "snapshot_id"
+        assert uris == ["t1", "t2"]
         client._make_api_call.assert_has_calls((
             unittest.mock.call(
-                "put",
+                "get",
+                ("https://api.spotify.com/v1/playlists/playlist_id"
+                 "?fields=snapshot_id,tracks(next,items(track(uri)))")),
+            unittest.mock.call().__aenter__(),
+            unittest.mock.call().__aenter__().json(loads=smartlist.serialization.loads),
+            unittest.mock.call().__aexit__(None, None, None),
+            unittest.mock.call("get", "page 2 url?fields=next,items(track(uri))"),
+            unittest.mock.call().__aenter__(),
+            unittest.mock.call().__aenter__().json(loads=smartlist.serialization.loads),
+            unittest.mock.call().__aexit__(None, None, None),
+        ))
+
+    async def test_non_200_response(self, client: smartlist.client.SpotifyClient):
+        mock_response = unittest.mock.AsyncMock()
+        mock_response.status = 500
+
+        client._make_api_call = unittest.mock.MagicMock()
+        client._make_api_call.return_value.__aenter__.return_value = mock_response
+
+        with pytest.raises(smartlist.client.SpotifyApiException,
+                           match="Error getting playlist items"):
+            await client.get_playlist_items("spotify:playlist:playlist_id")
+
+        mock_response.json.assert_not_called()
+
+
+@pytest.mark.asyncio
+class TestRemoveItemsFromPlaylist(object):
+
+    async def test_multiple_batches(self,
+                                    monkeypatch: pytest.MonkeyPatch,
+                                    client: smartlist.client.SpotifyClient):
+        monkeypatch.setattr("smartlist.client.PLAYLIST_ITEMS_BATCH_SIZE", 2)
+
+        mock_response = unittest.mock.AsyncMock()
+        mock_response.status = 200
+        mock_response.json.side_effect = (
+            dict(snapshot_id="snapshot2"),
+            dict(snapshot_id="snapshot3"),
+        )
+
+        client._make_api_call = unittest.mock.MagicMock()
+        client._make_api_call.return_value.__aenter__.return_value = mock_response
+
+        snapshot_id = await client.remove_items_from_playlist(
+            "spotify:playlist:playlist_id", [(0, "t1"), (5, "t2"), (3, "t3")], "snapshot1")
+
+        assert snapshot_id == "snapshot3"
+        client._make_api_call.assert_has_calls((
+            unittest.mock.call(
+                "delete",
+                "https://api.spotify.com/v1/playlists/playlist_id/tracks",
+                body=dict(
+                    tracks=[dict(uri="t2", positions=[5]), dict(uri="t3", positions=[3])],
+                    snapshot_id="snapshot1",
+                ),
+            ),
+            unittest.mock.call().__aenter__(),
+            unittest.mock.call().__aenter__().json(loads=smartlist.serialization.loads),
+            unittest.mock.call().__aexit__(None, None, None),
+            unittest.mock.call(
+                "delete",
                 "https://api.spotify.com/v1/playlists/playlist_id/tracks",
-                body=dict(uris=[]),
+                body=dict(
+                    tracks=[dict(uri="t1", positions=[0])],
+                    snapshot_id="snapshot2",
+                ),
             ),
             unittest.mock.call().__aenter__(),
+            unittest.mock.call().__aenter__().json(loads=smartlist.serialization.loads),
             unittest.mock.call().__aexit__(None, None, None),
         ))
 
-    async def test_non_201_response(self, client: smartlist.client.SpotifyClient):
+    async def test_non_200_response(self, client: smartlist.client.SpotifyClient):
         mock_response = unittest.mock.AsyncMock()
         mock_response.status = 500
 
         client._make_api_call = unittest.mock.MagicMock()
         client._make_api_call.return_value.__aenter__.return_value = mock_response
 
-        with pytest.raises(smartlist.client.SpotifyApiException, match="Error clearing playlist"):
-            await client.clear_playlist("spotify:playlist:playlist_id")
+        with pytest.raises(smartlist.client.SpotifyApiException,
+                           match="Error removing items from playlist"):
+            await client.remove_items_from_playlist(
+                "spotify:playlist:playlist_id", [(0, "t1")], "snapshot1")
 
         client._make_api_call.assert_called_once_with(
-            "put",
+            "delete",
             "https://api.spotify.com/v1/playlists/playlist_id/tracks",
-            body=dict(uris=[]),
+            body=dict(
+                tracks=[dict(uri="t1", positions=[0])],
+                snapshot_id="snapshot1",
+            ),
         )
 
 
@@ -864,6 +1850,7 @@ class TestAddItemsToPlaylist(object):
     async def test_single_batch(self, client: smartlist.client.SpotifyClient):
         mock_response = unittest.mock.AsyncMock()
         mock_response.status = 201
+        mock_response.json.return_value = dict(snapshot_id="snapshot_id")
 
         client._make_api_call = unittest.mock.MagicMock()
         client._make_api_call.return_value.__aenter__.return_value = mock_response
@@ -873,8 +1860,9 @@ class TestAddItemsToPlaylist(object):
             smartlist.client.Track(None, "t2", None, None, None, None),
             smartlist.client.Track(None, "t3", None, None, None, None),
         ]
-        await client.add_items_to_playlist("spotify:playlist:playlist_id", tracks)
+        snapshot_id = await client.add_items_to_playlist("spotify:playlist:playlist_id", tracks)
 
+        assert snapshot_id == "snapshot_id"
         client._make_api_call.assert_has_calls((
             unittest.mock.call(
                 "post",
@@ -882,6 +1870,7 @@ class TestAddItemsToPlaylist(object):
                 body=dict(uris=["t1", "t2", "t3"]),
             ),
             unittest.mock.call().__aenter__(),
+            unittest.mock.call().__aenter__().json(loads=smartlist.serialization.loads),
             unittest.mock.call().__aexit__(None, None, None),
         ))
 
@@ -892,6 +1881,10 @@ class TestAddItemsToPlaylist(object):
 
         mock_response = unittest.mock.AsyncMock()
         mock_response.status = 201
+        mock_response.json.side_effect = (
+            dict(snapshot_id="snapshot1"),
+            dict(snapshot_id="snapshot2"),
+        )
 
         client._make_api_call = unittest.mock.MagicMock()
         client._make_api_call.return_value.__aenter__.return_value = mock_response
@@ -901,8 +1894,9 @@ class TestAddItemsToPlaylist(object):
             smartlist.client.Track(None, "t2", None, None, None, None),
             smartlist.client.Track(None, "t3", None, None, None, None),
         ]
-        await client.add_items_to_playlist("spotify:playlist:playlist_id", tracks)
+        snapshot_id = await client.add_items_to_playlist("spotify:playlist:playlist_id", tracks)
 
+        assert snapshot_id == "snapshot2"
         client._make_api_call.assert_has_calls((
             unittest.mock.call(
                 "post",
@@ -910,6 +1904,7 @@ class TestAddItemsToPlaylist(object):
                 body=dict(uris=["t1", "t2"]),
             ),
             unittest.mock.call().__aenter__(),
+            unittest.mock.call().__aenter__().json(loads=smartlist.serialization.loads),
             unittest.mock.call().__aexit__(None, None, None),
             unittest.mock.call(
                 "post",
@@ -917,6 +1912,45 @@ class TestAddItemsToPlaylist(object):
                 body=dict(uris=["t3"]),
             ),
             unittest.mock.call().__aenter__(),
+            unittest.mock.call().__aenter__().json(loads=smartlist.serialization.loads),
+            unittest.mock.call().__aexit__(None, None, None),
+        ))
+
+    async def test_with_position(self,
+                                 monkeypatch: pytest.MonkeyPatch,
+                                 client: smartlist.client.SpotifyClient):
+        monkeypatch.setattr("smartlist.client.PLAYLIST_ITEMS_BATCH_SIZE", 2)
+
+        mock_response = unittest.mock.AsyncMock()
+        mock_response.status = 201
+        mock_response.json.return_value = dict(snapshot_id="snapshot_id")
+
+        client._make_api_call = unittest.mock.MagicMock()
+        client._make_api_call.return_value.__aenter__.return_value = mock_response
+
+        tracks = [
+            smartlist.client.Track(None, "t1", None, None, None, None),
+            smartlist.client.Track(None, "t2", None, None, None, None),
+            smartlist.client.Track(None, "t3", None, None, None, None),
+        ]
+        await client.add_items_to_playlist("spotify:playlist:playlist_id", tracks, position=4)
+
+        client._make_api_call.assert_has_calls((
+            unittest.mock.call(
+                "post",
+                "https://api.spotify.com/v1/playlists/playlist_id/tracks",
+                body=dict(uris=["t1", "t2"], position=4),
+            ),
+            unittest.mock.call().__aenter__(),
+            unittest.mock.call().__aenter__().json(loads=smartlist.serialization.loads),
+            unittest.mock.call().__aexit__(None, None, None),
+            unittest.mock.call(
+                "post",
+                "https://api.spotify.com/v1/playlists/playlist_id/tracks",
+                body=dict(uris=["t3"], position=6),
+            ),
+            unittest.mock.call().__aenter__(),
+            unittest.mock.call().__aenter__().json(loads=smartlist.serialization.loads),
             unittest.mock.call().__aexit__(None, None, None),
         ))
 
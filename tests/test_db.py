@@ -1,8 +1,13 @@
+import asyncio
+import configparser
+import sqlite3
+import threading
 import unittest.mock
 
 import pytest
 
 import smartlist.db
+import smartlist.serialization
 
 
 def test_scripts_exist():
@@ -68,21 +73,61 @@ def test_init_db(monkeypatch: pytest.MonkeyPatch):
     mock_connect = unittest.mock.MagicMock()
     monkeypatch.setattr("smartlist.db.sqlite3.connect", mock_connect)
 
+    mock_conn = unittest.mock.Mock()
+    mock_read_conns = [unittest.mock.Mock(), unittest.mock.Mock()]
+    mock_connect.side_effect = [mock_conn] + mock_read_conns
+
     mock_config = unittest.mock.Mock()
     mock_config.get.return_value = "db_path"
+    mock_config.getint.side_effect = lambda section, key, fallback: dict(
+        read_connections=2, mmap_size=1024, cache_size_kb=512)[key]
 
     db = smartlist.db.init_db("/root_path", mock_config)
 
     assert db is not None
     assert isinstance(db, smartlist.db.SmartListDB)
-    assert db._conn == mock_connect.return_value
-    mock_connect.assert_called_once_with("/root_path/db_path")
-    mock_apply_db_scripts.assert_called_once_with(mock_connect.return_value)
+    assert db._conn == mock_conn
+    assert db._all_read_conns == mock_read_conns
+    assert db.read_pool_size == 2
+    mock_connect.assert_has_calls((
+        unittest.mock.call("/root_path/db_path", check_same_thread=False),
+        unittest.mock.call("file:/root_path/db_path?mode=ro", uri=True, check_same_thread=False),
+        unittest.mock.call("file:/root_path/db_path?mode=ro", uri=True, check_same_thread=False),
+    ))
+    mock_conn.execute.assert_has_calls((
+        unittest.mock.call("PRAGMA journal_mode = WAL"),
+        unittest.mock.call("PRAGMA synchronous = NORMAL"),
+        unittest.mock.call("PRAGMA mmap_size = 1024"),
+        unittest.mock.call("PRAGMA cache_size = -512"),
+    ))
+    for mock_read_conn in mock_read_conns:
+        mock_read_conn.execute.assert_has_calls((
+            unittest.mock.call("PRAGMA mmap_size = 1024"),
+            unittest.mock.call("PRAGMA cache_size = -512"),
+        ))
+    mock_apply_db_scripts.assert_called_once_with(mock_conn)
 
 
 def test_constructor():
     db = smartlist.db.SmartListDB("conn")
     assert db._conn == "conn"
+    assert db.read_pool_size == 0
+
+
+def test_reads_use_read_pool():
+    mock_conn = unittest.mock.MagicMock()
+    mock_read_conn = unittest.mock.MagicMock()
+    mock_read_conn.__enter__.return_value.execute.return_value.fetchone.return_value = ["token"]
+    db = smartlist.db.SmartListDB(mock_conn, [mock_read_conn])
+
+    assert db.get_refresh_token("user_id") == "token"
+    db.upsert_user("user_id", "refresh_token")
+
+    mock_read_conn.__enter__.return_value.execute.assert_called_once_with(
+        "SELECT refresh_token FROM users WHERE user_id = ?", ("user_id",))
+    mock_conn.__enter__.return_value.execute.assert_called_once_with(
+        unittest.mock.ANY, ("user_id", "refresh_token"))
+    assert db._read_conns.qsize() == 1
 
 
 def test_get_refresh_token():
@@ -114,16 +159,18 @@ def test_upsert_user():
 def test_get_artists():
     mock_conn = unittest.mock.MagicMock()
     mock_conn.__enter__.return_value.execute.return_value.fetchall.return_value = (
-        ("id1", "pid1", "updated"),
-        ("id2", None, None),
+        ("id1", "pid1", "updated", "fingerprint", "snapshot_id", 0),
+        ("id2", None, None, None, None, 1),
     )
 
     db = smartlist.db.SmartListDB(mock_conn)
     artists = db.get_artists("user_id")
 
     assert artists == [
-        dict(id="id1", playlist_id="pid1", last_updated="updated"),
-        dict(id="id2", playlist_id=None, last_updated=None),
+        dict(id="id1", playlist_id="pid1", last_updated="updated",
+             fingerprint="fingerprint", snapshot_id="snapshot_id", dirty=False),
+        dict(id="id2", playlist_id=None, last_updated=None,
+             fingerprint=None, snapshot_id=None, dirty=True),
     ]
     mock_conn.__enter__.return_value.execute.assert_called_once_with(
         unittest.mock.ANY,
@@ -162,12 +209,419 @@ def test_remove_artists():
     )
 
 
-def test_update_artist_playlist():
+def test_update_artist_playlists():
+    mock_conn = unittest.mock.MagicMock()
+    db = smartlist.db.SmartListDB(mock_conn)
+    db.update_artist_playlists("user_id", [
+        ("a1", "p1", "last_updated", "fp1", "s1"),
+        ("a2", "p2", "last_updated", "fp2", "s2"),
+    ])
+
+    mock_conn.__enter__.return_value.executemany.assert_called_once_with(
+        unittest.mock.ANY, [
+            ("p1", "last_updated", "fp1", "s1", "user_id", "a1"),
+            ("p2", "last_updated", "fp2", "s2", "user_id", "a2"),
+        ],
+    )
+
+
+def test_mark_artists_dirty():
+    mock_conn = unittest.mock.MagicMock()
+    db = smartlist.db.SmartListDB(mock_conn)
+    db.mark_artists_dirty("user_id", ["a1", "a2"])
+
+    mock_conn.__enter__.return_value.executemany.assert_called_once_with(
+        unittest.mock.ANY, [("user_id", "a1"), ("user_id", "a2")])
+
+
+def test_get_library_keys():
+    mock_conn = unittest.mock.MagicMock()
+    mock_conn.__enter__.return_value.execute.return_value.fetchall.return_value = (
+        ("u1", "added1"), ("u2", "added2"))
+
+    db = smartlist.db.SmartListDB(mock_conn)
+
+    assert db.get_library_keys("user_id", "albums") == [("u1", "added1"), ("u2", "added2")]
+    mock_conn.__enter__.return_value.execute.assert_called_once_with(
+        unittest.mock.ANY,
+        ("user_id", "albums"),
+    )
+
+
+def test_get_library_items():
     mock_conn = unittest.mock.MagicMock()
+    mock_conn.__enter__.return_value.execute.return_value.fetchall.return_value = (
+        ("u1", smartlist.serialization.dumps(dict(uri="u1"))),
+        ("u2", smartlist.serialization.dumps(dict(uri="u2"))),
+    )
+
     db = smartlist.db.SmartListDB(mock_conn)
-    db.update_artist_playlist("user_id", "artist_id", "playlist_id", "last_updated")
+    items = db.get_library_items("user_id", "albums", "u0", 2)
 
+    assert items == [("u1", dict(uri="u1")), ("u2", dict(uri="u2"))]
     mock_conn.__enter__.return_value.execute.assert_called_once_with(
         unittest.mock.ANY,
-        ("playlist_id", "last_updated", "user_id", "artist_id"),
+        ("user_id", "albums", "u0", 2),
     )
+
+
+def test_get_library_items_by_uri(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr("smartlist.db.LOOKUP_BATCH_SIZE", 2)
+    mock_conn = unittest.mock.MagicMock()
+    mock_conn.__enter__.return_value.execute.return_value.fetchall.side_effect = (
+        ((smartlist.serialization.dumps(dict(uri="u1")),),
+         (smartlist.serialization.dumps(dict(uri="u2")),)),
+        ((smartlist.serialization.dumps(dict(uri="u3")),),),
+    )
+
+    db = smartlist.db.SmartListDB(mock_conn)
+
+    assert db.get_library_items_by_uri("user_id", "albums", ["u1", "u2", "u3"]) == [
+        dict(uri="u1"), dict(uri="u2"), dict(uri="u3")]
+    mock_conn.__enter__.return_value.execute.assert_has_calls((
+        unittest.mock.call(unittest.mock.ANY, ("user_id", "albums", "u1", "u2")),
+        unittest.mock.call().fetchall(),
+        unittest.mock.call(unittest.mock.ANY, ("user_id", "albums", "u3")),
+        unittest.mock.call().fetchall(),
+    ))
+
+
+@pytest.mark.parametrize("row,expected", (
+    (("last_full_sync",), "last_full_sync"),
+    (None, None),
+), ids=("Exists", "Missing"))
+def test_get_library_last_full_sync(row, expected):
+    mock_conn = unittest.mock.MagicMock()
+    mock_conn.__enter__.return_value.execute.return_value.fetchone.return_value = row
+
+    db = smartlist.db.SmartListDB(mock_conn)
+    result = db.get_library_last_full_sync("user_id", "albums")
+
+    assert result == expected
+    mock_conn.__enter__.return_value.execute.assert_called_once_with(
+        unittest.mock.ANY,
+        ("user_id", "albums"),
+    )
+
+
+class TestSaveLibraryItems(object):
+
+    @pytest.mark.parametrize("method,table", (
+        ("save_library_items", "library_items"),
+        ("stage_library_items", "library_staging"),
+    ))
+    def test_save(self, method, table):
+        mock_conn = unittest.mock.MagicMock()
+        db = smartlist.db.SmartListDB(mock_conn)
+        getattr(db, method)("user_id", "albums", [("u1", "added_at", dict(uri="u1"))])
+
+        mock_conn.__enter__.return_value.execute.assert_not_called()
+        mock_conn.__enter__.return_value.executemany.assert_called_once_with(
+            unittest.mock.ANY,
+            [("user_id", "albums", "u1", "added_at",
+              smartlist.serialization.dumps(dict(uri="u1")))],
+        )
+        assert "INSERT INTO {}(".format(table) in \
+            mock_conn.__enter__.return_value.executemany.call_args[0][0]
+
+    def test_clear_staging(self):
+        mock_conn = unittest.mock.MagicMock()
+        db = smartlist.db.SmartListDB(mock_conn)
+        db.clear_library_staging("user_id", "albums")
+
+        mock_conn.__enter__.return_value.execute.assert_called_once_with(
+            "DELETE FROM library_staging WHERE user_id = ? AND item_type = ?",
+            ("user_id", "albums"))
+
+    def test_commit_staging(self):
+        mock_conn = unittest.mock.MagicMock()
+        db = smartlist.db.SmartListDB(mock_conn)
+        db.commit_library_staging("user_id", "albums", "now")
+
+        mock_conn.__enter__.return_value.execute.assert_has_calls((
+            unittest.mock.call(unittest.mock.ANY, ("user_id", "albums")),
+            unittest.mock.call(unittest.mock.ANY, ("user_id", "albums")),
+            unittest.mock.call(unittest.mock.ANY, ("user_id", "albums")),
+            unittest.mock.call(unittest.mock.ANY, ("user_id", "albums", "now")),
+        ))
+
+
+@pytest.mark.parametrize("existing_job", (True, False), ids=("Existing", "New"))
+def test_enqueue_sync_job(existing_job):
+    mock_conn = unittest.mock.MagicMock()
+    mock_execute = mock_conn.__enter__.return_value.execute
+    mock_execute.return_value.fetchone.return_value = (1,) if existing_job else None
+    mock_execute.return_value.lastrowid = 2
+
+    db = smartlist.db.SmartListDB(mock_conn)
+    job_id = db.enqueue_sync_job("user_id", "created")
+
+    if existing_job:
+        assert job_id == 1
+        mock_execute.assert_called_once_with(unittest.mock.ANY, ("user_id",))
+    else:
+        assert job_id == 2
+        mock_execute.assert_has_calls((
+            unittest.mock.call(unittest.mock.ANY, ("user_id",)),
+            unittest.mock.call().fetchone(),
+            unittest.mock.call(unittest.mock.ANY, ("user_id", "created")),
+        ))
+
+
+@pytest.mark.parametrize("queued_job", (True, False), ids=("Queued", "Empty"))
+def test_claim_next_sync_job(queued_job):
+    mock_conn = unittest.mock.MagicMock()
+    mock_execute = mock_conn.__enter__.return_value.execute
+    mock_execute.return_value.fetchone.return_value = (1, "user_id") if queued_job else None
+
+    db = smartlist.db.SmartListDB(mock_conn)
+    job = db.claim_next_sync_job("started")
+
+    if queued_job:
+        assert job == (1, "user_id")
+        mock_execute.assert_called_with(unittest.mock.ANY, ("started", 1))
+    else:
+        assert job is None
+        mock_execute.assert_called_once_with(unittest.mock.ANY)
+
+
+def test_finish_sync_job():
+    mock_conn = unittest.mock.MagicMock()
+    db = smartlist.db.SmartListDB(mock_conn)
+    db.finish_sync_job(1, "complete", "finished")
+
+    mock_conn.__enter__.return_value.execute.assert_called_once_with(
+        unittest.mock.ANY,
+        ("complete", "finished", 1),
+    )
+
+
+@pytest.mark.parametrize("row,expected", (
+    (("running",), "running"),
+    (None, None),
+), ids=("Exists", "Missing"))
+def test_get_sync_job_status(row, expected):
+    mock_conn = unittest.mock.MagicMock()
+    mock_conn.__enter__.return_value.execute.return_value.fetchone.return_value = row
+
+    db = smartlist.db.SmartListDB(mock_conn)
+
+    assert db.get_sync_job_status(1) == expected
+    mock_conn.__enter__.return_value.execute.assert_called_once_with(unittest.mock.ANY, (1,))
+
+
+@pytest.mark.parametrize("row, expected", (
+    (None, None),
+    (("data", "expires"), ("data", "expires")),
+))
+def test_get_session_data(row, expected):
+    mock_conn = unittest.mock.MagicMock()
+    mock_conn.__enter__.return_value.execute.return_value.fetchone.return_value = row
+
+    db = smartlist.db.SmartListDB(mock_conn)
+
+    assert db.get_session_data("sid", "now") == expected
+    mock_conn.__enter__.return_value.execute.assert_called_once_with(
+        unittest.mock.ANY, ("sid", "now"))
+
+
+def test_save_session_data():
+    mock_conn = unittest.mock.MagicMock()
+    db = smartlist.db.SmartListDB(mock_conn)
+    db.save_session_data("sid", "data", "expires")
+
+    mock_conn.__enter__.return_value.execute.assert_called_once_with(
+        unittest.mock.ANY, ("sid", "data", "expires"))
+
+
+def test_delete_session():
+    mock_conn = unittest.mock.MagicMock()
+    db = smartlist.db.SmartListDB(mock_conn)
+    db.delete_session("sid")
+
+    mock_conn.__enter__.return_value.execute.assert_called_once_with(
+        "DELETE FROM sessions WHERE session_id = ?", ("sid",))
+
+
+def test_delete_expired_sessions():
+    mock_conn = unittest.mock.MagicMock()
+    db = smartlist.db.SmartListDB(mock_conn)
+    db.delete_expired_sessions("now")
+
+    mock_conn.__enter__.return_value.execute.assert_called_once_with(
+        "DELETE FROM sessions WHERE expires <= ?", ("now",))
+
+
+def test_get_catalog_artists(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr("smartlist.db.LOOKUP_BATCH_SIZE", 2)
+    mock_conn = unittest.mock.MagicMock()
+    mock_conn.__enter__.return_value.execute.return_value.fetchall.side_effect = (
+        ((smartlist.serialization.dumps(dict(uri="a1")), "f1"),
+         (smartlist.serialization.dumps(dict(uri="a2")), "f2")),
+        ((smartlist.serialization.dumps(dict(uri="a3")), "f3"),),
+    )
+
+    db = smartlist.db.SmartListDB(mock_conn)
+
+    assert db.get_catalog_artists(["a1", "a2", "a3"], "cutoff") == [
+        (dict(uri="a1"), "f1"),
+        (dict(uri="a2"), "f2"),
+        (dict(uri="a3"), "f3"),
+    ]
+    mock_conn.__enter__.return_value.execute.assert_has_calls((
+        unittest.mock.call(unittest.mock.ANY, ("a1", "a2", "cutoff")),
+        unittest.mock.call().fetchall(),
+        unittest.mock.call(unittest.mock.ANY, ("a3", "cutoff")),
+        unittest.mock.call().fetchall(),
+    ))
+
+
+def test_save_catalog_artists():
+    mock_conn = unittest.mock.MagicMock()
+    db = smartlist.db.SmartListDB(mock_conn)
+    db.save_catalog_artists([("a1", dict(uri="a1"))], "fetched")
+
+    mock_conn.__enter__.return_value.executemany.assert_called_once_with(
+        unittest.mock.ANY, [("a1", smartlist.serialization.dumps(dict(uri="a1")), "fetched")])
+
+
+def test_get_library_summary():
+    mock_conn = unittest.mock.MagicMock()
+    mock_conn.__enter__.return_value.execute.return_value.fetchone.return_value = (2, "newest")
+
+    db = smartlist.db.SmartListDB(mock_conn)
+
+    assert db.get_library_summary("user_id", "albums") == (2, "newest")
+    mock_conn.__enter__.return_value.execute.assert_called_once_with(
+        unittest.mock.ANY, ("user_id", "albums"))
+
+
+def test_requeue_running_sync_jobs():
+    mock_conn = unittest.mock.MagicMock()
+    db = smartlist.db.SmartListDB(mock_conn)
+    db.requeue_running_sync_jobs()
+
+    mock_conn.__enter__.return_value.execute.assert_called_once_with(unittest.mock.ANY)
+
+
+def test_get_users_due_for_sync():
+    mock_conn = unittest.mock.MagicMock()
+    mock_conn.__enter__.return_value.execute.return_value.fetchall.return_value = (
+        ("u1",), ("u2",))
+
+    db = smartlist.db.SmartListDB(mock_conn)
+
+    assert db.get_users_due_for_sync("cutoff") == ["u1", "u2"]
+    mock_conn.__enter__.return_value.execute.assert_called_once_with(
+        unittest.mock.ANY, ("cutoff",))
+
+
+def test_close():
+    mock_conn = unittest.mock.MagicMock()
+    mock_read_conn = unittest.mock.MagicMock()
+    db = smartlist.db.SmartListDB(mock_conn, [mock_read_conn])
+    db.close()
+    mock_conn.close.assert_called_once_with()
+    mock_read_conn.close.assert_called_once_with()
+
+
+@pytest.mark.asyncio
+class TestAsyncSmartListDB(object):
+
+    async def test_runs_on_db_thread(self):
+        mock_db = unittest.mock.Mock()
+        calling_threads = []
+
+        def get_artists(user_id):
+            calling_threads.append(threading.current_thread())
+            return ["artist"]
+
+        mock_db.get_artists.side_effect = get_artists
+        mock_db.read_pool_size = 0
+        db = smartlist.db.AsyncSmartListDB(mock_db)
+
+        assert await db.get_artists("user_id") == ["artist"]
+        await db.close()
+
+        mock_db.get_artists.assert_called_once_with("user_id")
+        mock_db.close.assert_called_once_with()
+        assert calling_threads[0] is not threading.current_thread()
+
+    async def test_delegates_methods(self):
+        mock_db = unittest.mock.Mock()
+        mock_db.read_pool_size = 0
+        db = smartlist.db.AsyncSmartListDB(mock_db)
+
+        await db.upsert_user("user_id", "refresh_token")
+        await db.update_artist_playlists("user_id", ["update"])
+        await db.save_library_items("user_id", "albums", ["row"])
+        assert await db.claim_next_sync_job("started") == mock_db.claim_next_sync_job.return_value
+        await db.close()
+
+        mock_db.upsert_user.assert_called_once_with("user_id", "refresh_token")
+        mock_db.update_artist_playlists.assert_called_once_with("user_id", ["update"])
+        mock_db.save_library_items.assert_called_once_with("user_id", "albums", ["row"])
+        mock_db.claim_next_sync_job.assert_called_once_with("started")
+
+    async def test_with_sqlite(self):
+        conn = sqlite3.connect(":memory:", check_same_thread=False)
+        smartlist.db.apply_db_scripts(conn)
+        db = smartlist.db.AsyncSmartListDB(smartlist.db.SmartListDB(conn))
+
+        await db.upsert_user("user_id", "refresh_token")
+        assert await db.get_refresh_token("user_id") == "refresh_token"
+
+        await db.close()
+
+    async def test_with_read_pool(self, tmp_path):
+        config = configparser.ConfigParser()
+        config.read_dict(dict(db=dict(path="smartlist.db", read_connections="2")))
+        db = smartlist.db.AsyncSmartListDB(smartlist.db.init_db(str(tmp_path), config))
+
+        assert db._read_executor is not db._executor
+        await db.upsert_user("user_id", "refresh_token")
+        await db.add_artists("user_id", ["a1"])
+        assert await asyncio.gather(
+            db.get_refresh_token("user_id"),
+            db.get_artists("user_id"),
+        ) == ["refresh_token", [dict(id="a1", playlist_id=None, last_updated=None,
+                                     fingerprint=None, snapshot_id=None, dirty=True)]]
+
+        await db.update_artist_playlists("user_id", [("a1", "p1", "updated", "fp", "s1")])
+        assert (await db.get_artists("user_id"))[0]["dirty"] is False
+        await db.mark_artists_dirty("user_id", ["a1"])
+        assert (await db.get_artists("user_id"))[0]["dirty"] is True
+
+        assert await db.get_library_summary("user_id", "albums") == (0, None)
+        await db.save_library_items("user_id", "albums", [
+            ("u1", "2021-01-01", dict(uri="u1")), ("u2", "2021-01-02", dict(uri="u2"))])
+        assert await db.get_library_summary("user_id", "albums") == (2, "2021-01-02")
+        assert await db.get_library_keys("user_id", "albums") == [
+            ("u1", "2021-01-01"), ("u2", "2021-01-02")]
+        assert await db.get_library_items("user_id", "albums", limit=1) == [
+            ("u1", dict(uri="u1"))]
+        assert await db.get_library_items("user_id", "albums", "u1") == [("u2", dict(uri="u2"))]
+
+        await db.stage_library_items("user_id", "albums", [("stale", "2020-01-01", dict())])
+        await db.clear_library_staging("user_id", "albums")
+        await db.stage_library_items("user_id", "albums", [("u3", "2021-01-03", dict(uri="u3"))])
+        assert await db.get_library_items_by_uri("user_id", "albums", ["u1", "u3"]) == [
+            dict(uri="u1")]
+        await db.commit_library_staging("user_id", "albums", "2021-01-04")
+        assert await db.get_library_keys("user_id", "albums") == [("u3", "2021-01-03")]
+        assert await db.get_library_last_full_sync("user_id", "albums") == "2021-01-04"
+        assert db._db._conn.execute("SELECT COUNT(*) FROM library_staging").fetchone() == (0,)
+
+        await db.save_catalog_artists([("a1", dict(uri="a1"))], "2021-01-02")
+        assert await db.get_catalog_artists(["a1", "a2"], "2021-01-01") == [
+            (dict(uri="a1"), "2021-01-02")]
+        assert await db.get_catalog_artists(["a1"], "2021-01-03") == []
+
+        await db.save_catalog_albums([("al1", dict(uri="al1", tracks=[]))], "2021-01-02")
+        assert await db.get_catalog_albums(["al1", "a1"], "2021-01-01") == [
+            (dict(uri="al1", tracks=[]), "2021-01-02")]
+
+        with pytest.raises(sqlite3.OperationalError):
+            db._db._all_read_conns[0].execute("DELETE FROM users")
+
+        await db.close()
@@ -5,6 +5,7 @@ import aiohttp.web
 import pytest
 
 import smartlist.handler_util
+import smartlist.serialization
 
 
 @pytest.mark.asyncio
@@ -99,7 +100,7 @@ class TestGetJsonPayload(object):
         val = await smartlist.handler_util.get_json_payload(mock_request)
 
         assert val == "json"
-        mock_request.json.assert_called_once_with()
+        mock_request.json.assert_called_once_with(loads=smartlist.serialization.loads)
 
     async def test_failure(self):
         mock_request = unittest.mock.AsyncMock()
@@ -109,4 +110,4 @@ class TestGetJsonPayload(object):
             await smartlist.handler_util.get_json_payload(mock_request)
 
         assert exc.value.status == 400
-        mock_request.json.assert_called_once_with()
+        mock_request.json.assert_called_once_with(loads=smartlist.serialization.loads)
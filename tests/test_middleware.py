@@ -6,10 +6,39 @@ import smartlist.middleware
 
 
 @pytest.fixture
-def mock_session(monkeypatch: pytest.MonkeyPatch):
-    mock_get_session = unittest.mock.AsyncMock()
-    monkeypatch.setattr("smartlist.middleware.smartlist.session.get_session", mock_get_session)
-    return mock_get_session.return_value
+def mock_session():
+    return unittest.mock.Mock()
+
+
+@pytest.mark.asyncio
+class TestServeStatic(object):
+
+    async def test_static_request(self):
+        mock_request = unittest.mock.MagicMock()
+        mock_request.path = "/assets/style.css"
+        mock_static_assets = mock_request.app.__getitem__.return_value
+        mock_static_assets.matches.return_value = True
+
+        mock_handler = unittest.mock.AsyncMock()
+        resp = await smartlist.middleware.serve_static(mock_request, mock_handler)
+
+        assert resp == mock_static_assets.handle.return_value
+        mock_request.app.__getitem__.assert_called_once_with("static_assets")
+        mock_static_assets.matches.assert_called_once_with("/assets/style.css")
+        mock_static_assets.handle.assert_called_once_with(mock_request)
+        mock_handler.assert_not_called()
+
+    async def test_other_request(self):
+        mock_request = unittest.mock.MagicMock()
+        mock_static_assets = mock_request.app.__getitem__.return_value
+        mock_static_assets.matches.return_value = False
+
+        mock_handler = unittest.mock.AsyncMock()
+        resp = await smartlist.middleware.serve_static(mock_request, mock_handler)
+
+        assert resp == mock_handler.return_value
+        mock_static_assets.handle.assert_not_called()
+        mock_handler.assert_called_once_with(mock_request)
 
 
 @pytest.mark.asyncio
@@ -31,14 +60,15 @@ async def test_load_session(monkeypatch: pytest.MonkeyPatch):
 
 @pytest.mark.asyncio
 async def test_inject_client(monkeypatch: pytest.MonkeyPatch,
-                             mock_session: unittest.mock.AsyncMock):
+                             mock_session: unittest.mock.Mock):
     mock_spotify_client_constructor = unittest.mock.Mock()
     mock_spotify_client_constructor.return_value.close = unittest.mock.AsyncMock()
     monkeypatch.setattr("smartlist.middleware.smartlist.client.SpotifyClient",
                         mock_spotify_client_constructor)
 
     mock_request = unittest.mock.MagicMock()
-    mock_request.app.__getitem__.side_effect = ["config", "db"]
+    mock_request.app.__getitem__.side_effect = ["config", "db", "client_resources"]
+    mock_request.__getitem__.return_value = mock_session
 
     mock_handler = unittest.mock.AsyncMock()
     await smartlist.middleware.inject_client(mock_request, mock_handler)
@@ -46,10 +76,13 @@ async def test_inject_client(monkeypatch: pytest.MonkeyPatch,
     mock_request.app.__getitem__.assert_has_calls((
         unittest.mock.call("config"),
         unittest.mock.call("db"),
+        unittest.mock.call("client_resources"),
     ))
+    mock_request.__getitem__.assert_called_once_with("session")
     mock_request.__setitem__.assert_called_once_with(
         "client", mock_spotify_client_constructor.return_value)
-    mock_spotify_client_constructor.assert_called_once_with("config", "db", mock_session)
+    mock_spotify_client_constructor.assert_called_once_with(
+        "config", "db", mock_session, "client_resources")
     mock_handler.assert_called_once_with(mock_request)
     mock_spotify_client_constructor.return_value.close.assert_called_once_with()
 
@@ -64,27 +97,43 @@ class TestGenerateCsrfToken(object):
         return mock
 
     async def test_no_existing_token(self,
-                                     mock_session: unittest.mock.AsyncMock,
+                                     mock_session: unittest.mock.Mock,
                                      mock_token_urlsafe: unittest.mock.Mock):
         mock_session.csrf_token = None
         mock_token_urlsafe.return_value = "token"
 
+        mock_request = dict(session=mock_session)
         mock_handler = unittest.mock.AsyncMock()
-        await smartlist.middleware.generate_csrf_token("request", mock_handler)
+        await smartlist.middleware.generate_csrf_token(mock_request, mock_handler)
 
         assert mock_session.csrf_token == "token"
         mock_token_urlsafe.assert_called_once_with()
-        mock_handler.assert_called_once_with("request")
+        mock_handler.assert_called_once_with(mock_request)
 
     async def test_existing_token(self,
-                                  mock_session: unittest.mock.AsyncMock,
+                                  mock_session: unittest.mock.Mock,
                                   mock_token_urlsafe: unittest.mock.Mock):
         mock_session.csrf_token = "token"
         mock_token_urlsafe.return_value = "new_token"
 
+        mock_request = dict(session=mock_session)
         mock_handler = unittest.mock.AsyncMock()
-        await smartlist.middleware.generate_csrf_token("request", mock_handler)
+        await smartlist.middleware.generate_csrf_token(mock_request, mock_handler)
 
         assert mock_session.csrf_token == "token"
         mock_token_urlsafe.assert_not_called()
-        mock_handler.assert_called_once_with("request")
+        mock_handler.assert_called_once_with(mock_request)
+
+    async def test_anonymous_session(self,
+                                     mock_session: unittest.mock.Mock,
+                                     mock_token_urlsafe: unittest.mock.Mock):
+        mock_session.user_info = None
+        mock_session.csrf_token = None
+
+        mock_request = dict(session=mock_session)
+        mock_handler = unittest.mock.AsyncMock()
+        await smartlist.middleware.generate_csrf_token(mock_request, mock_handler)
+
+        assert mock_session.csrf_token is None
+        mock_token_urlsafe.assert_not_called()
+        mock_handler.assert_called_once_with(mock_request)
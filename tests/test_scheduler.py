@@ -0,0 +1,221 @@
+import asyncio
+import datetime
+import unittest.mock
+
+import pytest
+
+import smartlist.scheduler
+import smartlist.serialization
+
+
+@pytest.fixture
+def scheduler():
+    config = unittest.mock.Mock()
+    db = unittest.mock.AsyncMock()
+    return smartlist.scheduler.SyncScheduler(config, db, "client_resources")
+
+
+@pytest.mark.asyncio
+async def test_sync_progress_send_json(scheduler: smartlist.scheduler.SyncScheduler):
+    ws1 = unittest.mock.AsyncMock()
+    ws2 = unittest.mock.AsyncMock()
+    await scheduler.subscribe("user_id", ws1)
+    await scheduler.subscribe("user_id", ws2)
+
+    progress = smartlist.scheduler.SyncProgress(scheduler, "user_id")
+    ws2.send_str.side_effect = Exception("closed")
+    await progress.send_json(dict(type="msg1"))
+    await progress.send_json(dict(type="msg2"))
+
+    assert progress.messages == [dict(type="msg1"), dict(type="msg2")]
+    ws1.send_str.assert_has_calls((
+        unittest.mock.call(smartlist.serialization.dumps(dict(type="msg1"))),
+        unittest.mock.call(smartlist.serialization.dumps(dict(type="msg2"))),
+    ))
+    ws2.send_str.assert_called_once_with(smartlist.serialization.dumps(dict(type="msg1")))
+    assert scheduler.get_subscribers("user_id") == {ws1}
+
+
+@pytest.mark.asyncio
+async def test_subscribe_replays_progress(scheduler: smartlist.scheduler.SyncScheduler):
+    progress = smartlist.scheduler.SyncProgress(scheduler, "user_id")
+    progress.messages.extend(["msg1", "msg2"])
+    scheduler._progress["user_id"] = progress
+
+    ws = unittest.mock.AsyncMock()
+    await scheduler.subscribe("user_id", ws)
+
+    assert scheduler.get_subscribers("user_id") == {ws}
+    ws.send_json.assert_has_calls((
+        unittest.mock.call("msg1", dumps=smartlist.serialization.dumps),
+        unittest.mock.call("msg2", dumps=smartlist.serialization.dumps),
+    ))
+
+    scheduler.unsubscribe("user_id", ws)
+    assert scheduler.get_subscribers("user_id") == set()
+    assert "user_id" not in scheduler._subscribers
+
+
+@pytest.mark.asyncio
+async def test_request_sync(scheduler: smartlist.scheduler.SyncScheduler):
+    scheduler._db.enqueue_sync_job.return_value = "job_id"
+    scheduler._wakeup = asyncio.Event()
+
+    job_id = await scheduler.request_sync("user_id")
+
+    assert job_id == "job_id"
+    assert scheduler._wakeup.is_set()
+    scheduler._db.enqueue_sync_job.assert_called_once_with("user_id", unittest.mock.ANY)
+
+
+@pytest.mark.asyncio
+class TestWaitForJob(object):
+
+    async def test_already_finished(self, scheduler: smartlist.scheduler.SyncScheduler):
+        scheduler._db.get_sync_job_status.return_value = "complete"
+
+        await scheduler.wait_for_job(1)
+
+        assert scheduler._job_events == dict()
+        scheduler._db.get_sync_job_status.assert_called_once_with(1)
+
+    async def test_waits_for_event(self, scheduler: smartlist.scheduler.SyncScheduler):
+        scheduler._db.get_sync_job_status.return_value = "running"
+
+        wait_task = asyncio.ensure_future(scheduler.wait_for_job(1))
+        await asyncio.sleep(0)
+        assert not wait_task.done()
+
+        scheduler._job_events[1].set()
+        await wait_task
+
+    async def test_job_finishes_during_status_check(
+            self, scheduler: smartlist.scheduler.SyncScheduler):
+        async def get_sync_job_status(job_id):
+            scheduler._job_events.pop(job_id).set()
+            return "running"
+
+        scheduler._db.get_sync_job_status.side_effect = get_sync_job_status
+
+        await asyncio.wait_for(scheduler.wait_for_job(1), timeout=1)
+
+        assert scheduler._job_events == dict()
+
+
+@pytest.mark.asyncio
+class TestEnqueuePeriodicJobs(object):
+
+    async def test_disabled(self, scheduler: smartlist.scheduler.SyncScheduler):
+        scheduler._config.getint.return_value = 0
+
+        await scheduler._enqueue_periodic_jobs()
+
+        scheduler._config.getint.assert_called_once_with(
+            "scheduler", "sync_interval_hours", fallback=24)
+        scheduler._db.get_users_due_for_sync.assert_not_called()
+
+    async def test_enqueues_due_users(self,
+                                      monkeypatch: pytest.MonkeyPatch,
+                                      scheduler: smartlist.scheduler.SyncScheduler):
+        now = datetime.datetime(2021, 6, 2, tzinfo=datetime.timezone.utc)
+        mock_datetime_datetime = unittest.mock.Mock()
+        mock_datetime_datetime.now.return_value = now
+        monkeypatch.setattr("smartlist.scheduler.datetime.datetime", mock_datetime_datetime)
+
+        scheduler._config.getint.return_value = 24
+        scheduler._db.get_users_due_for_sync.return_value = ["u1", "u2"]
+
+        await scheduler._enqueue_periodic_jobs()
+
+        scheduler._db.get_users_due_for_sync.assert_called_once_with(
+            (now - datetime.timedelta(hours=24)).isoformat())
+        scheduler._db.enqueue_sync_job.assert_has_calls((
+            unittest.mock.call("u1", now.isoformat()),
+            unittest.mock.call("u2", now.isoformat()),
+        ))
+
+
+@pytest.mark.asyncio
+async def test_start_queued_jobs(scheduler: smartlist.scheduler.SyncScheduler):
+    scheduler._config.getint.return_value = 2
+    scheduler._db.claim_next_sync_job.side_effect = ((1, "u1"), (2, "u2"), (3, "u3"))
+    scheduler._run_job = unittest.mock.AsyncMock()
+
+    await scheduler._start_queued_jobs()
+    await asyncio.gather(*scheduler._running_jobs)
+
+    scheduler._config.getint.assert_called_once_with(
+        "scheduler", "max_concurrent_jobs", fallback=1)
+    assert scheduler._db.claim_next_sync_job.call_count == 2
+    scheduler._run_job.assert_has_calls((
+        unittest.mock.call(1, "u1"),
+        unittest.mock.call(2, "u2"),
+    ))
+
+
+@pytest.mark.asyncio
+class TestRunJob(object):
+
+    @pytest.fixture
+    def mock_client(self, monkeypatch: pytest.MonkeyPatch):
+        mock_constructor = unittest.mock.Mock()
+        mock_constructor.return_value.close = unittest.mock.AsyncMock()
+        monkeypatch.setattr("smartlist.scheduler.smartlist.client.SpotifyClient",
+                            mock_constructor)
+        return mock_constructor
+
+    @pytest.fixture
+    def mock_sync_artists(self, monkeypatch: pytest.MonkeyPatch):
+        mock = unittest.mock.AsyncMock()
+        monkeypatch.setattr("smartlist.scheduler.smartlist.sync.sync_artists", mock)
+        return mock
+
+    async def test_success(self,
+                           scheduler: smartlist.scheduler.SyncScheduler,
+                           mock_client: unittest.mock.Mock,
+                           mock_sync_artists: unittest.mock.AsyncMock):
+        job_event = asyncio.Event()
+        scheduler._job_events[1] = job_event
+
+        await scheduler._run_job(1, "user_id")
+
+        [client_args, _] = mock_client.call_args
+        assert client_args[0] == scheduler._config
+        assert client_args[1] == scheduler._db
+        assert client_args[2].user_id == "user_id"
+        assert client_args[2].access_token is None
+        assert client_args[3] == "client_resources"
+        mock_sync_artists.assert_called_once_with(
+            unittest.mock.ANY, scheduler._config, scheduler._db, "user_id",
+            mock_client.return_value)
+        assert isinstance(mock_sync_artists.call_args[0][0], smartlist.scheduler.SyncProgress)
+        mock_client.return_value.close.assert_called_once_with()
+        scheduler._db.finish_sync_job.assert_called_once_with(1, "complete", unittest.mock.ANY)
+        assert job_event.is_set()
+        assert scheduler._job_events == dict()
+        assert scheduler._progress == dict()
+
+    async def test_failure(self,
+                           scheduler: smartlist.scheduler.SyncScheduler,
+                           mock_client: unittest.mock.Mock,
+                           mock_sync_artists: unittest.mock.AsyncMock):
+        mock_sync_artists.side_effect = Exception("test exception")
+
+        await scheduler._run_job(1, "user_id")
+
+        mock_client.return_value.close.assert_called_once_with()
+        scheduler._db.finish_sync_job.assert_called_once_with(1, "failed", unittest.mock.ANY)
+        assert scheduler._progress == dict()
+
+    async def test_cancelled(self,
+                             scheduler: smartlist.scheduler.SyncScheduler,
+                             mock_client: unittest.mock.Mock,
+                             mock_sync_artists: unittest.mock.AsyncMock):
+        mock_sync_artists.side_effect = asyncio.CancelledError()
+
+        with pytest.raises(asyncio.CancelledError):
+            await scheduler._run_job(1, "user_id")
+
+        mock_client.return_value.close.assert_called_once_with()
+        scheduler._db.finish_sync_job.assert_not_called()
+        assert scheduler._progress == dict()
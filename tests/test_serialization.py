@@ -0,0 +1,42 @@
+import unittest.mock
+
+import pytest
+
+import smartlist.serialization
+
+
+DATA = dict(uri="spotify:album:1", name="Album", tracks=[dict(uri="spotify:track:1")])
+
+
+def test_dumps_uses_orjson(monkeypatch: pytest.MonkeyPatch):
+    mock_orjson = unittest.mock.Mock()
+    mock_orjson.dumps.return_value = b"{}"
+    monkeypatch.setattr("smartlist.serialization.orjson", mock_orjson)
+
+    assert smartlist.serialization.dumps(DATA) == "{}"
+    mock_orjson.dumps.assert_called_once_with(DATA)
+
+
+def test_loads_uses_orjson(monkeypatch: pytest.MonkeyPatch):
+    mock_orjson = unittest.mock.Mock()
+    monkeypatch.setattr("smartlist.serialization.orjson", mock_orjson)
+
+    assert smartlist.serialization.loads(b"{}") == mock_orjson.loads.return_value
+    mock_orjson.loads.assert_called_once_with(b"{}")
+
+
+def test_stdlib_fallback(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr("smartlist.serialization.orjson", None)
+
+    text = smartlist.serialization.dumps(DATA)
+
+    assert isinstance(text, str)
+    assert smartlist.serialization.loads(text) == DATA
+    assert smartlist.serialization.loads(text.encode()) == DATA
+
+
+def test_round_trip():
+    text = smartlist.serialization.dumps(DATA)
+
+    assert isinstance(text, str)
+    assert smartlist.serialization.loads(text) == DATA
@@ -1,5 +1,12 @@
+import asyncio
+import datetime
+import json
+import time
 import unittest.mock
 
+import aiohttp.test_utils
+import aiohttp.web
+import aiohttp_session
 import pytest
 
 import smartlist.session
@@ -61,3 +68,160 @@ async def test_get_session(monkeypatch):
     assert isinstance(session, smartlist.session.Session)
     assert session._session == "mock_session"
     mock_aiohttp_get_session.assert_called_once_with("request")
+
+
+@pytest.mark.asyncio
+async def test_purge_expired_sessions(monkeypatch):
+    mock_db = unittest.mock.AsyncMock()
+    mock_db.delete_expired_sessions.side_effect = (Exception("failed"), None)
+    mock_sleep = unittest.mock.AsyncMock()
+    mock_sleep.side_effect = (None, asyncio.CancelledError())
+    monkeypatch.setattr("smartlist.session.asyncio.sleep", mock_sleep)
+
+    with pytest.raises(asyncio.CancelledError):
+        await smartlist.session.purge_expired_sessions(mock_db, 60)
+
+    assert mock_db.delete_expired_sessions.call_count == 2
+    mock_sleep.assert_has_calls([unittest.mock.call(60), unittest.mock.call(60)])
+
+
+@pytest.fixture
+def storage():
+    return smartlist.session.SessionStorage(
+        unittest.mock.AsyncMock(), cache_size=2, max_age=3600)
+
+
+def _mock_request(session_id=None):
+    mock_request = unittest.mock.Mock()
+    mock_request.cookies = dict()
+    if session_id is not None:
+        mock_request.cookies["AIOHTTP_SESSION"] = session_id
+    return mock_request
+
+
+def _session_data(**data):
+    return json.dumps(dict(created=int(time.time()), session=data))
+
+
+def _future(seconds=3600):
+    return datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=seconds)
+
+
+@pytest.mark.asyncio
+class TestSessionStorage(object):
+
+    async def test_load_without_cookie(self, storage: smartlist.session.SessionStorage):
+        session = await storage.load_session(_mock_request())
+
+        assert session.new
+        assert session.identity is None
+        storage._db.get_session_data.assert_not_called()
+
+    async def test_load_from_db_then_cache(self, storage: smartlist.session.SessionStorage):
+        storage._db.get_session_data.return_value = (
+            _session_data(key="value"), _future().isoformat())
+
+        for _ in range(2):
+            session = await storage.load_session(_mock_request("sid"))
+            assert not session.new
+            assert session.identity == "sid"
+            assert session["key"] == "value"
+
+        storage._db.get_session_data.assert_called_once_with("sid", unittest.mock.ANY)
+
+    async def test_load_unknown(self, storage: smartlist.session.SessionStorage):
+        storage._db.get_session_data.return_value = None
+
+        session = await storage.load_session(_mock_request("sid"))
+
+        assert session.new
+        assert session.identity is None
+
+    async def test_load_expired_cache_entry(self, storage: smartlist.session.SessionStorage):
+        storage._cache["sid"] = (_session_data(), _future(-1))
+
+        session = await storage.load_session(_mock_request("sid"))
+
+        assert session.new
+        assert "sid" not in storage._cache
+        storage._db.get_session_data.assert_not_called()
+
+    async def test_save_new(self,
+                            monkeypatch: pytest.MonkeyPatch,
+                            storage: smartlist.session.SessionStorage):
+        monkeypatch.setattr("smartlist.session.secrets.token_urlsafe", lambda _: "new_sid")
+        session = await storage.load_session(_mock_request())
+        session["key"] = "value"
+        response = aiohttp.web.Response()
+
+        await storage.save_session(_mock_request(), response, session)
+
+        assert session.identity == "new_sid"
+        assert response.cookies["AIOHTTP_SESSION"].value == "new_sid"
+        storage._db.delete_expired_sessions.assert_not_called()
+        storage._db.save_session_data.assert_called_once_with(
+            "new_sid", unittest.mock.ANY, unittest.mock.ANY)
+        assert "new_sid" in storage._cache
+
+        loaded = await storage.load_session(_mock_request("new_sid"))
+        assert loaded["key"] == "value"
+        storage._db.get_session_data.assert_not_called()
+
+    async def test_save_existing(self, storage: smartlist.session.SessionStorage):
+        storage._cache["sid"] = (_session_data(key="value"), _future())
+        session = await storage.load_session(_mock_request("sid"))
+        session["key"] = "new_value"
+        response = aiohttp.web.Response()
+
+        await storage.save_session(_mock_request("sid"), response, session)
+
+        assert response.cookies["AIOHTTP_SESSION"].value == "sid"
+        storage._db.delete_expired_sessions.assert_not_called()
+        storage._db.save_session_data.assert_called_once_with(
+            "sid", unittest.mock.ANY, unittest.mock.ANY)
+        assert "new_value" in storage._cache["sid"][0]
+
+    async def test_save_empty(self, storage: smartlist.session.SessionStorage):
+        storage._cache["sid"] = (_session_data(key="value"), _future())
+        session = await storage.load_session(_mock_request("sid"))
+        session.clear()
+        response = aiohttp.web.Response()
+
+        await storage.save_session(_mock_request("sid"), response, session)
+
+        assert response.cookies["AIOHTTP_SESSION"].value == ""
+        assert "sid" not in storage._cache
+        storage._db.delete_session.assert_called_once_with("sid")
+        storage._db.save_session_data.assert_not_called()
+
+    async def test_new_session_changes_identity(self,
+                                                monkeypatch: pytest.MonkeyPatch,
+                                                storage: smartlist.session.SessionStorage):
+        monkeypatch.setattr("smartlist.session.secrets.token_urlsafe", lambda _: "new_sid")
+        storage._cache["old_sid"] = (_session_data(csrf_token="token"), _future())
+        request = aiohttp.test_utils.make_mocked_request(
+            "GET", "/", headers={"Cookie": "AIOHTTP_SESSION=old_sid"})
+        request[aiohttp_session.STORAGE_KEY] = storage
+        old_session = await smartlist.session.get_session(request)
+        assert old_session.csrf_token == "token"
+
+        session = await smartlist.session.new_session(request)
+        session.user_info = dict(user_id="user_id")
+        response = aiohttp.web.Response()
+        await storage.save_session(request, response, request[aiohttp_session.SESSION_KEY])
+
+        assert request["session"] is session
+        assert session.csrf_token is None
+        assert response.cookies["AIOHTTP_SESSION"].value == "new_sid"
+        assert "old_sid" not in storage._cache
+        storage._db.delete_session.assert_called_once_with("old_sid")
+        storage._db.save_session_data.assert_called_once_with(
+            "new_sid", unittest.mock.ANY, unittest.mock.ANY)
+
+    async def test_cache_eviction(self, storage: smartlist.session.SessionStorage):
+        storage._cache_put("s1", "d1", _future())
+        storage._cache_put("s2", "d2", _future())
+        await storage._load_data("s1")
+        storage._cache_put("s3", "d3", _future())
+
+        assert list(storage._cache.keys()) == ["s1", "s3"]
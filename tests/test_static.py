@@ -0,0 +1,110 @@
+import gzip
+import hashlib
+import unittest.mock
+
+import aiohttp.test_utils
+import aiohttp.web
+import pytest
+
+import smartlist.static
+
+
+CSS_BODY = b"body { color: red; }\n" * 20
+CSS_DIGEST = hashlib.sha256(CSS_BODY).hexdigest()[:smartlist.static.HASH_LENGTH]
+
+
+@pytest.fixture
+def static_assets(tmp_path):
+    (tmp_path / "css").mkdir()
+    (tmp_path / "css" / "style.css").write_bytes(CSS_BODY)
+    (tmp_path / "tiny.js").write_bytes(b"x")
+    return smartlist.static.StaticAssets("/assets/", str(tmp_path))
+
+
+def _request(path, method="GET", headers=None):
+    return aiohttp.test_utils.make_mocked_request(method, path, headers=headers or {})
+
+
+def test_url_for(static_assets: smartlist.static.StaticAssets):
+    assert static_assets.url_for("css/style.css") == "/assets/css/style.{}.css".format(CSS_DIGEST)
+    assert static_assets.url_for("/css/style.css") == "/assets/css/style.{}.css".format(CSS_DIGEST)
+    assert static_assets.url_for("missing.css") == "/assets/missing.css"
+
+
+def test_matches(static_assets: smartlist.static.StaticAssets):
+    assert static_assets.matches("/assets/css/style.css")
+    assert not static_assets.matches("/assetsfoo")
+    assert not static_assets.matches("/artists")
+
+
+@pytest.mark.parametrize("accept_encoding, expected", (
+    ("", None),
+    ("gzip", "gzip"),
+    ("gzip, deflate, br", "br"),
+    ("br;q=0, gzip;q=0.5", "gzip"),
+    ("deflate", None),
+))
+def test_select_encoding(accept_encoding, expected):
+    static_file = smartlist.static.StaticFile(
+        "text/css", "digest", {None: b"body", "gzip": b"gz", "br": b"br"})
+    assert static_file.select_encoding(accept_encoding) == expected
+
+
+def test_compress_body(monkeypatch: pytest.MonkeyPatch):
+    mock_brotli = unittest.mock.Mock()
+    mock_brotli.compress.return_value = b"br"
+    monkeypatch.setattr("smartlist.static.brotli", mock_brotli)
+
+    bodies = smartlist.static.compress_body(CSS_BODY)
+
+    assert bodies[None] == CSS_BODY
+    assert gzip.decompress(bodies["gzip"]) == CSS_BODY
+    assert bodies["br"] == b"br"
+    mock_brotli.compress.assert_called_once_with(CSS_BODY)
+
+
+def test_compress_body_skips_larger_output(monkeypatch: pytest.MonkeyPatch):
+    monkeypatch.setattr("smartlist.static.brotli", None)
+
+    assert smartlist.static.compress_body(b"x") == {None: b"x"}
+
+
+class TestHandle(object):
+
+    def test_hashed_gzip(self, static_assets: smartlist.static.StaticAssets):
+        resp = static_assets.handle(_request(
+            "/assets/css/style.{}.css".format(CSS_DIGEST), headers={"Accept-Encoding": "gzip"}))
+
+        assert resp.status == 200
+        assert resp.content_type == "text/css"
+        assert gzip.decompress(resp.body) == CSS_BODY
+        assert resp.headers["Content-Encoding"] == "gzip"
+        assert resp.headers["Cache-Control"] == smartlist.static.IMMUTABLE_CACHE_CONTROL
+        assert resp.headers["ETag"] == "\"{}-gzip\"".format(CSS_DIGEST)
+        assert resp.headers["Vary"] == "Accept-Encoding"
+
+    def test_unhashed_identity(self, static_assets: smartlist.static.StaticAssets):
+        resp = static_assets.handle(_request("/assets/css/style.css"))
+
+        assert resp.status == 200
+        assert resp.body == CSS_BODY
+        assert "Content-Encoding" not in resp.headers
+        assert resp.headers["Cache-Control"] == "no-cache"
+        assert resp.headers["ETag"] == "\"{}\"".format(CSS_DIGEST)
+
+    def test_not_modified(self, static_assets: smartlist.static.StaticAssets):
+        resp = static_assets.handle(_request("/assets/css/style.css", headers={
+            "If-None-Match": "\"other\", \"{}\"".format(CSS_DIGEST),
+        }))
+
+        assert resp.status == 304
+        assert resp.body is None
+        assert resp.headers["ETag"] == "\"{}\"".format(CSS_DIGEST)
+
+    def test_not_found(self, static_assets: smartlist.static.StaticAssets):
+        with pytest.raises(aiohttp.web.HTTPNotFound):
+            static_assets.handle(_request("/assets/missing.css"))
+
+    def test_method_not_allowed(self, static_assets: smartlist.static.StaticAssets):
+        with pytest.raises(aiohttp.web.HTTPMethodNotAllowed):
+            static_assets.handle(_request("/assets/tiny.js", method="POST"))
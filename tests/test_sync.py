@@ -1,32 +1,362 @@
+import asyncio
+import configparser
 import datetime
 import operator
+import sqlite3
 import typing
 import unittest.mock
 
+import aiohttp
 import pytest
 
 import smartlist.client
+import smartlist.db
+import smartlist.session
 import smartlist.sync
 
 
+EMPTY_FINGERPRINT = smartlist.sync.fingerprint_track_list([])
+
+
+async def iter_pages(*pages):
+    for page in pages:
+        yield page
+
+
+def _clean_artist(artist_id, playlist_id, snapshot_id):
+    return dict(id=artist_id, dirty=False, last_updated="updated", playlist_id=playlist_id,
+                snapshot_id=snapshot_id, fingerprint=EMPTY_FINGERPRINT)
+
+
+def _mock_unchanged_client(playlists):
+    mock_client = unittest.mock.AsyncMock()
+    mock_client.is_library_unchanged.return_value = True
+    mock_client.iter_saved_albums = unittest.mock.Mock()
+    mock_client.iter_saved_albums.return_value = iter_pages()
+    mock_client.iter_saved_tracks = unittest.mock.Mock()
+    mock_client.iter_saved_tracks.return_value = iter_pages()
+    mock_client.get_library_changes = unittest.mock.Mock()
+    mock_client.get_library_changes.return_value = []
+    mock_client.get_user_playlists.return_value = playlists
+    return mock_client
+
+
 @pytest.mark.asyncio
-async def test_sync_artists(monkeypatch: pytest.MonkeyPatch):
-    mock_sync_artist = unittest.mock.AsyncMock()
-    monkeypatch.setattr("smartlist.sync.sync_artist", mock_sync_artist)
-
-    mock_ws = unittest.mock.AsyncMock()
-    mock_db = unittest.mock.Mock()
-    mock_db.get_artists.return_value = ["a1", "a2", "a3"]
-
-    await smartlist.sync.sync_artists(mock_ws, "config", mock_db, "user_id", "client")
-
-    mock_ws.send_json.assert_called_once_with(dict(type="start"))
-    mock_db.get_artists.assert_called_once_with("user_id")
-    mock_sync_artist.assert_has_calls((
-        unittest.mock.call(mock_ws, "config", mock_db, "user_id", "client", "a1"),
-        unittest.mock.call(mock_ws, "config", mock_db, "user_id", "client", "a2"),
-        unittest.mock.call(mock_ws, "config", mock_db, "user_id", "client", "a3"),
-    ))
+class TestSyncArtists(object):
+
+    async def test_success(self, monkeypatch: pytest.MonkeyPatch):
+        mock_sync_artist = unittest.mock.AsyncMock()
+        monkeypatch.setattr("smartlist.sync.sync_artist", mock_sync_artist)
+        mock_index_album_pages_by_artist = unittest.mock.AsyncMock()
+        mock_index_album_pages_by_artist.side_effect = (
+            dict(a1="a1_albums", a2="a2_albums"),
+            dict(a1="a1_tracks", a3="a3_tracks"),
+        )
+        monkeypatch.setattr(
+            "smartlist.sync.index_album_pages_by_artist", mock_index_album_pages_by_artist)
+        mock_index_albums_by_artist = unittest.mock.Mock()
+        mock_index_albums_by_artist.return_value = dict()
+        monkeypatch.setattr("smartlist.sync.index_albums_by_artist", mock_index_albums_by_artist)
+
+        mock_ws = unittest.mock.AsyncMock()
+        mock_config = unittest.mock.Mock()
+        mock_config.getint.return_value = 1
+        mock_db = unittest.mock.AsyncMock()
+        mock_db.get_artists.return_value = [
+            dict(id="a{}".format(idx), dirty=True, playlist_id=None) for idx in range(1, 4)]
+        mock_client = unittest.mock.AsyncMock()
+        mock_client.is_library_unchanged.return_value = False
+        mock_client.get_library_changes = unittest.mock.Mock()
+        mock_client.iter_saved_albums = unittest.mock.Mock()
+        mock_client.iter_saved_tracks = unittest.mock.Mock()
+
+        await smartlist.sync.sync_artists(mock_ws, mock_config, mock_db, "user_id", mock_client)
+
+        mock_ws.send_json.assert_called_once_with(dict(type="start"))
+        mock_config.getint.assert_has_calls((
+            unittest.mock.call("sync", "max_concurrency", fallback=1),
+            unittest.mock.call("sync", "write_batch_size", fallback=20),
+        ))
+        mock_db.get_artists.assert_called_once_with("user_id")
+        mock_client.is_library_unchanged.assert_called_once_with()
+        mock_client.iter_saved_albums.assert_called_once_with(use_snapshot=False)
+        mock_client.iter_saved_tracks.assert_called_once_with(use_snapshot=False)
+        mock_index_album_pages_by_artist.assert_has_calls((
+            unittest.mock.call(mock_client.iter_saved_albums.return_value, {"a1", "a2", "a3"}),
+            unittest.mock.call(mock_client.iter_saved_tracks.return_value, {"a1", "a2", "a3"}),
+        ))
+        mock_index_albums_by_artist.assert_called_once_with(
+            mock_client.get_library_changes.return_value, {"a1", "a2", "a3"})
+        mock_sync_artist.assert_has_calls((
+            unittest.mock.call(mock_ws, mock_config, unittest.mock.ANY, "user_id", mock_client,
+                               dict(id="a1", dirty=True, playlist_id=None),
+                               "a1_albums", "a1_tracks", None),
+            unittest.mock.call(mock_ws, mock_config, unittest.mock.ANY, "user_id", mock_client,
+                               dict(id="a2", dirty=True, playlist_id=None), "a2_albums", [], None),
+            unittest.mock.call(mock_ws, mock_config, unittest.mock.ANY, "user_id", mock_client,
+                               dict(id="a3", dirty=True, playlist_id=None), [], "a3_tracks", None),
+        ))
+        updates = mock_sync_artist.call_args[0][2]
+        assert isinstance(updates, smartlist.sync.ArtistUpdateBuffer)
+        assert updates._db == mock_db
+        assert updates._flush_size == 1
+
+    async def test_flushes_updates(self, monkeypatch: pytest.MonkeyPatch):
+        async def sync_artist_side_effect(ws, config, updates, user_id, client, artist, *args):
+            if artist["id"] == "a2":
+                raise Exception("test exception")
+            await updates.add(artist["id"], "playlist_id", "last_updated", "fp", "snapshot_id")
+
+        mock_sync_artist = unittest.mock.AsyncMock()
+        mock_sync_artist.side_effect = sync_artist_side_effect
+        monkeypatch.setattr("smartlist.sync.sync_artist", mock_sync_artist)
+
+        mock_config = unittest.mock.Mock()
+        mock_config.getint.return_value = 10
+        mock_db = unittest.mock.AsyncMock()
+        mock_db.get_artists.return_value = [
+            dict(id="a{}".format(idx), dirty=True, playlist_id=None) for idx in range(1, 4)]
+        mock_client = unittest.mock.AsyncMock()
+        mock_client.is_library_unchanged.return_value = False
+        mock_client.get_library_changes = unittest.mock.Mock()
+        mock_client.get_library_changes.return_value = []
+        mock_client.iter_saved_albums = unittest.mock.Mock()
+        mock_client.iter_saved_albums.return_value = iter_pages()
+        mock_client.iter_saved_tracks = unittest.mock.Mock()
+        mock_client.iter_saved_tracks.return_value = iter_pages()
+
+        with pytest.raises(Exception, match="test exception"):
+            await smartlist.sync.sync_artists(
+                unittest.mock.AsyncMock(), mock_config, mock_db, "user_id", mock_client)
+
+        mock_db.update_artist_playlists.assert_called_once_with("user_id", [
+            ("a1", "playlist_id", "last_updated", "fp", "snapshot_id"),
+            ("a3", "playlist_id", "last_updated", "fp", "snapshot_id"),
+        ])
+
+    async def test_concurrency_limit(self, monkeypatch: pytest.MonkeyPatch):
+        running = set()
+        max_running = 0
+
+        async def sync_artist_side_effect(*args):
+            nonlocal max_running
+            running.add(args[5]["id"])
+            max_running = max(max_running, len(running))
+            await asyncio.sleep(0)
+            running.remove(args[5]["id"])
+
+        mock_sync_artist = unittest.mock.AsyncMock()
+        mock_sync_artist.side_effect = sync_artist_side_effect
+        monkeypatch.setattr("smartlist.sync.sync_artist", mock_sync_artist)
+
+        mock_ws = unittest.mock.AsyncMock()
+        mock_config = unittest.mock.Mock()
+        mock_config.getint.return_value = 2
+        mock_db = unittest.mock.AsyncMock()
+        mock_db.get_artists.return_value = [
+            dict(id="a{}".format(idx), dirty=True, playlist_id=None) for idx in range(5)]
+        mock_client = unittest.mock.AsyncMock()
+        mock_client.is_library_unchanged.return_value = False
+        mock_client.get_library_changes = unittest.mock.Mock()
+        mock_client.get_library_changes.return_value = []
+        mock_client.iter_saved_albums = unittest.mock.Mock()
+        mock_client.iter_saved_albums.return_value = iter_pages()
+        mock_client.iter_saved_tracks = unittest.mock.Mock()
+        mock_client.iter_saved_tracks.return_value = iter_pages()
+
+        await smartlist.sync.sync_artists(mock_ws, mock_config, mock_db, "user_id", mock_client)
+
+        assert mock_sync_artist.call_count == 5
+        assert max_running == 2
+
+    async def test_only_dirty_artists_rebuilt(self, monkeypatch: pytest.MonkeyPatch):
+        mock_sync_artist = unittest.mock.AsyncMock()
+        monkeypatch.setattr("smartlist.sync.sync_artist", mock_sync_artist)
+        mock_index_album_pages_by_artist = unittest.mock.AsyncMock()
+        mock_index_album_pages_by_artist.side_effect = (dict(a2="a2_albums"), dict())
+        monkeypatch.setattr(
+            "smartlist.sync.index_album_pages_by_artist", mock_index_album_pages_by_artist)
+        mock_index_albums_by_artist = unittest.mock.Mock()
+        mock_index_albums_by_artist.return_value = dict(a2="a2_changes")
+        monkeypatch.setattr("smartlist.sync.index_albums_by_artist", mock_index_albums_by_artist)
+
+        mock_ws = unittest.mock.AsyncMock()
+        mock_config = unittest.mock.Mock()
+        mock_config.getint.return_value = 1
+        mock_db = unittest.mock.AsyncMock()
+        a1 = _clean_artist("a1", "p1", "s1")
+        a2 = _clean_artist("a2", "p2", "s2")
+        a3 = dict(id="a3", dirty=True, last_updated=None, playlist_id=None)
+        mock_db.get_artists.return_value = [a1, a2, a3]
+        mock_client = unittest.mock.AsyncMock()
+        mock_client.is_library_unchanged.return_value = True
+        mock_client.get_library_changes = unittest.mock.Mock()
+        mock_client.get_library_changes.return_value = "changes"
+        mock_client.get_user_playlists.return_value = dict(p1="s1", p2="s2")
+        mock_client.iter_saved_albums = unittest.mock.Mock()
+        mock_client.iter_saved_tracks = unittest.mock.Mock()
+
+        await smartlist.sync.sync_artists(mock_ws, mock_config, mock_db, "user_id", mock_client)
+
+        mock_client.iter_saved_albums.assert_called_once_with(use_snapshot=True)
+        mock_client.iter_saved_tracks.assert_called_once_with(use_snapshot=True)
+        mock_index_albums_by_artist.assert_called_once_with("changes", {"a1", "a2", "a3"})
+        mock_db.mark_artists_dirty.assert_called_once_with("user_id", ["a2"])
+        assert mock_ws.send_json.call_args_list == [
+            unittest.mock.call(dict(type="start")),
+            unittest.mock.call(dict(type="artistStart", artistId="a1")),
+            unittest.mock.call(dict(type="artistComplete", artistId="a1", lastUpdated="updated")),
+        ]
+        assert mock_sync_artist.call_args_list == [
+            unittest.mock.call(mock_ws, mock_config, unittest.mock.ANY, "user_id", mock_client,
+                               a2, "a2_albums", [], dict(p1="s1", p2="s2")),
+            unittest.mock.call(mock_ws, mock_config, unittest.mock.ANY, "user_id", mock_client,
+                               a3, [], [], dict(p1="s1", p2="s2")),
+        ]
+        mock_client.get_user_playlists.assert_called_once_with()
+
+    @pytest.mark.parametrize("error", [
+        smartlist.client.SpotifyApiException("Error getting user playlists"),
+        smartlist.client.SpotifyAuthorizationException("Refresh token revoked"),
+        aiohttp.ClientError("connection reset"),
+        asyncio.TimeoutError(),
+    ])
+    async def test_playlist_listing_fails(self, monkeypatch: pytest.MonkeyPatch, error: Exception):
+        mock_sync_artist = unittest.mock.AsyncMock()
+        monkeypatch.setattr("smartlist.sync.sync_artist", mock_sync_artist)
+
+        mock_config = unittest.mock.Mock()
+        mock_config.getint.return_value = 1
+        mock_db = unittest.mock.AsyncMock()
+        mock_db.get_artists.return_value = [dict(id="a1", dirty=True, playlist_id="p1")]
+        mock_client = unittest.mock.AsyncMock()
+        mock_client.is_library_unchanged.return_value = False
+        mock_client.iter_saved_albums = unittest.mock.Mock()
+        mock_client.iter_saved_albums.return_value = iter_pages()
+        mock_client.iter_saved_tracks = unittest.mock.Mock()
+        mock_client.iter_saved_tracks.return_value = iter_pages()
+        mock_client.get_library_changes = unittest.mock.Mock()
+        mock_client.get_library_changes.return_value = []
+        mock_client.get_user_playlists.side_effect = error
+
+        await smartlist.sync.sync_artists(
+            unittest.mock.AsyncMock(), mock_config, mock_db, "user_id", mock_client)
+
+        mock_sync_artist.assert_called_once_with(
+            unittest.mock.ANY, mock_config, unittest.mock.ANY, "user_id", mock_client,
+            dict(id="a1", dirty=True, playlist_id="p1"), [], [], None)
+
+    async def test_nothing_dirty(self, monkeypatch: pytest.MonkeyPatch):
+        mock_sync_artist = unittest.mock.AsyncMock()
+        monkeypatch.setattr("smartlist.sync.sync_artist", mock_sync_artist)
+
+        mock_config = unittest.mock.Mock()
+        mock_config.getint.return_value = 1
+        mock_db = unittest.mock.AsyncMock()
+        mock_db.get_artists.return_value = [_clean_artist("a1", "p1", "s1")]
+        mock_client = _mock_unchanged_client(dict(p1="s1"))
+
+        await smartlist.sync.sync_artists(
+            unittest.mock.AsyncMock(), mock_config, mock_db, "user_id", mock_client)
+
+        mock_sync_artist.assert_not_called()
+        mock_client.get_user_playlists.assert_called_once_with()
+        mock_db.mark_artists_dirty.assert_not_called()
+        mock_db.update_artist_playlists.assert_not_called()
+
+    async def test_deleted_playlist_rebuilt(self, monkeypatch: pytest.MonkeyPatch):
+        mock_sync_artist = unittest.mock.AsyncMock()
+        monkeypatch.setattr("smartlist.sync.sync_artist", mock_sync_artist)
+
+        mock_ws = unittest.mock.AsyncMock()
+        mock_config = unittest.mock.Mock()
+        mock_config.getint.return_value = 1
+        mock_db = unittest.mock.AsyncMock()
+        a1 = _clean_artist("a1", "p1", "s1")
+        a2 = _clean_artist("a2", "p2", "s2")
+        mock_db.get_artists.return_value = [a1, a2]
+        mock_client = _mock_unchanged_client(dict(p2="s2"))
+
+        await smartlist.sync.sync_artists(mock_ws, mock_config, mock_db, "user_id", mock_client)
+
+        mock_db.mark_artists_dirty.assert_called_once_with("user_id", ["a1"])
+        mock_sync_artist.assert_called_once_with(
+            mock_ws, mock_config, unittest.mock.ANY, "user_id", mock_client,
+            a1, [], [], dict(p2="s2"))
+        assert mock_ws.send_json.call_args_list == [
+            unittest.mock.call(dict(type="start")),
+            unittest.mock.call(dict(type="artistStart", artistId="a2")),
+            unittest.mock.call(dict(type="artistComplete", artistId="a2", lastUpdated="updated")),
+        ]
+
+    async def test_edited_playlist_rebuilt(self, monkeypatch: pytest.MonkeyPatch):
+        mock_sync_artist = unittest.mock.AsyncMock()
+        monkeypatch.setattr("smartlist.sync.sync_artist", mock_sync_artist)
+
+        mock_config = unittest.mock.Mock()
+        mock_config.getint.return_value = 1
+        mock_db = unittest.mock.AsyncMock()
+        a1 = _clean_artist("a1", "p1", "s1")
+        mock_db.get_artists.return_value = [a1]
+        mock_client = _mock_unchanged_client(dict(p1="edited"))
+
+        await smartlist.sync.sync_artists(
+            unittest.mock.AsyncMock(), mock_config, mock_db, "user_id", mock_client)
+
+        mock_db.mark_artists_dirty.assert_called_once_with("user_id", ["a1"])
+        mock_sync_artist.assert_called_once_with(
+            unittest.mock.ANY, mock_config, unittest.mock.ANY, "user_id", mock_client,
+            a1, [], [], dict(p1="edited"))
+
+    async def test_fingerprint_mismatch_rebuilt(self, monkeypatch: pytest.MonkeyPatch):
+        mock_sync_artist = unittest.mock.AsyncMock()
+        monkeypatch.setattr("smartlist.sync.sync_artist", mock_sync_artist)
+
+        mock_config = unittest.mock.Mock()
+        mock_config.getint.return_value = 1
+        mock_db = unittest.mock.AsyncMock()
+        a1 = dict(_clean_artist("a1", "p1", "s1"), fingerprint="old_fingerprint")
+        mock_db.get_artists.return_value = [a1]
+        mock_client = _mock_unchanged_client(dict(p1="s1"))
+
+        await smartlist.sync.sync_artists(
+            unittest.mock.AsyncMock(), mock_config, mock_db, "user_id", mock_client)
+
+        mock_db.mark_artists_dirty.assert_called_once_with("user_id", ["a1"])
+        mock_sync_artist.assert_called_once_with(
+            unittest.mock.ANY, mock_config, unittest.mock.ANY, "user_id", mock_client,
+            a1, [], [], dict(p1="s1"))
+
+    async def test_library_exception(self, monkeypatch: pytest.MonkeyPatch):
+        mock_sync_artist = unittest.mock.AsyncMock()
+        monkeypatch.setattr("smartlist.sync.sync_artist", mock_sync_artist)
+
+        mock_ws = unittest.mock.AsyncMock()
+        mock_db = unittest.mock.AsyncMock()
+        mock_db.get_artists.return_value = [dict(id="a1"), dict(id="a2")]
+        mock_client = unittest.mock.AsyncMock()
+        mock_client.is_library_unchanged.return_value = False
+        mock_client.get_library_changes = unittest.mock.Mock()
+
+        async def failing_pages():
+            raise Exception("test exception")
+            yield
+
+        mock_client.iter_saved_albums = unittest.mock.Mock()
+        mock_client.iter_saved_albums.return_value = failing_pages()
+        mock_client.iter_saved_tracks = unittest.mock.Mock()
+        mock_client.iter_saved_tracks.return_value = iter_pages()
+
+        await smartlist.sync.sync_artists(mock_ws, "config", mock_db, "user_id", mock_client)
+
+        mock_client.iter_saved_albums.assert_called_once_with(use_snapshot=False)
+        mock_client.get_library_changes.assert_not_called()
+        mock_sync_artist.assert_not_called()
+        mock_ws.send_json.assert_has_calls((
+            unittest.mock.call(dict(type="start")),
+            unittest.mock.call(dict(type="artistError", artistId="a1", error="Unable to sync")),
+            unittest.mock.call(dict(type="artistError", artistId="a2", error="Unable to sync")),
+        ))
 
 
 @pytest.mark.asyncio
@@ -40,17 +370,15 @@ class TestSyncArtist(object):
             return mock
 
         return (
-            create_mock("filter_albums"),
             create_mock("merge_album_lists"),
             create_mock("convert_album_list_to_track_list"),
             create_mock("get_or_create_playlist", constructor=unittest.mock.AsyncMock),
             create_mock("replace_playlist_tracks", constructor=unittest.mock.AsyncMock),
-            create_mock("update_artist_playlist_info"),
+            create_mock("update_artist_playlist_info", constructor=unittest.mock.AsyncMock),
         )
 
     async def test_success(self, mock_processing_functions: typing.Tuple[unittest.mock.Mock, ...]):
         (
-            mock_filter_albums,
             mock_merge_album_lists,
             mock_convert_album_list_to_track_list,
             mock_get_or_create_playlist,
@@ -59,40 +387,35 @@ class TestSyncArtist(object):
         ) = mock_processing_functions
 
         now = datetime.datetime.now(datetime.timezone.utc)
-        mock_filter_albums.side_effect = ["filtered_saved_albums", "filtered_saved_tracks"]
         mock_merge_album_lists.return_value = "merged_album_list"
         mock_convert_album_list_to_track_list.return_value = [
-            smartlist.client.Track("t1", None, None, None, None, None),
-            smartlist.client.Track("t2", None, None, None, None, None),
+            smartlist.client.Track("t1", "t1", None, None, None, None),
+            smartlist.client.Track("t2", "t2", None, None, None, None),
         ]
-        mock_get_or_create_playlist.return_value = "playlist_id"
+        mock_get_or_create_playlist.return_value = ("playlist_id", "snapshot_id")
+        mock_replace_playlist_tracks.return_value = "new_snapshot_id"
         mock_update_artist_playlist_info.return_value = now
 
         mock_client = unittest.mock.AsyncMock()
-        mock_client.get_saved_albums.return_value = "saved_albums"
-        mock_client.get_saved_tracks.return_value = "saved_tracks"
-
         mock_ws = unittest.mock.AsyncMock()
 
+        artist = dict(id="artist_id", playlist_id="playlist_id", snapshot_id="snapshot_id",
+                      fingerprint="old_fingerprint", last_updated="last_updated")
         await smartlist.sync.sync_artist(
-            mock_ws, "config", "db", "user_id", mock_client, dict(id="artist_id"))
+            mock_ws, "config", "updates", "user_id", mock_client, artist,
+            "saved_albums", "saved_tracks")
 
-        mock_filter_albums.assert_has_calls((
-            unittest.mock.call("artist_id", "saved_albums"),
-            unittest.mock.call("artist_id", "saved_tracks"),
-        ))
-        mock_merge_album_lists.assert_called_once_with(
-            "filtered_saved_albums", "filtered_saved_tracks")
+        mock_merge_album_lists.assert_called_once_with("saved_albums", "saved_tracks")
         mock_convert_album_list_to_track_list.assert_called_once_with("merged_album_list")
         mock_get_or_create_playlist.assert_called_once_with(
-            "config", "user_id", mock_client, dict(id="artist_id"))
+            "config", "user_id", mock_client, artist, None)
         mock_replace_playlist_tracks.assert_called_once_with(
             mock_client, "playlist_id", mock_convert_album_list_to_track_list.return_value)
         mock_update_artist_playlist_info.assert_called_once_with(
-            "db", "user_id", dict(id="artist_id"), "playlist_id")
-
-        mock_client.get_saved_albums.assert_called_once_with()
-        mock_client.get_saved_tracks.assert_called_once_with()
+            "updates", artist, "playlist_id",
+            smartlist.sync.fingerprint_track_list(
+                mock_convert_album_list_to_track_list.return_value),
+            "new_snapshot_id")
 
         mock_ws.send_json.assert_has_calls((
             unittest.mock.call(dict(type="artistStart", artistId="artist_id")),
@@ -100,10 +423,9 @@ class TestSyncArtist(object):
                                lastUpdated=now.isoformat())),
         ))
 
-    async def test_exception(self,
+    async def test_unchanged(self,
                              mock_processing_functions: typing.Tuple[unittest.mock.Mock, ...]):
         (
-            mock_filter_albums,
             mock_merge_album_lists,
             mock_convert_album_list_to_track_list,
             mock_get_or_create_playlist,
@@ -111,23 +433,58 @@ class TestSyncArtist(object):
             mock_update_artist_playlist_info,
         ) = mock_processing_functions
 
-        mock_client = unittest.mock.AsyncMock()
-        mock_client.get_saved_albums.side_effect = Exception("test exception")
+        mock_convert_album_list_to_track_list.return_value = [
+            smartlist.client.Track("t1", "t1", None, None, None, None),
+        ]
+        mock_get_or_create_playlist.return_value = ("playlist_id", "snapshot_id")
 
+        mock_client = unittest.mock.AsyncMock()
         mock_ws = unittest.mock.AsyncMock()
 
+        artist = dict(id="artist_id", playlist_id="playlist_id", snapshot_id="snapshot_id",
+                      fingerprint=smartlist.sync.fingerprint_track_list(
+                          mock_convert_album_list_to_track_list.return_value),
+                      last_updated="last_updated")
+        mock_updates = unittest.mock.AsyncMock()
         await smartlist.sync.sync_artist(
-            mock_ws, None, None, None, mock_client, dict(id="artist_id"))
+            mock_ws, "config", mock_updates, "user_id", mock_client, artist, [], [])
 
-        mock_filter_albums.assert_not_called()
-        mock_merge_album_lists.assert_not_called()
-        mock_convert_album_list_to_track_list.assert_not_called()
-        mock_get_or_create_playlist.assert_not_called()
         mock_replace_playlist_tracks.assert_not_called()
         mock_update_artist_playlist_info.assert_not_called()
+        mock_updates.add.assert_called_once_with(
+            "artist_id", "playlist_id", "last_updated", artist["fingerprint"], "snapshot_id")
+        mock_ws.send_json.assert_has_calls((
+            unittest.mock.call(dict(type="artistStart", artistId="artist_id")),
+            unittest.mock.call(dict(type="artistComplete", artistId="artist_id",
+                               lastUpdated="last_updated")),
+        ))
 
-        mock_client.get_saved_albums.assert_called_once_with()
-        mock_client.get_saved_tracks.assert_not_called()
+    async def test_exception(self,
+                             mock_processing_functions: typing.Tuple[unittest.mock.Mock, ...]):
+        (
+            mock_merge_album_lists,
+            mock_convert_album_list_to_track_list,
+            mock_get_or_create_playlist,
+            mock_replace_playlist_tracks,
+            mock_update_artist_playlist_info,
+        ) = mock_processing_functions
+
+        mock_convert_album_list_to_track_list.return_value = []
+        mock_get_or_create_playlist.side_effect = Exception("test exception")
+
+        mock_client = unittest.mock.AsyncMock()
+        mock_ws = unittest.mock.AsyncMock()
+
+        await smartlist.sync.sync_artist(
+            mock_ws, None, None, None, mock_client, dict(id="artist_id"), [], [])
+
+        mock_merge_album_lists.assert_called_once_with([], [])
+        mock_convert_album_list_to_track_list.assert_called_once_with(
+            mock_merge_album_lists.return_value)
+        mock_get_or_create_playlist.assert_called_once_with(
+            None, None, mock_client, dict(id="artist_id"), None)
+        mock_replace_playlist_tracks.assert_not_called()
+        mock_update_artist_playlist_info.assert_not_called()
 
         mock_ws.send_json.assert_has_calls((
             unittest.mock.call(dict(type="artistStart", artistId="artist_id")),
@@ -136,7 +493,21 @@ class TestSyncArtist(object):
         ))
 
 
-def test_filter_albums():
+@pytest.mark.parametrize("playlist_id,fingerprint,playlists,expected", [
+    ("p1", "fp", dict(p1="s1"), True),
+    (None, "fp", dict(), False),
+    ("p1", "fp", None, False),
+    ("p1", "fp", dict(), False),
+    ("p1", "fp", dict(p1="s2"), False),
+    ("p1", "other_fp", dict(p1="s1"), False),
+])
+def test_is_playlist_current(playlist_id, fingerprint, playlists, expected):
+    artist = dict(playlist_id=playlist_id, fingerprint="fp", snapshot_id="s1")
+
+    assert smartlist.sync.is_playlist_current(artist, fingerprint, playlists) == expected
+
+
+def test_index_albums_by_artist():
     def _build_track(track_name, artist_names):
         return smartlist.client.Track(
             track_name,
@@ -147,33 +518,67 @@ def test_filter_albums():
             None,
         )
 
-    # album with only matching tracks
-    album1 = smartlist.client.Album("album1", None, None, None, None)
+    # album with only a1 tracks
+    album1 = smartlist.client.Album("album1", None, None, "album1", None)
     album1.add_track(_build_track("t1", ["a1"]))
     album1.add_track(_build_track("t2", ["a1"]))
 
-    # album with no matching tracks
-    album2 = smartlist.client.Album("album4", None, None, None, None)
+    # album with only a2 tracks
+    album2 = smartlist.client.Album("album2", None, None, "album2", None)
     album2.add_track(_build_track("t1", ["a2"]))
-    album2.add_track(_build_track("t2", ["a2"]))
 
-    # album with some matching tracks
-    album3 = smartlist.client.Album("album2", None, None, None, None)
+    # album with mixed artist tracks
+    album3 = smartlist.client.Album("album3", None, None, "album3", None)
     album3.add_track(_build_track("t1", ["a1"]))
-    album3.add_track(_build_track("t2", ["a2"]))
+    album3.add_track(_build_track("t2", ["a2", "a3"]))
+
+    index = smartlist.sync.index_albums_by_artist([album1, album2, album3])
 
-    # album with multi artist tracks
-    album4 = smartlist.client.Album("album3", None, None, None, None)
-    album4.add_track(_build_track("t1", ["a2", "a3"]))
-    album4.add_track(_build_track("t2", ["a1", "a2"]))
+    assert {
+        artist_uri: [
+            (album.name, tuple(map(operator.attrgetter("name"), album.tracks.values())))
+            for album in albums
+        ]
+        for artist_uri, albums in index.items()
+    } == {
+        "a1": [("album1", ("t1", "t2")), ("album3", ("t1",))],
+        "a2": [("album2", ("t1",)), ("album3", ("t2",))],
+        "a3": [("album3", ("t2",))],
+    }
+    assert index["a1"][0] is not album1
+    assert list(map(operator.attrgetter("name"), album3.tracks.values())) == ["t1", "t2"]
+
+
+def test_index_albums_by_artist_filtered():
+    track = smartlist.client.Track(
+        "t1", "t1", 1, 1,
+        [smartlist.client.Artist("a1", "a1"), smartlist.client.Artist("a2", "a2")], None)
+    album = smartlist.client.Album("album", "2021", "year", "album", [])
+    album.add_track(track)
+
+    index = smartlist.sync.index_albums_by_artist([album], {"a2", "a3"})
+
+    assert list(index) == ["a2"]
+    assert list(index["a2"][0].tracks.values()) == [track]
+
+
+@pytest.mark.asyncio
+async def test_index_album_pages_by_artist(monkeypatch: pytest.MonkeyPatch):
+    mock_index_albums_by_artist = unittest.mock.Mock()
+    mock_index_albums_by_artist.side_effect = (
+        dict(a1=["p1a1"], a2=["p1a2"]),
+        dict(a1=["p2a1"]),
+    )
+    monkeypatch.setattr("smartlist.sync.index_albums_by_artist", mock_index_albums_by_artist)
 
-    filtered_albums = smartlist.sync.filter_albums("a1", [album1, album2, album3, album4])
+    index = await smartlist.sync.index_album_pages_by_artist(
+        iter_pages("page1", "page2"), {"a1", "a2"})
 
-    assert filtered_albums == [album1, album3, album4]
-    assert list(map(operator.attrgetter("name"), album1.tracks.values())) == ["t1", "t2"]
-    assert list(map(operator.attrgetter("name"), album2.tracks.values())) == []
-    assert list(map(operator.attrgetter("name"), album3.tracks.values())) == ["t1"]
-    assert list(map(operator.attrgetter("name"), album4.tracks.values())) == ["t2"]
+    assert index == dict(a1=["p1a1", "p2a1"], a2=["p1a2"])
+    mock_index_albums_by_artist.assert_has_calls((
+        unittest.mock.call("page1", {"a1", "a2"}),
+        unittest.mock.call("page2", {"a1", "a2"}),
+    ))
 
 
 def test_merge_album_lists():
@@ -214,6 +619,45 @@ def test_merge_album_lists():
     )
 
 
+@pytest.mark.asyncio
+async def test_fingerprint_matches_between_full_pass_and_snapshot():
+    def saved_album(uri, added_at):
+        artist = dict(name="ar1", uri="ar1")
+        return dict(added_at=added_at, album=dict(
+            name=uri, uri=uri, release_date="2021-01-01", release_date_precision="day",
+            artists=[artist], tracks=dict(next=None, total=2, items=[
+                dict(name=name, uri="{}:{}".format(uri, name), disc_number=1,
+                     track_number=number, artists=[artist])
+                for number, name in ((2, "t2"), (1, "t1"))])))
+
+    conn = sqlite3.connect(":memory:", check_same_thread=False)
+    smartlist.db.apply_db_scripts(conn)
+    db = smartlist.db.AsyncSmartListDB(smartlist.db.SmartListDB(conn))
+    client = smartlist.client.SpotifyClient(
+        configparser.ConfigParser(), db,
+        smartlist.session.Session(dict(user_info=dict(user_id="user_id"))))
+    client._iter_saved_item_pages = unittest.mock.Mock()
+    client._iter_saved_item_pages.return_value = iter_pages(
+        [saved_album("spotify:album:b", "3"), saved_album("spotify:album:c", "2")],
+        [saved_album("spotify:album:a", "1")])
+
+    full_index = await smartlist.sync.index_album_pages_by_artist(
+        client.iter_saved_albums(), {"ar1"})
+    snapshot_index = await smartlist.sync.index_album_pages_by_artist(
+        client.iter_saved_albums(use_snapshot=True), {"ar1"})
+    await db.close()
+
+    full_tracks = smartlist.sync.build_artist_track_list(full_index["ar1"], [])
+    snapshot_tracks = smartlist.sync.build_artist_track_list(snapshot_index["ar1"], [])
+    assert [album.uri for album in full_index["ar1"]] != \
+        [album.uri for album in snapshot_index["ar1"]]
+    assert [track.uri for track in full_tracks] == [
+        "spotify:album:{}:{}".format(album, track)
+        for album in "abc" for track in ("t1", "t2")]
+    assert smartlist.sync.fingerprint_track_list(full_tracks) == \
+        smartlist.sync.fingerprint_track_list(snapshot_tracks)
+
+
 def test_convert_album_list_to_track_list():
     def _build_album(album_name, release_date, track_builders):
         album = smartlist.client.Album(album_name, release_date, "day", None, None)
@@ -264,12 +708,36 @@ class TestGetOrCreatePlaylist(object):
 
     async def test_playlist_exists(self):
         mock_client = unittest.mock.AsyncMock()
+        mock_client.get_playlist.return_value = dict(snapshot_id="snapshot_id")
 
-        playlist_id = await smartlist.sync.get_or_create_playlist(
+        playlist_id, snapshot_id = await smartlist.sync.get_or_create_playlist(
             None, None, mock_client, dict(playlist_id="playlist_id"))
 
         assert playlist_id == "playlist_id"
-        mock_client.get_playlist.assert_called_once_with("playlist_id")
+        assert snapshot_id == "snapshot_id"
+        mock_client.get_playlist.assert_called_once_with("playlist_id", fields="snapshot_id")
+
+    async def test_playlist_listed(self):
+        mock_client = unittest.mock.AsyncMock()
+
+        playlist_id, snapshot_id = await smartlist.sync.get_or_create_playlist(
+            None, None, mock_client, dict(playlist_id="playlist_id"),
+            dict(playlist_id="listed_snapshot_id"))
+
+        assert playlist_id == "playlist_id"
+        assert snapshot_id == "listed_snapshot_id"
+        mock_client.get_playlist.assert_not_called()
+
+    async def test_playlist_not_listed(self):
+        mock_client = unittest.mock.AsyncMock()
+        mock_client.get_playlist.return_value = dict(snapshot_id="snapshot_id")
+
+        playlist_id, snapshot_id = await smartlist.sync.get_or_create_playlist(
+            None, None, mock_client, dict(playlist_id="playlist_id"), dict(other="other"))
+
+        assert playlist_id == "playlist_id"
+        assert snapshot_id == "snapshot_id"
+        mock_client.get_playlist.assert_called_once_with("playlist_id", fields="snapshot_id")
 
     @pytest.mark.parametrize("get_fails", (True, False), ids=("GetFails", "NoExisting"))
     async def test_playlist_created(self, get_fails):
@@ -277,7 +745,8 @@ class TestGetOrCreatePlaylist(object):
         mock_config.get.side_effect = ("NameTemplate: {name}", "DescriptionTemplate: {name}")
         mock_client = unittest.mock.AsyncMock()
         mock_client.get_artists_by_ids.return_value = [dict(name="artist_name")]
-        mock_client.create_playlist.return_value = dict(uri="created_playlist_id")
+        mock_client.create_playlist.return_value = dict(
+            uri="created_playlist_id", snapshot_id="snapshot_id")
 
         artist = dict(id="artist_id", playlist_id=None)
         if get_fails:
@@ -285,10 +754,11 @@ class TestGetOrCreatePlaylist(object):
             mock_client.get_playlist.side_effect = smartlist.client.SpotifyApiException(
                 "Error getting playlist")
 
-        playlist_id = await smartlist.sync.get_or_create_playlist(
+        playlist_id, snapshot_id = await smartlist.sync.get_or_create_playlist(
             mock_config, "user_id", mock_client, artist)
 
         assert playlist_id == "created_playlist_id"
+        assert snapshot_id == "snapshot_id"
         mock_config.get.assert_has_calls((
             unittest.mock.call("playlist", "name_template", fallback="SmartList: {name}"),
             unittest.mock.call(
@@ -299,28 +769,105 @@ class TestGetOrCreatePlaylist(object):
         mock_client.create_playlist.assert_called_once_with(
             "user_id", "NameTemplate: artist_name", "DescriptionTemplate: artist_name")
         if get_fails:
-            mock_client.get_playlist.assert_called_once_with("existing_playlist_id")
+            mock_client.get_playlist.assert_called_once_with(
+                "existing_playlist_id", fields="snapshot_id")
+
+
+def _build_tracks(uris):
+    return [smartlist.client.Track(None, uri, None, None, None, None) for uri in uris]
+
+
+@pytest.mark.parametrize("current_uris,desired_uris,expected_removals,expected_insertions", (
+    ("abcd", "abcd", [], []),
+    ("", "abc", [], [(0, "abc")]),
+    ("abc", "", [(0, "a"), (1, "b"), (2, "c")], []),
+    ("abd", "abcde", [], [(2, "c"), (4, "e")]),
+    ("abxcd", "abcd", [(2, "x")], []),
+    ("dabc", "abcd", [(0, "d")], [(3, "d")]),
+    ("abab", "ab", [(2, "a"), (3, "b")], []),
+), ids=("Unchanged", "Empty", "Cleared", "Inserted", "Removed", "Moved", "Duplicates"))
+def test_diff_playlist_tracks(current_uris, desired_uris, expected_removals, expected_insertions):
+    removals, insertions = smartlist.sync.diff_playlist_tracks(
+        list(current_uris), _build_tracks(desired_uris))
+
+    assert removals == expected_removals
+    assert [(position, "".join(track.uri for track in run))
+            for position, run in insertions] == expected_insertions
 
 
 @pytest.mark.asyncio
 async def test_replace_playlist_tracks():
     mock_client = unittest.mock.AsyncMock()
-    await smartlist.sync.replace_playlist_tracks(mock_client, "playlist_id", "tracks")
+    mock_client.get_playlist_items.return_value = ("snapshot1", ["a", "x", "c"])
+    mock_client.remove_items_from_playlist.return_value = "snapshot2"
+    mock_client.add_items_to_playlist.side_effect = ("snapshot3", "snapshot4")
+
+    tracks = _build_tracks("abcd")
+    snapshot_id = await smartlist.sync.replace_playlist_tracks(
+        mock_client, "playlist_id", tracks)
+
+    assert snapshot_id == "snapshot4"
+    mock_client.get_playlist_items.assert_called_once_with("playlist_id")
+    mock_client.remove_items_from_playlist.assert_called_once_with(
+        "playlist_id", [(1, "x")], "snapshot1")
+    mock_client.add_items_to_playlist.assert_has_calls((
+        unittest.mock.call("playlist_id", [tracks[1]], position=1),
+        unittest.mock.call("playlist_id", [tracks[3]], position=3),
+    ))
+
+
+@pytest.mark.asyncio
+async def test_replace_playlist_tracks_unchanged():
+    mock_client = unittest.mock.AsyncMock()
+    mock_client.get_playlist_items.return_value = ("snapshot1", ["a", "b"])
 
-    mock_client.clear_playlist.assert_called_once_with("playlist_id")
-    mock_client.add_items_to_playlist.assert_called_once_with("playlist_id", "tracks")
+    snapshot_id = await smartlist.sync.replace_playlist_tracks(
+        mock_client, "playlist_id", _build_tracks("ab"))
 
+    assert snapshot_id == "snapshot1"
+    mock_client.remove_items_from_playlist.assert_not_called()
+    mock_client.add_items_to_playlist.assert_not_called()
 
-def test_update_artist_playlist_info(monkeypatch: pytest.MonkeyPatch):
+
+@pytest.mark.asyncio
+async def test_update_artist_playlist_info(monkeypatch: pytest.MonkeyPatch):
     mock_datetime_datetime = unittest.mock.Mock()
     monkeypatch.setattr("smartlist.actions.datetime.datetime", mock_datetime_datetime)
 
-    mock_db = unittest.mock.Mock()
-    last_updated = smartlist.sync.update_artist_playlist_info(
-        mock_db, "user_id", dict(id="artist_id"), "playlist_id")
+    mock_updates = unittest.mock.AsyncMock()
+    last_updated = await smartlist.sync.update_artist_playlist_info(
+        mock_updates, dict(id="artist_id"), "playlist_id", "fingerprint", "snapshot_id")
 
     assert last_updated == mock_datetime_datetime.now.return_value
     mock_datetime_datetime.now.assert_called_once_with(datetime.timezone.utc)
-    mock_db.update_artist_playlist.assert_called_once_with(
-        "user_id", "artist_id", "playlist_id",
-        mock_datetime_datetime.now.return_value.isoformat.return_value)
+    mock_updates.add.assert_called_once_with(
+        "artist_id", "playlist_id",
+        mock_datetime_datetime.now.return_value.isoformat.return_value,
+        "fingerprint", "snapshot_id")
+
+
+@pytest.mark.asyncio
+class TestArtistUpdateBuffer(object):
+
+    async def test_flushes_every_n_updates(self):
+        mock_db = unittest.mock.AsyncMock()
+        updates = smartlist.sync.ArtistUpdateBuffer(mock_db, "user_id", 2)
+
+        for idx in range(5):
+            await updates.add("a{}".format(idx), "p", "u", "f", "s")
+
+        assert mock_db.update_artist_playlists.call_args_list == [
+            unittest.mock.call("user_id", [("a0", "p", "u", "f", "s"), ("a1", "p", "u", "f", "s")]),
+            unittest.mock.call("user_id", [("a2", "p", "u", "f", "s"), ("a3", "p", "u", "f", "s")]),
+        ]
+
+        await updates.flush()
+        mock_db.update_artist_playlists.assert_called_with("user_id", [("a4", "p", "u", "f", "s")])
+
+    async def test_flush_empty(self):
+        mock_db = unittest.mock.AsyncMock()
+        updates = smartlist.sync.ArtistUpdateBuffer(mock_db, "user_id", 2)
+
+        await updates.flush()
+
+        mock_db.update_artist_playlists.assert_not_called()